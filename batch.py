@@ -0,0 +1,186 @@
+# -----------------------------------------------------------------------
+#  Batch processing of Use Case 2 jobs outside Proteome Discoverer
+# -----------------------------------------------------------------------
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import scriptutils
+
+"""
+Runs UC2.perform on many node_args.json files, e.g. to reprocess archived
+consensus exports on machines without Proteome Discoverer. The arguments are
+node_args.json files, folders searched for node_args.json files, or glob
+patterns ('archive/**/node_args.json').
+
+Every job runs in a process of its own, --jobs of them at a time, optionally
+with its address space limited to --memory-limit MB, so a job that fails,
+runs out of memory or crashes does not affect the others. What a job prints
+goes to a log file next to its node_args.json. A summary line per job gives
+its status, wall time, rows written and peak RSS; --summary stores them as
+JSON. The exit code is 1 when a job failed.
+
+Example:
+
+    python batch.py --jobs 4 --memory-limit 4096 --uc2-args "--join-mode sortmerge" archive/
+"""
+
+# name of the node_args.json files searched for in folders
+nodeArgsName = 'node_args.json'
+
+def findJobs(paths):
+    """ Returns the node_args.json files of files, folders and glob patterns, each once, in the given order """
+    fileNames = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for dirPath, dirNames, names in os.walk(path):
+                if nodeArgsName in names:
+                    found.append(os.path.join(dirPath, nodeArgsName))
+        elif os.path.isfile(path):
+            found = [path]
+        else:
+            found = glob.glob(path, recursive=True)
+            assert found, "No node_args.json file matches {}".format(path)
+        fileNames.extend(sorted(found))
+
+    seen = set()
+    jobs = []
+    for fileName in fileNames:
+        key = os.path.normcase(os.path.abspath(fileName))
+        if key not in seen:
+            seen.add(key)
+            jobs.append(fileName)
+    return jobs
+
+def runJob(nodeArgsFileName, argv, memoryLimit, logName, connection):
+    """ Runs UC2.perform in this (child) process and sends the outcome through connection """
+    import contextlib
+    import traceback
+
+    try:
+        result = {'status': 'failed', 'rowsOut': None}
+        if memoryLimit and not scriptutils.setMemoryLimit(memoryLimit):
+            result['warning'] = 'memory limit not supported on this platform'
+        logFileName = os.path.join(os.path.dirname(os.path.abspath(nodeArgsFileName)), logName)
+        result['log'] = logFileName
+
+        startTime = time.perf_counter()
+        with open(logFileName, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                import prepare_phosphomatics_ct
+
+                fileName, options = prepare_phosphomatics_ct.UC2.parseArguments([nodeArgsFileName] + argv)
+                result['rowsOut'] = prepare_phosphomatics_ct.UC2.perform(fileName, options)
+                result['status'] = 'ok'
+            except (Exception, SystemExit) as exception:
+                traceback.print_exc()
+                result['error'] = '{}: {}'.format(exception.__class__.__name__, exception)
+        result['wallTime'] = time.perf_counter() - startTime
+        result['peakRSS'] = scriptutils.getPeakRSS()
+        connection.send(result)
+    finally:
+        connection.close()
+
+def runJobs(nodeArgsFileNames, argv, jobs, memoryLimit, logName, report=None):
+    """ Runs the jobs, at most jobs at a time, and returns their results in the order of nodeArgsFileNames
+
+    report(result) is called as every job finishes.
+    """
+    pending = list(enumerate(nodeArgsFileNames))
+    pending.reverse()
+    running = {}
+    results = [None] * len(nodeArgsFileNames)
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                index, nodeArgsFileName = pending.pop()
+                parentConnection, childConnection = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=runJob, args=(nodeArgsFileName, argv, memoryLimit, logName, childConnection))
+                process.start()
+                childConnection.close()
+                running[parentConnection] = (index, nodeArgsFileName, process)
+
+            # a connection is ready when its job sent the result or its process died
+            for connection in multiprocessing.connection.wait(list(running)):
+                index, nodeArgsFileName, process = running.pop(connection)
+                try:
+                    result = connection.recv()
+                except EOFError:
+                    result = None
+                connection.close()
+                process.join()
+                if result is None:
+                    result = {'status': 'failed', 'rowsOut': None, 'wallTime': None, 'peakRSS': None,
+                              'error': 'job process exited with code {}'.format(process.exitcode)}
+                result['nodeArgs'] = nodeArgsFileName
+                results[index] = result
+                if report is not None:
+                    report(result)
+    finally:
+        for connection, (index, nodeArgsFileName, process) in running.items():
+            process.terminate()
+            process.join()
+            connection.close()
+    return results
+
+def printResult(result):
+    wallTime = '' if result['wallTime'] is None else '%.3f' % result['wallTime']
+    rowsOut = '' if result['rowsOut'] is None else result['rowsOut']
+    peakRSS = '' if result['peakRSS'] is None else '%.1f' % (result['peakRSS'] / 1048576.0)
+    print('{:>7} {:>10} {:>12} {:>10}  {}'.format(result['status'], wallTime, rowsOut, peakRSS, result['nodeArgs']))
+    for key in ('error', 'warning'):
+        if key in result:
+            print('{:>7} {}'.format('', result[key]))
+    sys.stdout.flush()
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Run the Phosphomatics node on many node_args.json files outside Proteome Discoverer')
+    parser.add_argument('paths', nargs='+',
+        help='node_args.json files, folders to search for them, or glob patterns')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of jobs run at the same time, default: number of CPUs (%(default)s)')
+    parser.add_argument('--memory-limit', dest='memoryLimit', type=int, default=None,
+        help='address space limit (MB) of every job process, beyond which the job fails with MemoryError; '
+             'not supported on Windows; default: none')
+    parser.add_argument('--uc2-args', dest='uc2Args', default='',
+        help='further arguments for the node, split like a POSIX shell does, so quote paths with spaces, '
+             'e.g. "--join-mode sortmerge --cache-dir \'D:/UC2 cache\'"')
+    parser.add_argument('--log-name', dest='logName', default='phosphomatics_batch.log',
+        help='name of the file next to every node_args.json that gets what its job prints, default %(default)s')
+    parser.add_argument('--summary', default=None,
+        help='JSON file to store the results of the jobs in')
+    args = parser.parse_args(argv)
+
+    assert args.jobs > 0, "--jobs must be at least 1"
+    uc2Args = shlex.split(args.uc2Args)
+    # invalid node arguments are reported once here rather than by every job
+    import prepare_phosphomatics_ct
+    prepare_phosphomatics_ct.UC2.parseArguments([nodeArgsName] + uc2Args)
+
+    nodeArgsFileNames = findJobs(args.paths)
+    memoryLimit = args.memoryLimit * 1024 * 1024 if args.memoryLimit else None
+    print('batch: {} jobs, {} at a time'.format(len(nodeArgsFileNames), args.jobs))
+    print('{:>7} {:>10} {:>12} {:>10}  {}'.format('status', 'wall (s)', 'rows out', 'RSS (MB)', 'node_args'))
+
+    startTime = time.perf_counter()
+    results = runJobs(nodeArgsFileNames, uc2Args, args.jobs, memoryLimit, args.logName, printResult)
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    print('batch: {} jobs done, {} failed, {} rows written in {:.1f} s'.format(
+        len(results), failed, sum(result['rowsOut'] or 0 for result in results), time.perf_counter() - startTime))
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
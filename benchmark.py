@@ -0,0 +1,449 @@
+# -----------------------------------------------------------------------
+#  Benchmark of Use Case 2 on synthetic data
+# -----------------------------------------------------------------------
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import multiprocessing
+import scriptutils
+
+"""
+Generates node_args.json files with Peptide Groups, Modification Sites and
+TargetPeptideGroup-ModificationSite tables shaped like Proteome Discoverer
+exports, runs UC2.perform on them end to end and reports wall time, map rows
+per second and peak RSS for every scale.
+
+Every run happens in a fresh process, so the peak RSS belongs to that run
+alone. Datasets are generated once into --data-dir and reused by later
+benchmarks with the same parameters. With --decoding, only the decoding
+of node_args.json is timed, by structure and by the object_hook decoder.
+With --reload, the node writes the results table also as .npz (see the
+columnarOutput option) and reloading Phosphomatics.txt with csv is timed
+against loading Phosphomatics.npz, with numpy when it is installed. With
+--pdresult, the tables of every dataset are also written to an SQLite file
+laid out like a .pdResult file (see writePdResult), which the node then
+reads instead of the table files.
+
+Example:
+
+    python benchmark.py --scales 10000,100000,1000000 --channels 16,300 --join-modes hash,sortmerge
+"""
+
+# ratios of table sizes to the number of map rows, roughly those of TMT phospho studies
+peptidesPerMapping = 0.35
+sitesPerMapping = 0.5
+
+modificationNames = [
+    ('Phospho', 0.45), ('Oxidation', 0.25), ('Carbamidomethyl', 0.2), ('Acetyl', 0.05), ('GlyGly', 0.05)
+]
+modificationResidues = {
+    'Phospho': 'STY', 'Oxidation': 'M', 'Carbamidomethyl': 'C', 'Acetyl': 'K', 'GlyGly': 'K'
+}
+
+# fraction of missing abundance values
+missingFraction = 0.15
+
+# Modifications cells of generateDataset with specialCells, %s being the usual value
+specialModifications = ['%s;\t1xAcetyl [K2]', '%s\n1xAcetyl [K2]', '%s "1xGlyGly"', '"%s"\r\n\t""']
+
+def columnDescription(name, iD, dataType, dataGroupName=None):
+    options = {} if dataGroupName is None else {'DataGroupName': dataGroupName}
+    return {'ColumnName': name, 'ID': iD, 'DataType': dataType, 'Options': options}
+
+def writeTable(fileName, columnDescriptions, rows):
+    with open(fileName, 'w') as f:
+        # PD quotes all header fields, data fields only where needed
+        f.write('\t'.join('"%s"' % c['ColumnName'] for c in columnDescriptions) + '\n')
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerows(rows)
+
+def generateDataset(dataDir, mappings, channels, extraColumns=10, seed=1, specialCells=False):
+    """ Writes a synthetic dataset to dataDir and returns the name of its node_args.json
+
+    mappings is the number of map table rows, channels the number of abundance
+    columns of the Peptide Groups table, extraColumns the number of other
+    grouped numeric columns (like the abundance ratios PD exports). With
+    specialCells, every fifth Modifications cell holds tabs, line breaks or
+    quotes, which PD exports in quoted cells.
+    """
+    nodeArgsFileName = os.path.join(dataDir, 'node_args.json')
+    if os.path.exists(nodeArgsFileName):
+        return nodeArgsFileName
+    if not os.path.isdir(dataDir):
+        os.makedirs(dataDir)
+
+    rng = random.Random(seed)
+    peptideCount = max(1, int(mappings * peptidesPerMapping))
+    siteCount = max(1, int(mappings * sitesPerMapping))
+
+    pepColumns = [
+        columnDescription('Peptide Groups Peptide Group ID', 'ID', 'Int'),
+        columnDescription('Sequence', '', 'String'),
+        columnDescription('Modifications', '', 'String'),
+        columnDescription('Confidence', '', 'String'),
+    ]
+    pepColumns += [columnDescription('Abundances F%d' % (i + 1), '', 'Float', 'Abundances') for i in range(channels)]
+    pepColumns += [columnDescription('Abundance Ratio F%d' % (i + 1), '', 'Float', 'Abundance Ratios') for i in range(extraColumns)]
+
+    modColumns = [
+        columnDescription('Modification Sites Modification Site ID', 'ID', 'Int'),
+        columnDescription('Modification Name', '', 'String'),
+        columnDescription('Target Amino Acid', '', 'String'),
+        columnDescription('Position', '', 'Int'),
+        columnDescription('Protein Accession', '', 'String'),
+        columnDescription('Site Probability', '', 'Float'),
+    ]
+
+    mapColumns = [
+        columnDescription('Peptide Groups Peptide Group ID', 'ID', 'Int'),
+        columnDescription('Modification Sites Modification Site ID', 'ID', 'Int'),
+        columnDescription('Site Status', '', 'String'),
+    ]
+    del mapColumns[2]['Options']
+
+    def abundance():
+        return '' if rng.random() < missingFraction else '%.6g' % rng.lognormvariate(13, 2)
+
+    def peptideRows():
+        for peptideID in range(1, peptideCount + 1):
+            sequence = ''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for i in range(rng.randint(7, 25)))
+            modifications = '1xPhospho [S%d]; 1xOxidation [M%d]' % (rng.randint(1, 7), rng.randint(1, 7))
+            if specialCells and peptideID % 5 == 0:
+                modifications = specialModifications[peptideID // 5 % len(specialModifications)] % modifications
+            yield ([peptideID, sequence, modifications, rng.choice(['High', 'Medium', 'Low'])]
+                   + [abundance() for i in range(channels)]
+                   + ['%.3f' % rng.uniform(0.1, 10) for i in range(extraColumns)])
+
+    names = [name for name, weight in modificationNames]
+    weights = [weight for name, weight in modificationNames]
+    proteins = max(1, siteCount // 8)
+
+    def siteRows():
+        for siteID in range(1, siteCount + 1):
+            name = rng.choices(names, weights)[0]
+            yield [siteID, name, rng.choice(modificationResidues[name]), rng.randint(1, 2000),
+                   'P%05d' % rng.randint(1, proteins), '%.2f' % rng.uniform(0, 100)]
+
+    def mapRows():
+        for i in range(mappings):
+            yield [rng.randint(1, peptideCount), rng.randint(1, siteCount), rng.choice(['Confident', 'Ambiguous'])]
+
+    pepFileName = os.path.join(dataDir, 'TargetPeptideGroup.txt')
+    modFileName = os.path.join(dataDir, 'ModificationSite.txt')
+    mapFileName = os.path.join(dataDir, 'TargetPeptideGroup-ModificationSite.txt')
+    writeTable(pepFileName, pepColumns, peptideRows())
+    writeTable(modFileName, modColumns, siteRows())
+    writeTable(mapFileName, mapColumns, mapRows())
+
+    nodeArgs = {
+        'CurrentWorkflowID': 1,
+        'ExpectedResponsePath': os.path.join(dataDir, 'node_response.json'),
+        'WorkingDirectory': dataDir,
+        'ResultFilePath': os.path.join(dataDir, 'benchmark.pdResult'),
+        'Version': 1,
+        'Tables': [
+            {'TableName': 'Peptide Groups', 'DataFile': pepFileName, 'DataFormat': 'CSV',
+             'Options': {}, 'ColumnDescriptions': pepColumns},
+            {'TableName': 'Modification Sites', 'DataFile': modFileName, 'DataFormat': 'CSV',
+             'Options': {}, 'ColumnDescriptions': modColumns},
+            {'TableName': 'TargetPeptideGroup-ModificationSite', 'DataFile': mapFileName,
+             'DataFormat': 'CSVConnectionTable',
+             'Options': {'FirstTable': 'Peptide Groups', 'SecondTable': 'Modification Sites'},
+             'ColumnDescriptions': mapColumns},
+        ]
+    }
+    # written last, so an interrupted generation is not mistaken for a complete dataset
+    with open(nodeArgsFileName, 'w') as f:
+        json.dump(nodeArgs, f, indent=4)
+    return nodeArgsFileName
+
+# names of the tables in the files written by writePdResult
+pdResultTableNames = {
+    'Peptide Groups': 'TargetPeptideGroups',
+    'Modification Sites': 'TargetModificationSites',
+    'TargetPeptideGroup-ModificationSite': 'TargetPeptideGroupsTargetModificationSites',
+}
+pdResultColumnTypes = {'Int': 'INTEGER', 'Float': 'REAL', 'String': 'TEXT'}
+
+def writePdResult(nodeArgsFileName, fileName=None, groupedValues=True):
+    """ Writes the tables of a node_args.json to an SQLite file laid out like a .pdResult file, returns its name
+
+    The file goes to the ResultFilePath of node_args.json by default. Tables
+    and columns are named without spaces, their node_args.json names are
+    listed in the DataTypes and DataTypesColumns tables (see pdresult). The
+    values get the SQLite type of the DataType of their column, empty numeric
+    cells are NULL, and the ID columns are indexed. With groupedValues, the
+    columns of a DataGroupName, like the abundances, are stored together in
+    one BLOB column of grouped values named after the group, as Proteome
+    Discoverer does (see pdresult.groupedValueBytes); otherwise every column
+    is a column of the table. An existing file newer than node_args.json is
+    kept.
+    """
+    import sqlite3
+    import struct
+
+    with open(nodeArgsFileName, 'rt') as f:
+        nodeArgs = json.load(f)
+    if fileName is None:
+        fileName = nodeArgs['ResultFilePath']
+    if os.path.exists(fileName) and os.path.getmtime(fileName) >= os.path.getmtime(nodeArgsFileName):
+        return fileName
+
+    tempFileName = fileName + '.tmp'
+    if os.path.exists(tempFileName):
+        os.remove(tempFileName)
+    connection = sqlite3.connect(tempFileName)
+    try:
+        connection.execute('CREATE TABLE DataTypes (TableName TEXT, DisplayName TEXT)')
+        connection.execute('CREATE TABLE DataTypesColumns (TableName TEXT, ColumnName TEXT, DisplayName TEXT)')
+        for table in nodeArgs['Tables']:
+            tableName = pdResultTableNames.get(table['TableName'], table['TableName'].replace(' ', ''))
+            columns = table['ColumnDescriptions']
+
+            # column name -> display name, SQL type, and the indices of the cells it holds
+            layout = []
+            groups = {}
+            for index, column in enumerate(columns):
+                group = (column.get('Options') or {}).get('DataGroupName')
+                if groupedValues and group is not None and column['DataType'] == 'Float':
+                    if group not in groups:
+                        groups[group] = len(layout)
+                        layout.append((''.join(c for c in group if c.isalnum()), group, 'BLOB', []))
+                    layout[groups[group]][3].append(index)
+                else:
+                    layout.append((''.join(c for c in column['ColumnName'] if c.isalnum()), column['ColumnName'],
+                                   pdResultColumnTypes.get(column['DataType'], 'TEXT'), [index]))
+            connection.execute('INSERT INTO DataTypes VALUES (?, ?)', (tableName, table['TableName']))
+            connection.executemany('INSERT INTO DataTypesColumns VALUES (?, ?, ?)', [
+                (tableName, columnName, displayName) for columnName, displayName, columnType, indices in layout])
+            connection.execute('CREATE TABLE {} ({})'.format(tableName, ', '.join(
+                '{} {}'.format(columnName, columnType) for columnName, displayName, columnType, indices in layout)))
+            for columnName, displayName, columnType, indices in layout:
+                if columns[indices[0]]['ID'] == 'ID':
+                    connection.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(tableName, columnName))
+
+            def makeValue(row, columnType, indices):
+                if columnType == 'BLOB':
+                    # a double and a byte that is 0 for a missing value
+                    return b''.join(struct.pack('<dB', float(row[index]) if row[index] else 0.0, row[index] != '')
+                                    for index in indices)
+                value = row[indices[0]]
+                return None if value == '' and columnType != 'TEXT' else value
+
+            with open(table['DataFile'], 'r', newline='') as f:
+                reader = csv.reader(f, delimiter='\t')
+                next(reader)
+                connection.executemany(
+                    'INSERT INTO {} VALUES ({})'.format(tableName, ', '.join('?' * len(layout))),
+                    ([makeValue(row, columnType, indices) for columnName, displayName, columnType, indices in layout]
+                     for row in reader))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tempFileName, fileName)
+    return fileName
+
+def benchmarkDecoding(nodeArgsFileName, repeat):
+    """ Returns the fastest times of decoding node_args.json by structure and by the object_hook decoder """
+    timings = {}
+    decoders = [
+        ('structural', lambda f: scriptutils.NodeArgs.fromFile(f)),
+        ('objectHook', lambda f: scriptutils.NodeArgs.fromDict(json.load(f, cls=scriptutils.NodeArgsDecoder))),
+    ]
+    for name, decode in decoders:
+        best = None
+        for i in range(max(repeat, 5)):
+            with open(nodeArgsFileName, 'rt') as f:
+                startTime = time.perf_counter()
+                decode(f)
+                seconds = time.perf_counter() - startTime
+            best = seconds if best is None else min(best, seconds)
+        timings[name] = best
+    return timings
+
+def benchmarkReload(dataDir, repeat):
+    """ Returns the fastest times of loading the results table of a run from Phosphomatics.txt and .npz
+
+    The text file is read like a downstream script would, with the abundances
+    converted to floats; the .npz file with numpy.load, or scriptutils.readNpz
+    without numpy.
+    """
+    try:
+        import numpy
+        loadNpz = lambda fileName: dict(numpy.load(fileName))
+        npzReader = 'numpy'
+    except ImportError:
+        loadNpz = scriptutils.readNpz
+        npzReader = 'readNpz'
+
+    def loadText(fileName):
+        with open(fileName, newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            header = next(reader)
+            return [row[:4] + scriptutils.parseAbundanceList(row[4:]) for row in reader]
+
+    timings = {'npzReader': npzReader}
+    loaders = [
+        ('text', loadText, os.path.join(dataDir, 'Phosphomatics.txt')),
+        ('npz', loadNpz, os.path.join(dataDir, 'Phosphomatics.npz')),
+    ]
+    for name, load, fileName in loaders:
+        best = None
+        for i in range(max(repeat, 3)):
+            startTime = time.perf_counter()
+            load(fileName)
+            seconds = time.perf_counter() - startTime
+            best = seconds if best is None else min(best, seconds)
+        timings[name] = best
+        timings[name + 'Bytes'] = os.path.getsize(fileName)
+    return timings
+
+def runOnce(nodeArgsFileName, argv, connection):
+    """ Runs UC2.perform in this (child) process and sends the measurements through connection """
+    import prepare_phosphomatics_ct
+
+    try:
+        nodeArgsFileName, options = prepare_phosphomatics_ct.UC2.parseArguments([nodeArgsFileName] + argv)
+        startTime = time.perf_counter()
+        rowsOut = prepare_phosphomatics_ct.UC2.perform(nodeArgsFileName, options)
+        wallTime = time.perf_counter() - startTime
+        connection.send({'wallTime': wallTime, 'rowsOut': rowsOut, 'peakRSS': scriptutils.getPeakRSS()})
+    except Exception as exception:
+        connection.send({'error': '{}: {}'.format(exception.__class__.__name__, exception)})
+    finally:
+        connection.close()
+
+def runBenchmark(nodeArgsFileName, argv):
+    parentConnection, childConnection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=runOnce, args=(nodeArgsFileName, argv, childConnection))
+    process.start()
+    childConnection.close()
+    try:
+        result = parentConnection.recv()
+    except EOFError:
+        result = {'error': 'benchmark process exited with code {}'.format(process.exitcode)}
+    process.join()
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the Phosphomatics node on synthetic data')
+    parser.add_argument('--scales', default='10000,100000,1000000',
+        help='comma-separated numbers of map table rows, default %(default)s')
+    parser.add_argument('--channels', default='16',
+        help='comma-separated numbers of abundance columns, default %(default)s')
+    parser.add_argument('--extra-columns', dest='extraColumns', type=int, default=10,
+        help='number of other numeric columns of the Peptide Groups table, default %(default)s')
+    parser.add_argument('--join-modes', dest='joinModes', default='hash',
+        help='comma-separated join modes to run, default %(default)s')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='runs per configuration, the fastest one is reported, default %(default)s')
+    parser.add_argument('--data-dir', dest='dataDir', default='benchmark_data',
+        help='folder for the generated datasets, default %(default)s')
+    parser.add_argument('--output', default=None,
+        help='JSON file to store the results in')
+    parser.add_argument('--decoding', action='store_true',
+        help='only time decoding the node_args.json of the datasets, e.g. with --channels 2000')
+    parser.add_argument('--reload', action='store_true',
+        help='only time reloading the results table from Phosphomatics.txt and from the .npz file')
+    parser.add_argument('--pdresult', action='store_true',
+        help='write the tables of the datasets to .pdResult files (see writePdResult) and run the node on those')
+    parser.add_argument('--uc2-args', dest='uc2Args', default='',
+        help='further arguments for the node, e.g. "--abundance-type float32"')
+    args = parser.parse_args(argv)
+
+    if args.decoding:
+        return runDecodingBenchmarks(args)
+    if args.reload:
+        return runReloadBenchmarks(args)
+
+    results = []
+    print('{:>10} {:>8} {:>10} {:>10} {:>12} {:>12} {:>10}'.format(
+        'mappings', 'channels', 'join mode', 'wall (s)', 'rows/s', 'rows out', 'RSS (MB)'))
+    for channels in [int(x) for x in args.channels.split(',')]:
+        for mappings in [int(x) for x in args.scales.split(',')]:
+            dataDir = os.path.join(args.dataDir, 'm%d_c%d_x%d' % (mappings, channels, args.extraColumns))
+            nodeArgsFileName = generateDataset(dataDir, mappings, channels, args.extraColumns)
+            uc2Args = args.uc2Args.split()
+            if args.pdresult:
+                writePdResult(nodeArgsFileName)
+                uc2Args += ['--input-source', 'pdresult']
+
+            for joinMode in args.joinModes.split(','):
+                best = None
+                for i in range(args.repeat):
+                    result = runBenchmark(nodeArgsFileName, ['--join-mode', joinMode] + uc2Args)
+                    if 'error' in result:
+                        best = result
+                        break
+                    if best is None or result['wallTime'] < best['wallTime']:
+                        best = result
+
+                best.update({'mappings': mappings, 'channels': channels, 'joinMode': joinMode})
+                results.append(best)
+                if 'error' in best:
+                    print('{:>10} {:>8} {:>10} failed: {}'.format(mappings, channels, joinMode, best['error']))
+                    continue
+                best['rowsPerSecond'] = mappings / best['wallTime'] if best['wallTime'] > 0 else None
+                peakRSS = '' if best['peakRSS'] is None else '%.1f' % (best['peakRSS'] / 1048576.0)
+                print('{:>10} {:>8} {:>10} {:>10.3f} {:>12.0f} {:>12} {:>10}'.format(
+                    mappings, channels, joinMode, best['wallTime'], best['rowsPerSecond'] or 0, best['rowsOut'], peakRSS))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0 if all('error' not in result for result in results) else 1
+
+def runDecodingBenchmarks(args):
+    results = []
+    print('{:>8} {:>10} {:>16} {:>16}'.format('channels', 'columns', 'structural (ms)', 'object_hook (ms)'))
+    mappings = int(args.scales.split(',')[0])
+    for channels in [int(x) for x in args.channels.split(',')]:
+        dataDir = os.path.join(args.dataDir, 'm%d_c%d_x%d' % (mappings, channels, args.extraColumns))
+        nodeArgsFileName = generateDataset(dataDir, mappings, channels, args.extraColumns)
+        with open(nodeArgsFileName, 'rt') as f:
+            columns = sum(len(table['ColumnDescriptions']) for table in json.load(f)['Tables'])
+
+        timings = benchmarkDecoding(nodeArgsFileName, args.repeat)
+        timings.update({'channels': channels, 'columns': columns})
+        results.append(timings)
+        print('{:>8} {:>10} {:>16.2f} {:>16.2f}'.format(
+            channels, columns, timings['structural'] * 1000, timings['objectHook'] * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+def runReloadBenchmarks(args):
+    results = []
+    print('{:>10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'mappings', 'channels', 'text (s)', 'npz (s)', 'text (MB)', 'npz (MB)', 'speedup'))
+    for channels in [int(x) for x in args.channels.split(',')]:
+        for mappings in [int(x) for x in args.scales.split(',')]:
+            dataDir = os.path.join(args.dataDir, 'm%d_c%d_x%d' % (mappings, channels, args.extraColumns))
+            nodeArgsFileName = generateDataset(dataDir, mappings, channels, args.extraColumns)
+            result = runBenchmark(nodeArgsFileName, ['--columnar-output', 'npz'] + args.uc2Args.split())
+            if 'error' in result:
+                print('{:>10} {:>8} failed: {}'.format(mappings, channels, result['error']))
+                results.append(dict(result, mappings=mappings, channels=channels))
+                continue
+
+            timings = benchmarkReload(dataDir, args.repeat)
+            timings.update({'mappings': mappings, 'channels': channels, 'rowsOut': result['rowsOut']})
+            results.append(timings)
+            print('{:>10} {:>8} {:>10.3f} {:>10.4f} {:>10.1f} {:>10.1f} {:>7.0f}x'.format(
+                mappings, channels, timings['text'], timings['npz'], timings['textBytes'] / 1048576.0,
+                timings['npzBytes'] / 1048576.0, timings['text'] / timings['npz'] if timings['npz'] > 0 else 0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0 if all('error' not in result for result in results) else 1
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
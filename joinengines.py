@@ -0,0 +1,1480 @@
+import os
+import time
+import array
+import zlib
+import heapq
+import scriptutils
+
+# csv, pickle, shutil and tempfile are imported by the engines that use
+# them, so a run of the default engine does not pay for importing them at startup
+
+"""
+Join engines
+------------
+
+A join engine combines the TargetPeptideGroup-ModificationSite connection
+table with the Peptide Groups and Modification Sites tables listed in
+node_args.json.
+
+JoinEngine
+    children
+        HashJoinEngine
+            children
+                MappedJoinEngine
+        SortMergeJoinEngine
+        SqliteJoinEngine
+
+RowFilter
+    drops the rows of an input table that fail its RowPredicates while the table is read
+    children
+        ModificationFilter
+            drops the Modification Sites rows of other modifications
+
+RowPredicate
+    children
+        MembershipPredicate
+        MinimumPredicate
+        ValidValuesPredicate
+
+ExternalSorter
+    sorts row streams that do not fit into memory, used by SortMergeJoinEngine
+
+SiteAggregator
+    collapses the records of the same modification site into one
+
+JoinPlanner
+    chooses between the hash and sqlite join modes from the input sizes and the available memory
+
+The engines are registered by join mode name in joinEngines; the join mode
+'auto' leaves the choice to JoinPlanner.
+
+Every engine yields one record per connection table row whose modification
+is kept, in connection table order:
+
+    (peptideGroupID, accession, residue, position, abundances, modificationName)
+
+where abundances is an array (see scriptutils.parseAbundances) with the
+values of the indexDict['quantColIndicies'] columns of the matching peptide
+group, of the type selected by options['abundanceType'], and modificationName
+is the one of options['modifications'] the site has. Numbering and writing the
+records, into one table per modification, is left to UC2.doTables.
+
+The engines read the tables from their files, or from a tableSource such as
+pdresult.PdResultSource, asking it only for the columns they use.
+"""
+
+class JoinEngine(object):
+    """ A base class for the engines joining the map table with the peptide and modification tables
+
+    Attributes
+    ----------
+    nodeArgs : NodeArgs
+        parsed node_args.json
+    indexDict : dict
+        table and column indices collected by UC2.perform; the engine adds the
+        column indices it finds in the map and modification table headers
+    options : dict
+        run options, see UC2.defaultOptions
+    modificationNames : list
+        values of the 'Modification Name' column of the modification sites to keep,
+        options['modifications']
+    modificationFilter : ModificationFilter
+        set up by join() once the Modification Sites header is known; it also applies
+        the minSiteProbability option
+    peptideFilter : RowFilter
+        applies the minConfidence and minValidValues options to the Peptide Groups
+        rows, or None when neither is set
+    cache : TableCache
+        cache for data parsed from the input tables, or None; not every engine uses it
+    profiler : StageProfiler
+        measures the parsing of the input tables, see scriptutils.StageProfiler;
+        a scriptutils.NullProfiler by default
+    tableSource : object
+        source the input tables are read from, see scriptutils.getTableReader,
+        or None for their files
+
+    Methods
+    -------
+    join() -> generator of records
+        joins the three input tables and yields the output records
+    joinAggregated(aggregator) -> generator of records
+        the records of join() collapsed by a SiteAggregator
+    """
+
+    def __init__(self, nodeArgs, indexDict, options=None, cache=None, profiler=None, tableSource=None):
+        self.nodeArgs = nodeArgs
+        self.indexDict = indexDict
+        self.options = options if options is not None else {}
+        self.cache = cache
+        self.profiler = profiler if profiler is not None else scriptutils.NullProfiler()
+        self.tableSource = tableSource
+        self.modificationNames = list(self.options.get('modifications') or ['Phospho'])
+        self.modificationFilter = None
+        self.abundanceTypecode = scriptutils.abundanceTypecodes[self.options.get('abundanceType', 'float64')]
+        self.peptideFilter = self.createPeptideFilter()
+
+    def getColumnNames(self, tableIndex):
+        return [c.ColumnName for c in self.nodeArgs.Tables[tableIndex].ColumnDescriptions]
+
+    def getTableReader(self, tableIndex, columnIndices=None, rowFilter=None):
+        return scriptutils.getTableReader(self.nodeArgs, tableIndex, self.tableSource, columnIndices, rowFilter)
+
+    def getPeptideColumnIndices(self):
+        """ Returns the indices of the Peptide Groups columns the records and the peptideFilter need """
+        indexDict = self.indexDict
+        columnIndices = [indexDict['peptideIDColumnIndex']] + list(indexDict['quantColIndicies'])
+        if self.peptideFilter is not None:
+            columnIndices += self.peptideFilter.getColumnIndices()
+        return columnIndices
+
+    def getModificationColumnIndices(self):
+        """ Returns the indices of the Modification Sites columns the records and the modificationFilter need """
+        indexDict = self.indexDict
+        return [indexDict[name] for name in
+                ('modIDColumnIndex', 'accessionIndex', 'residueIndex', 'positionIndex', 'modNameIndex')] + \
+            self.modificationFilter.getColumnIndices()
+
+    def getMapColumnIndices(self):
+        return [self.indexDict['pepGroupIDColInMapTable'], self.indexDict['modSiteIDColInMapTable']]
+
+    def setMapColumnIndices(self, mapHeader):
+        self.indexDict['pepGroupIDColInMapTable'] = mapHeader.index(
+            'Peptide Groups Peptide Group ID')
+        self.indexDict['modSiteIDColInMapTable'] = mapHeader.index(
+            'Modification Sites Modification Site ID')
+
+    def setModificationColumnIndices(self, modHeader):
+        self.indexDict['modNameIndex'] = modHeader.index('Modification Name')
+        self.indexDict['residueIndex'] = modHeader.index('Target Amino Acid')
+        self.indexDict['accessionIndex'] = modHeader.index('Protein Accession')
+        self.indexDict['positionIndex'] = modHeader.index('Position')
+        self.indexDict['modIDColumnIndex'] = modHeader.index('Modification Sites Modification Site ID')
+
+        predicates = []
+        minSiteProbability = self.options.get('minSiteProbability')
+        if minSiteProbability is not None:
+            assert 'Site Probability' in modHeader, \
+                "The minSiteProbability option needs the 'Site Probability' column of the Modification Sites table"
+            predicates.append(MinimumPredicate(
+                'Site Probability >= {:g}'.format(minSiteProbability), modHeader.index('Site Probability'),
+                minSiteProbability))
+        self.modificationFilter = ModificationFilter(
+            self.modificationNames, self.indexDict['modNameIndex'], self.indexDict['modIDColumnIndex'], predicates)
+
+    def createPeptideFilter(self):
+        """ Returns the RowFilter of the Peptide Groups rows selected by the options, or None """
+        indexDict = self.indexDict
+        predicates = []
+        minConfidence = self.options.get('minConfidence')
+        if minConfidence is not None:
+            assert minConfidence in confidenceLevels, "invalid confidence level {}".format(minConfidence)
+            pepHeader = self.getColumnNames(indexDict['peptideTableIndex'])
+            assert 'Confidence' in pepHeader, \
+                "The minConfidence option needs the 'Confidence' column of the Peptide Groups table"
+            predicates.append(MembershipPredicate(
+                'Confidence >= {}'.format(minConfidence), pepHeader.index('Confidence'),
+                confidenceLevels[confidenceLevels.index(minConfidence):]))
+        minValidValues = self.options.get('minValidValues')
+        if minValidValues is not None:
+            predicates.append(ValidValuesPredicate(
+                'abundances >= {}'.format(minValidValues), indexDict['quantColIndicies'], minValidValues))
+
+        if not predicates:
+            return None
+        return RowFilter('Peptide Groups', predicates, indexDict['peptideIDColumnIndex'])
+
+    def addJoinCost(self, seconds, rows):
+        """ Records the cost of joining the kept map rows in the filters, see RowFilter.getSavedSeconds """
+        self.modificationFilter.addJoinCost(seconds, rows)
+        if self.peptideFilter is not None:
+            self.peptideFilter.addJoinCost(seconds, rows)
+
+    def skipRejectedPeptide(self, peptideGroupID):
+        """ Counts a map row of a peptide group dropped by the peptideFilter, fails for a missing one """
+        assert self.peptideFilter is not None and self.peptideFilter.isRejected(peptideGroupID), \
+            "Peptide group {} not found in the Peptide Groups table".format(peptideGroupID)
+        self.peptideFilter.skipMapRow()
+
+    def getTempDir(self):
+        """ Creates a temporary folder below nodeArgs.WorkingDirectory, or the system one """
+        import tempfile
+
+        parentDir = getattr(self.nodeArgs, 'WorkingDirectory', None)
+        if parentDir is None or not os.path.isdir(parentDir):
+            parentDir = None
+        return tempfile.mkdtemp(prefix='phosphomatics_', dir=parentDir)
+
+    def join(self):
+        raise NotImplementedError("join() must be implemented by {}".format(self.__class__.__name__))
+
+    def joinAggregated(self, aggregator):
+        """ Returns the records of join() collapsed by a SiteAggregator, in memory unless an engine knows better """
+        return aggregator.aggregate(self.join())
+
+class HashJoinEngine(JoinEngine):
+    """ Joins the tables through in-memory indexes
+
+    The Peptide Groups and Modification Sites tables are read once each and
+    indexed by their ID columns, then the map rows are joined against them.
+    The cost is linear in the size of the three tables. Only the columns the
+    records need are kept: the ID and the abundance columns of the peptide
+    groups in a scriptutils.ColumnarTable, the ID columns of the map rows in
+    arrays. With a scriptutils.TableCache, all three are reused from earlier
+    runs on the same files. With options['parseWorkers'], the Peptide Groups
+    file is parsed in worker processes by a scriptutils.ParallelTableParser.
+
+    When an ID occurs more than once, the first row with that ID is used,
+    just like the original sequential lookup did.
+    """
+
+    @classmethod
+    def buildIndex(cls, reader, keyIndex):
+        index = {}
+        for row in reader:
+            key = row[keyIndex]
+            if key not in index:
+                index[key] = row
+        return index
+
+    def loadPeptides(self):
+        indexDict = self.indexDict
+        return scriptutils.readColumnarTable(
+            self.nodeArgs, indexDict['peptideTableIndex'], indexDict['peptideIDColumnIndex'],
+            indexDict['quantColIndicies'], self.abundanceTypecode, cache=self.cache, rowFilter=self.peptideFilter,
+            tableSource=self.tableSource, workers=self.options.get('parseWorkers'))
+
+    def getAbundances(self, peptides, peptideGroupID):
+        """ Returns the abundances of a peptide group of the loaded peptides, or None if it is missing
+        or dropped by the peptideFilter """
+        rowNumber = peptides.getRowNumber(peptideGroupID)
+        if rowNumber is None: return None
+        return peptides.getValues(rowNumber)
+
+    def releasePeptides(self, peptides):
+        pass
+
+    def join(self):
+        with self.profiler.stage('parsePeptides') as stage:
+            peptides = self.loadPeptides()
+            stage.rowsOut = len(peptides)
+            if self.peptideFilter is not None:
+                stage.rowsIn = self.peptideFilter.rowsRead
+        try:
+            for record in self.joinWithPeptides(peptides):
+                yield record
+        finally:
+            self.releasePeptides(peptides)
+
+    def loadModifications(self):
+        """ Returns the kept modification sites as a dict of int ID -> (accession, residue, position, modification name) """
+        nodeArgs = self.nodeArgs
+        indexDict = self.indexDict
+        modificationFilter = self.modificationFilter
+
+        def build():
+            modFile, modReader, modHeader = self.getTableReader(
+                indexDict['modSiteTableIndex'], self.getModificationColumnIndices(), modificationFilter)
+            try:
+                modIDIndex = indexDict['modIDColumnIndex']
+                accessionIndex = indexDict['accessionIndex']
+                residueIndex = indexDict['residueIndex']
+                positionIndex = indexDict['positionIndex']
+                modNameIndex = indexDict['modNameIndex']
+                # one string object per modification name rather than one per site
+                names = dict((name, name) for name in modificationFilter.modificationNames)
+                modifications = {}
+                for modRow in modReader:
+                    modID = int(modRow[modIDIndex])
+                    if modID not in modifications:
+                        modifications[modID] = (modRow[accessionIndex], modRow[residueIndex], modRow[positionIndex],
+                                                names[modRow[modNameIndex]])
+            finally:
+                modFile.close()
+            return modifications, modificationFilter.getState()
+
+        if self.cache is None:
+            modifications, filterState = build()
+        else:
+            modifications, filterState = self.cache.getOrBuild(
+                nodeArgs, indexDict['modSiteTableIndex'],
+                ('ModificationSites', sorted(modificationFilter.modificationNames), modificationFilter.getKey()), build)
+            modificationFilter.setState(filterState)
+        return modifications
+
+    def loadMapRows(self):
+        """ Returns the peptide group and modification site IDs of the map rows as two arrays """
+        nodeArgs = self.nodeArgs
+        indexDict = self.indexDict
+
+        def build():
+            pepIDs = array.array('q')
+            modIDs = array.array('q')
+            mapFile, mapReader, mapHeader = self.getTableReader(
+                indexDict['mapTableIndex'], self.getMapColumnIndices())
+            try:
+                pepIDCol = indexDict['pepGroupIDColInMapTable']
+                modIDCol = indexDict['modSiteIDColInMapTable']
+                for mapRow in mapReader:
+                    pepIDs.append(int(mapRow[pepIDCol]))
+                    modIDs.append(int(mapRow[modIDCol]))
+            finally:
+                mapFile.close()
+            return pepIDs, modIDs
+
+        if self.cache is None:
+            return build()
+        return self.cache.getOrBuild(
+            nodeArgs, indexDict['mapTableIndex'],
+            ('MapRows', indexDict['pepGroupIDColInMapTable'], indexDict['modSiteIDColInMapTable']), build)
+
+    def joinWithPeptides(self, peptides):
+        indexDict = self.indexDict
+
+        # the column indices are taken from the column descriptions, which getTableReader
+        # checks against the file headers, so they are known even when the tables come from the cache
+        self.setModificationColumnIndices(self.getColumnNames(indexDict['modSiteTableIndex']))
+        self.setMapColumnIndices(self.getColumnNames(indexDict['mapTableIndex']))
+        modificationFilter = self.modificationFilter
+
+        with self.profiler.stage('parseModifications') as stage:
+            modifications = self.loadModifications()
+            stage.rowsIn = modificationFilter.rowsRead
+            stage.rowsOut = len(modifications)
+        with self.profiler.stage('parseMapRows') as stage:
+            pepIDs, modIDs = self.loadMapRows()
+            stage.rowsOut = len(pepIDs)
+
+        joinedRows = 0
+        startTime = time.perf_counter()
+        for pepID, modID in zip(pepIDs, modIDs):
+            modification = modifications.get(modID)
+            if modification is None:
+                assert modificationFilter.isRejected(modID), \
+                    "Modification site {} not found in the Modification Sites table".format(modID)
+                modificationFilter.skipMapRow()
+                continue
+
+            abundances = self.getAbundances(peptides, pepID)
+            if abundances is None:
+                self.skipRejectedPeptide(pepID)
+                continue
+            accession, residue, position, modificationName = modification
+            joinedRows += 1
+            yield (str(pepID), accession, residue, position, abundances, modificationName)
+        self.addJoinCost(time.perf_counter() - startTime, joinedRows)
+
+class MappedJoinEngine(HashJoinEngine):
+    """ Joins the tables like HashJoinEngine, but leaves the peptide groups in their file
+
+    The Peptide Groups table is accessed through a scriptutils.MappedTable:
+    only the byte offsets of its rows are held in memory and a row is decoded
+    when a map row refers to it. This suits wide tables that are too big to
+    load but small enough to be mapped into the address space.
+
+    The peptideFilter is applied to a peptide group when a map row first
+    refers to it, so its counts only cover the peptide groups of kept sites.
+
+    With a tableSource, its mapped table (see pdresult.PdResultTable) takes
+    the place of the file.
+    """
+
+    def loadPeptides(self):
+        self.acceptedPeptideIDs = set()
+        indexDict = self.indexDict
+        if self.tableSource is not None:
+            return self.tableSource.getMappedTable(
+                self.nodeArgs, indexDict['peptideTableIndex'], indexDict['peptideIDColumnIndex'],
+                self.getPeptideColumnIndices(), cache=self.cache)
+        return scriptutils.MappedTable(
+            self.nodeArgs, indexDict['peptideTableIndex'], indexDict['peptideIDColumnIndex'], cache=self.cache)
+
+    def getAbundances(self, peptides, peptideGroupID):
+        peptideFilter = self.peptideFilter
+        if peptideFilter is not None and peptideFilter.isRejected(peptideGroupID): return None
+        peptide = peptides.getRow(peptideGroupID)
+        if peptide is None: return None
+        if peptideFilter is not None and peptideGroupID not in self.acceptedPeptideIDs:
+            if not peptideFilter.accept(peptide):
+                peptideFilter.reject(peptideGroupID)
+                return None
+            self.acceptedPeptideIDs.add(peptideGroupID)
+        return scriptutils.parseAbundances(
+            [peptide[x] for x in self.indexDict['quantColIndicies']], self.abundanceTypecode)
+
+    def releasePeptides(self, peptides):
+        peptides.close()
+
+class RowFilter(object):
+    """ Drops the rows of an input table that fail any of a list of predicates while the table is read
+
+    The engines then skip the map rows pointing at dropped rows before
+    joining them, and never keep the dropped rows. The predicates are
+    evaluated in their order; the first one a row fails is counted.
+
+    Attributes
+    ----------
+    tableName : str
+        name of the filtered table, for the summary
+    predicates : list
+        RowPredicate instances
+    rejectedCounts : list
+        number of rows rejected by each predicate
+    rowsRead, rowsRejected : int
+        rows seen and dropped
+    mapRowsSkipped : int
+        map rows skipped because they point at a dropped row
+    joinSeconds, joinedRows : float, int
+        time the join loop of the engine took, timed as a whole and so including
+        the writing of the records, and the number of kept map rows it joined;
+        used to estimate the time saved on the skipped ones
+    """
+
+    def __init__(self, tableName, predicates, idIndex):
+        self.tableName = tableName
+        self.predicates = list(predicates)
+        self.idIndex = idIndex
+        self.rejectedIDs = set()
+        self.rejectedCounts = [0] * len(self.predicates)
+        self.rowsRead = 0
+        self.rowsRejected = 0
+        self.mapRowsSkipped = 0
+        self.joinSeconds = 0.0
+        self.joinedRows = 0
+
+    def getKey(self):
+        """ Describes the predicates, for cache keys """
+        return tuple(predicate.name for predicate in self.predicates)
+
+    def getColumnIndices(self):
+        """ Returns the indices of the columns the filter reads """
+        columnIndices = [self.idIndex]
+        for predicate in self.predicates:
+            columnIndices += predicate.getColumnIndices()
+        return columnIndices
+
+    def accept(self, row):
+        self.rowsRead += 1
+        for index, predicate in enumerate(self.predicates):
+            if not predicate(row):
+                self.rejectedCounts[index] += 1
+                self.rowsRejected += 1
+                return False
+        return True
+
+    def filterRows(self, rows):
+        """ Yields the rows to keep and remembers the IDs of the dropped ones """
+        rejectedIDs = self.rejectedIDs
+        idIndex = self.idIndex
+        for row in rows:
+            rowID = int(row[idIndex])
+            # a later row cannot replace a dropped one, the first row with an ID wins
+            if rowID in rejectedIDs: continue
+            if self.accept(row):
+                yield row
+            else:
+                rejectedIDs.add(rowID)
+
+    def reject(self, rowID):
+        """ Remembers the ID of a row dropped by accept() outside filterRows """
+        self.rejectedIDs.add(int(rowID))
+
+    def getSqlConditions(self, columnExpressions):
+        """ Returns the SQL conditions and parameters of the predicates, see RowPredicate.getSqlCondition,
+        or None if a predicate has none """
+        conditions = [predicate.getSqlCondition(columnExpressions) for predicate in self.predicates]
+        if any(condition is None for condition in conditions):
+            return None
+        return conditions
+
+    def addRejectedRows(self, rowsRead, rejectedRows):
+        """ Counts the rows of a table a source tested with getSqlConditions rather than accept()
+
+        rejectedRows yields the ID of every dropped row with the index of the
+        first predicate it failed.
+        """
+        self.rowsRead += rowsRead
+        for rowID, index in rejectedRows:
+            self.rejectedIDs.add(int(rowID))
+            self.rejectedCounts[index] += 1
+            self.rowsRejected += 1
+
+    def isRejected(self, rowID):
+        return int(rowID) in self.rejectedIDs
+
+    def getState(self):
+        return self.rejectedIDs, self.rowsRead, self.rowsRejected, self.rejectedCounts
+
+    def setState(self, state):
+        # copies, as a state loaded from a TableCache may be shared with later runs
+        rejectedIDs, self.rowsRead, self.rowsRejected, rejectedCounts = state
+        self.rejectedIDs = set(rejectedIDs)
+        self.rejectedCounts = list(rejectedCounts)
+
+    def addState(self, state):
+        """ Adds the counts of a filter of another part of the same table, e.g. from a worker process """
+        rejectedIDs, rowsRead, rowsRejected, rejectedCounts = state
+        self.rejectedIDs.update(rejectedIDs)
+        self.rowsRead += rowsRead
+        self.rowsRejected += rowsRejected
+        self.rejectedCounts = [a + b for a, b in zip(self.rejectedCounts, rejectedCounts)]
+
+    def skipMapRow(self):
+        self.mapRowsSkipped += 1
+
+    def addJoinCost(self, seconds, rows):
+        self.joinSeconds += seconds
+        self.joinedRows += rows
+
+    def getSavedSeconds(self):
+        """ Estimated time the skipped map rows would have taken at the cost per joined row """
+        if self.joinedRows == 0: return 0.0
+        return self.mapRowsSkipped * self.joinSeconds / self.joinedRows
+
+    def getRejectedSummary(self):
+        return ', '.join('{}: {}'.format(predicate.name, count)
+                         for predicate, count in zip(self.predicates, self.rejectedCounts))
+
+    def summary(self):
+        return "{} filter kept {} of {} rows (rejected by {}), skipped {} map rows (est. {:.2f} s saved)".format(
+            self.tableName, self.rowsRead - self.rowsRejected, self.rowsRead, self.getRejectedSummary(),
+            self.mapRowsSkipped, self.getSavedSeconds())
+
+class ModificationFilter(RowFilter):
+    """ A RowFilter of the Modification Sites table dropping the rows of unwanted modifications
+
+    Attributes
+    ----------
+    modificationNames : set
+        'Modification Name' values of the rows to keep; further predicates,
+        e.g. a minimum site probability, follow that on the name
+    """
+
+    def __init__(self, modificationNames, modNameIndex, modIDIndex, predicates=()):
+        self.modificationNames = set(modificationNames)
+        self.modNameIndex = modNameIndex
+        RowFilter.__init__(
+            self, 'Modification Sites',
+            [MembershipPredicate('modification', modNameIndex, self.modificationNames)] + list(predicates),
+            modIDIndex)
+
+    def summary(self):
+        rejectedBy = ''
+        if len(self.predicates) > 1:
+            rejectedBy = ' (rejected by {})'.format(self.getRejectedSummary())
+        return "modification filter {} kept {} of {} Modification Sites rows{}, " \
+            "skipped {} map rows (est. {:.2f} s saved)".format(
+                sorted(self.modificationNames), self.rowsRead - self.rowsRejected, self.rowsRead, rejectedBy,
+                self.mapRowsSkipped, self.getSavedSeconds())
+
+class RowPredicate(object):
+    """ A base class for the tests a RowFilter applies to the rows of a table
+
+    A predicate is called with a row, a list of strings, and returns whether
+    the row is kept. Predicates are plain objects rather than functions, so
+    that they can be sent to the worker processes of a scriptutils.ParallelTableParser.
+
+    Attributes
+    ----------
+    name : str
+        describes the test in summaries and cache keys, e.g. 'Site Probability >= 75'
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, row):
+        raise NotImplementedError("__call__() must be implemented by {}".format(self.__class__.__name__))
+
+    def getColumnIndices(self):
+        """ Returns the indices of the columns the test reads """
+        raise NotImplementedError("getColumnIndices() must be implemented by {}".format(self.__class__.__name__))
+
+    def getSqlCondition(self, columnExpressions):
+        """ Returns the test as an SQL condition and its parameters, or None if it has none
+
+        columnExpressions holds the SQL expression of the values of every
+        column as the rows would hold them. The SQL function parse_number,
+        which a source provides, converts a value like scriptutils.parseAbundance.
+        """
+        return None
+
+class MembershipPredicate(RowPredicate):
+    """ Keeps the rows whose value in a column is one of a set of values """
+
+    def __init__(self, name, columnIndex, values):
+        RowPredicate.__init__(self, name)
+        self.columnIndex = columnIndex
+        self.values = set(values)
+
+    def getColumnIndices(self):
+        return [self.columnIndex]
+
+    def __call__(self, row):
+        return row[self.columnIndex] in self.values
+
+    def getSqlCondition(self, columnExpressions):
+        values = sorted(self.values)
+        return '{} IN ({})'.format(columnExpressions[self.columnIndex], ', '.join('?' * len(values))), values
+
+class MinimumPredicate(RowPredicate):
+    """ Keeps the rows whose numeric value in a column is at least a minimum; empty values fail """
+
+    def __init__(self, name, columnIndex, minimum):
+        RowPredicate.__init__(self, name)
+        self.columnIndex = columnIndex
+        self.minimum = minimum
+
+    def getColumnIndices(self):
+        return [self.columnIndex]
+
+    def __call__(self, row):
+        # NaN >= minimum is False
+        return scriptutils.parseAbundance(row[self.columnIndex]) >= self.minimum
+
+    def getSqlCondition(self, columnExpressions):
+        # NaN becomes NULL in SQLite, NULL >= minimum is not true either; parse_number
+        # is only called for values that are not numbers already
+        return "CASE typeof({0}) WHEN 'real' THEN {0} WHEN 'integer' THEN {0} ELSE parse_number({0}) END >= ?".format(
+            columnExpressions[self.columnIndex]), [self.minimum]
+
+class ValidValuesPredicate(RowPredicate):
+    """ Keeps the rows with at least a minimum number of valid (non-missing) values in a set of numeric columns """
+
+    def __init__(self, name, columnIndices, minimum):
+        RowPredicate.__init__(self, name)
+        self.columnIndices = list(columnIndices)
+        self.minimum = minimum
+
+    def getColumnIndices(self):
+        return list(self.columnIndices)
+
+    def __call__(self, row):
+        # the kept rows are parsed again, and counted in abundanceErrors, with the other cells
+        values = scriptutils.parseAbundanceList([row[x] for x in self.columnIndices], count=False)
+        return len(values) - sum(1 for v in values if v != v) >= self.minimum
+
+# confidence levels of Proteome Discoverer, lowest first, see the minConfidence option
+confidenceLevels = ['Low', 'Medium', 'High']
+
+class ExternalSorter(object):
+    """ Sorts a stream of rows by a key with a bounded amount of memory
+
+    Rows are collected until their estimated size reaches the memory budget,
+    then they are sorted and spilled to a temporary run file. The sorted runs
+    are merged lazily when the rows are read back. Rows with equal keys keep
+    their input order.
+
+    The merge holds one batch of pickled rows and the buffer of every run it
+    reads, so the runs are written in batches of batchBytes and merged
+    mergeWidth at a time, both worked out from the budget: the batches of a
+    merge together take about the budget, as the rows collected for a run did. More runs
+    than mergeWidth are merged in several passes.
+
+    Attributes
+    ----------
+    tempDir : str
+        folder for the run files
+    memoryBudget : int
+        approximate number of bytes of rows held in memory, while collecting or merging
+    mergeWidth : int
+        number of runs merged at once
+    batchBytes : int
+        approximate number of bytes of the rows pickled together in a run file
+    """
+
+    # approximate per-object memory cost (bytes) of a list and of a string in it
+    rowOverhead = 72
+    fieldOverhead = 57
+    # ... and of an int or a float in it
+    numberFieldSize = 32
+    # ... and of the (key, sequence, row) tuple of a row being sorted
+    itemOverhead = 96
+
+    # maximum number of run files merged at once
+    maxMergeWidth = 64
+
+    # smallest batch (bytes) worth a pickle.load; below mergeWidth * minBatchBytes the merge width shrinks
+    minBatchBytes = 16 * 1024
+    # buffer of an open run file
+    runBufferBytes = 8192
+
+    def __init__(self, tempDir, memoryBudget):
+        self.tempDir = tempDir
+        self.memoryBudget = memoryBudget
+        self.mergeWidth = int(max(2, min(self.maxMergeWidth,
+                                         memoryBudget // (self.minBatchBytes + self.runBufferBytes))))
+        self.batchBytes = max(memoryBudget // self.mergeWidth - self.runBufferBytes, 1)
+        self.runFileNames = []
+        # estimated bytes of an average row, for the number of rows of a batch
+        self.rowBytes = None
+
+    @classmethod
+    def estimateSize(cls, row):
+        # the IDs are ints, and the rows of a table source may hold floats, see pdresult
+        size = cls.itemOverhead + cls.rowOverhead
+        for field in row:
+            size += cls.fieldOverhead + len(field) if field.__class__ is str else cls.numberFieldSize
+        return size
+
+    def writeRun(self, sortedItems):
+        import pickle
+        import tempfile
+
+        batchRows = max(1, int(self.batchBytes // self.rowBytes))
+        runFile = tempfile.NamedTemporaryFile(
+            prefix='run_', suffix='.pkl', dir=self.tempDir, delete=False)
+        try:
+            batch = []
+            for item in sortedItems:
+                batch.append(item)
+                if len(batch) == batchRows:
+                    pickle.dump(batch, runFile, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            if batch:
+                pickle.dump(batch, runFile, pickle.HIGHEST_PROTOCOL)
+        finally:
+            runFile.close()
+        return runFile.name
+
+    def spill(self, items, size):
+        items.sort()
+        # the rows of the first run stand for those of the later ones
+        if self.rowBytes is None:
+            self.rowBytes = float(size) / len(items)
+        self.runFileNames.append(self.writeRun(items))
+
+    @classmethod
+    def readRun(cls, runFileName):
+        import pickle
+
+        with open(runFileName, 'rb') as runFile:
+            while True:
+                try:
+                    batch = pickle.load(runFile)
+                except EOFError:
+                    break
+                for item in batch:
+                    yield item
+        os.remove(runFileName)
+
+    def sort(self, rows, key):
+        """ Returns an iterator over (key, row) pairs sorted by key
+
+        key is a function returning the sort key (an int or a string, or a tuple of them) of a row
+        """
+        items = []
+        size = 0
+        for sequence, row in enumerate(rows):
+            items.append((key(row), sequence, row))
+            size += self.estimateSize(row)
+            if size >= self.memoryBudget:
+                self.spill(items, size)
+                items = []
+                size = 0
+
+        if not self.runFileNames:
+            items.sort()
+            return ((k, row) for k, sequence, row in items)
+
+        if items:
+            self.spill(items, size)
+
+        # merge in several passes when there are too many runs to keep open at once
+        mergeWidth = self.mergeWidth
+        runFileNames = self.runFileNames
+        self.runFileNames = []
+        while len(runFileNames) > mergeWidth:
+            runFileNames = [
+                self.writeRun(heapq.merge(*[self.readRun(name) for name in runFileNames[start:start + mergeWidth]]))
+                for start in range(0, len(runFileNames), mergeWidth)
+            ]
+        runs = [self.readRun(runFileName) for runFileName in runFileNames]
+        return ((k, row) for k, sequence, row in heapq.merge(*runs))
+
+class SortMergeJoinEngine(JoinEngine):
+    """ Joins the tables with external sorts and merge joins
+
+    Meant for inputs that do not fit into memory. All three tables are
+    sorted on disk, so memory use is bounded by options['memoryBudget']
+    regardless of the input size:
+
+        1. map rows, tagged with their position, are sorted by modification site ID
+           and merged with the Modification Sites table sorted the same way
+        2. the surviving rows are sorted by peptide group ID and merged with
+           the Peptide Groups table sorted the same way
+        3. the records are sorted back by position in the map table
+
+    The IDs are converted to int once, when the rows are read, and sorted and
+    compared as such, like HashJoinEngine looks them up. The records and their
+    order are the same as those of HashJoinEngine.
+    Run files are kept in a temporary folder below nodeArgs.WorkingDirectory
+    (or the system temporary folder) that is removed afterwards.
+    """
+
+    defaultMemoryBudget = 256 * 1024 * 1024
+
+    # number of ExternalSorter instances holding rows in memory at the same time: two merging
+    # their runs into a merge join while a third collects the joined rows; each gets an equal
+    # share of the budget for collecting and for merging, after the share of the records being
+    # written (see UC2.getWriteBatchRows)
+    concurrentSorters = 3
+    writeBudgetShare = 0.25
+
+    @classmethod
+    def mergeJoin(cls, leftItems, rightItems):
+        """ Yields (leftRow, rightRow) for every left row, rightRow being the first right row with the same key or None
+
+        Both inputs are iterators of (key, row) pairs sorted by key.
+        """
+        rightKey, rightRow = None, None
+        rightItems = iter(rightItems)
+        exhausted = False
+        for leftKey, leftRow in leftItems:
+            while not exhausted and (rightKey is None or rightKey < leftKey):
+                try:
+                    nextKey, nextRow = next(rightItems)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # keep the first row of a run of equal keys
+                if nextKey != rightKey:
+                    rightKey, rightRow = nextKey, nextRow
+            yield leftRow, (rightRow if rightKey == leftKey else None)
+
+    def getSorterBudget(self):
+        memoryBudget = self.options.get('memoryBudget') or self.defaultMemoryBudget
+        return max(int(memoryBudget * (1 - self.writeBudgetShare)) // self.concurrentSorters, 1)
+
+    def joinAggregated(self, aggregator):
+        """ Collapses the records with SiteAggregator.aggregateSorted, which keeps to the memory budget
+
+        Its sorters get the budget of those of join(): the first collects the
+        records while join() merges its last sorter, the second the groups while
+        the first merges, so no more than concurrentSorters hold rows at a time.
+        """
+        import shutil
+
+        sorterBudget = self.getSorterBudget()
+        tempDir = self.getTempDir()
+        try:
+            newSorter = lambda: ExternalSorter(tempDir, sorterBudget)
+            for record in aggregator.aggregateSorted(self.join(), newSorter, self.abundanceTypecode):
+                yield record
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+    def join(self):
+        import shutil
+
+        indexDict = self.indexDict
+        sorterBudget = self.getSorterBudget()
+
+        tempDir = self.getTempDir()
+        try:
+            def newSorter():
+                return ExternalSorter(tempDir, sorterBudget)
+
+            with self.profiler.stage('parseMapRows'):
+                self.setMapColumnIndices(self.getColumnNames(indexDict['mapTableIndex']))
+                mapFile, mapReader, mapHeader = self.getTableReader(
+                    indexDict['mapTableIndex'], self.getMapColumnIndices())
+                try:
+                    pepIDCol = indexDict['pepGroupIDColInMapTable']
+                    modIDCol = indexDict['modSiteIDColInMapTable']
+                    # [position, peptide group ID, modification site ID]
+                    mapRows = (
+                        [position, int(mapRow[pepIDCol]), int(mapRow[modIDCol])]
+                        for position, mapRow in enumerate(mapReader)
+                    )
+                    sortedMapRows = newSorter().sort(mapRows, lambda row: row[2])
+                finally:
+                    mapFile.close()
+
+            with self.profiler.stage('parseModifications') as stage:
+                self.setModificationColumnIndices(self.getColumnNames(indexDict['modSiteTableIndex']))
+                modFile, modReader, modHeader = self.getTableReader(
+                    indexDict['modSiteTableIndex'], self.getModificationColumnIndices())
+                try:
+                    modIDIndex = indexDict['modIDColumnIndex']
+                    modificationFilter = self.modificationFilter
+                    # rows of other modifications are reduced to their ID right away,
+                    # the ID is kept to tell them from missing sites in the merge join
+                    modRows = (
+                        modRow if modificationFilter.accept(modRow) else [int(modRow[modIDIndex])]
+                        for modRow in modReader
+                    )
+                    sortedModRows = newSorter().sort(
+                        modRows, lambda row: row[0] if len(row) == 1 else int(row[modIDIndex]))
+                finally:
+                    modFile.close()
+                stage.rowsIn = modificationFilter.rowsRead
+                stage.rowsOut = modificationFilter.rowsRead - modificationFilter.rowsRejected
+
+            # 1. map rows joined with modification sites
+            def keptSiteRows():
+                for mapRow, modification in self.mergeJoin(sortedMapRows, sortedModRows):
+                    assert modification is not None, \
+                        "Modification site {} not found in the Modification Sites table".format(mapRow[2])
+                    if len(modification) == 1:
+                        modificationFilter.skipMapRow()
+                        continue
+                    # [position, peptide group ID, accession, residue, position in protein, modification name]
+                    yield [
+                        mapRow[0], mapRow[1],
+                        modification[indexDict['accessionIndex']],
+                        modification[indexDict['residueIndex']],
+                        modification[indexDict['positionIndex']],
+                        modification[indexDict['modNameIndex']]
+                    ]
+            sortedSiteRows = newSorter().sort(keptSiteRows(), lambda row: row[1])
+
+            # 2. ... joined with peptide groups
+            startTime = time.perf_counter()
+            joinedRowCount = [0]
+            pepFile, pepReader, pepHeader = self.getTableReader(
+                indexDict['peptideTableIndex'], self.getPeptideColumnIndices(), self.peptideFilter)
+            try:
+                pepIDIndex = indexDict['peptideIDColumnIndex']
+                quantColIndicies = indexDict['quantColIndicies']
+                peptides = (
+                    [int(peptide[pepIDIndex])] + [peptide[x] for x in quantColIndicies]
+                    for peptide in pepReader
+                )
+                sortedPeptides = newSorter().sort(peptides, lambda row: row[0])
+
+                def joinedRows():
+                    for siteRow, peptide in self.mergeJoin(sortedSiteRows, sortedPeptides):
+                        if peptide is None:
+                            self.skipRejectedPeptide(siteRow[1])
+                            continue
+                        joinedRowCount[0] += 1
+                        yield siteRow + peptide[1:]
+                sortedRecords = newSorter().sort(joinedRows(), lambda row: row[0])
+            finally:
+                pepFile.close()
+            self.addJoinCost(time.perf_counter() - startTime, joinedRowCount[0])
+
+            # 3. ... back in map table order
+            typecode = self.abundanceTypecode
+            for position, row in sortedRecords:
+                yield (str(row[1]), row[2], row[3], row[4], scriptutils.parseAbundances(row[6:], typecode), row[5])
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+class SqliteJoinEngine(JoinEngine):
+    """ Joins the tables in a temporary SQLite database on disk
+
+    Meant, like SortMergeJoinEngine, for inputs that do not fit into memory,
+    trading speed for a memory ceiling. The kept rows of the three tables are
+    bulk-loaded into a staging database in batched inserts within one
+    transaction, then the records come out of one SQL join, streamed in map
+    table order:
+
+        peptides (id INTEGER PRIMARY KEY, abundances BLOB)
+        sites (id INTEGER PRIMARY KEY, accession, residue, position, name)
+        map (peptideGroupID, siteID), its rowid being the position in the map table
+
+    The ID columns of the peptide groups and the modification sites are the
+    integer primary keys, the index SQLite looks their rows up with, so that
+    when an ID occurs more than once the first row is kept. The abundances of
+    a peptide group are stored as one blob of the abundanceType. SQLite's
+    page cache is limited to options['memoryBudget'], shared with the sorts of
+    the query if it has any; besides them, only the IDs of the rows dropped by
+    the filters are held in memory.
+
+    The records and their order are the same as those of HashJoinEngine. With
+    a SiteAggregator, joinAggregated collapses them in a GROUP BY query, so
+    the groups are not held in memory either. The database is kept in a
+    temporary folder below nodeArgs.WorkingDirectory (or the system temporary
+    folder) that is removed afterwards.
+    """
+
+    defaultMemoryBudget = SortMergeJoinEngine.defaultMemoryBudget
+
+    # rows passed to SQLite in one executemany call
+    insertBatchRows = 10000
+
+    joinStatement = (
+        'SELECT map.peptideGroupID, map.siteID, sites.accession, sites.residue, sites.position, sites.name, '
+        'peptides.abundances FROM map '
+        'LEFT JOIN sites ON sites.id = map.siteID '
+        # the peptide group of a dropped site is not looked up
+        'LEFT JOIN peptides ON sites.id IS NOT NULL AND peptides.id = map.peptideGroupID '
+        'ORDER BY map.rowid')
+
+    # the map rows joinAggregated skips, and its groups in the position of their first map row
+    skippedStatement = (
+        'SELECT map.peptideGroupID, map.siteID, sites.id IS NULL FROM map '
+        'LEFT JOIN sites ON sites.id = map.siteID '
+        'LEFT JOIN peptides ON sites.id IS NOT NULL AND peptides.id = map.peptideGroupID '
+        'WHERE sites.id IS NULL OR peptides.id IS NULL')
+    aggregateStatement = (
+        'SELECT MIN(map.rowid) AS first, site_group(map.rowid, map.peptideGroupID, sites.accession, sites.residue, '
+        'sites.position, sites.name, peptides.abundances) FROM map '
+        'JOIN sites ON sites.id = map.siteID '
+        'JOIN peptides ON peptides.id = map.peptideGroupID '
+        'GROUP BY sites.accession, sites.residue, sites.position, sites.name '
+        'ORDER BY first')
+
+    def getMemoryBudget(self):
+        return self.options.get('memoryBudget') or self.defaultMemoryBudget
+
+    def createDatabase(self, tempDir, cacheBytes):
+        import sqlite3
+
+        connection = sqlite3.connect(os.path.join(tempDir, 'staging.db'), isolation_level=None)
+        # the database is thrown away after the run, so it needs neither a journal nor syncing
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('PRAGMA temp_store = FILE')
+        connection.execute('PRAGMA cache_size = -{}'.format(max(cacheBytes // 1024, 1)))
+        connection.execute('CREATE TABLE peptides (id INTEGER PRIMARY KEY, abundances BLOB)')
+        connection.execute(
+            'CREATE TABLE sites (id INTEGER PRIMARY KEY, accession TEXT, residue TEXT, position TEXT, name TEXT)')
+        connection.execute('CREATE TABLE map (peptideGroupID INTEGER, siteID INTEGER)')
+        return connection
+
+    def insertRows(self, connection, statement, rows):
+        """ Inserts rows in batches, returns the number of rows inserted """
+        changes = connection.total_changes
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.insertBatchRows:
+                connection.executemany(statement, batch)
+                batch = []
+        if batch:
+            connection.executemany(statement, batch)
+        return connection.total_changes - changes
+
+    def loadPeptides(self, connection):
+        indexDict = self.indexDict
+        pepFile, pepReader, pepHeader = self.getTableReader(
+            indexDict['peptideTableIndex'], self.getPeptideColumnIndices(), self.peptideFilter)
+        try:
+            pepIDIndex = indexDict['peptideIDColumnIndex']
+            quantColIndicies = indexDict['quantColIndicies']
+            typecode = self.abundanceTypecode
+            rows = (
+                (int(peptide[pepIDIndex]),
+                 scriptutils.parseAbundances([peptide[x] for x in quantColIndicies], typecode).tobytes())
+                for peptide in pepReader
+            )
+            return self.insertRows(connection, 'INSERT OR IGNORE INTO peptides VALUES (?, ?)', rows)
+        finally:
+            pepFile.close()
+
+    def loadModifications(self, connection):
+        indexDict = self.indexDict
+        self.setModificationColumnIndices(self.getColumnNames(indexDict['modSiteTableIndex']))
+        modFile, modReader, modHeader = self.getTableReader(
+            indexDict['modSiteTableIndex'], self.getModificationColumnIndices(), self.modificationFilter)
+        try:
+            modIDIndex = indexDict['modIDColumnIndex']
+            accessionIndex = indexDict['accessionIndex']
+            residueIndex = indexDict['residueIndex']
+            positionIndex = indexDict['positionIndex']
+            modNameIndex = indexDict['modNameIndex']
+            rows = (
+                (int(modRow[modIDIndex]), modRow[accessionIndex], modRow[residueIndex], modRow[positionIndex],
+                 modRow[modNameIndex])
+                for modRow in modReader
+            )
+            return self.insertRows(connection, 'INSERT OR IGNORE INTO sites VALUES (?, ?, ?, ?, ?)', rows)
+        finally:
+            modFile.close()
+
+    def loadMapRows(self, connection):
+        indexDict = self.indexDict
+        self.setMapColumnIndices(self.getColumnNames(indexDict['mapTableIndex']))
+        mapFile, mapReader, mapHeader = self.getTableReader(
+            indexDict['mapTableIndex'], self.getMapColumnIndices())
+        try:
+            pepIDCol = indexDict['pepGroupIDColInMapTable']
+            modIDCol = indexDict['modSiteIDColInMapTable']
+            rows = ((int(mapRow[pepIDCol]), int(mapRow[modIDCol])) for mapRow in mapReader)
+            return self.insertRows(connection, 'INSERT INTO map VALUES (?, ?)', rows)
+        finally:
+            mapFile.close()
+
+    def join(self):
+        return self.runStaged(self.joinStaged)
+
+    def joinAggregated(self, aggregator):
+        # the sorters of the GROUP BY and the ORDER BY each take up to the cache size besides the page cache
+        return self.runStaged(lambda connection: self.aggregateStaged(connection, aggregator), sorters=2)
+
+    def runStaged(self, joinStaged, sorters=0):
+        """ Stages the input tables in a new database and yields the records of joinStaged(connection)
+
+        The budget is shared by the page cache and the sorters of the query of joinStaged.
+        """
+        import shutil
+
+        tempDir = self.getTempDir()
+        try:
+            connection = self.createDatabase(tempDir, self.getMemoryBudget() // (1 + sorters))
+            try:
+                connection.execute('BEGIN')
+                with self.profiler.stage('parsePeptides') as stage:
+                    stage.rowsOut = self.loadPeptides(connection)
+                    if self.peptideFilter is not None:
+                        stage.rowsIn = self.peptideFilter.rowsRead
+                with self.profiler.stage('parseModifications') as stage:
+                    stage.rowsOut = self.loadModifications(connection)
+                    stage.rowsIn = self.modificationFilter.rowsRead
+                with self.profiler.stage('parseMapRows') as stage:
+                    stage.rowsOut = self.loadMapRows(connection)
+                connection.execute('COMMIT')
+
+                for record in joinStaged(connection):
+                    yield record
+            finally:
+                connection.close()
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+    def joinStaged(self, connection):
+        modificationFilter = self.modificationFilter
+        typecode = self.abundanceTypecode
+        # one string object per modification name rather than one per record
+        names = dict((name, name) for name in modificationFilter.modificationNames)
+
+        joinedRows = 0
+        startTime = time.perf_counter()
+        for pepID, modID, accession, residue, position, name, blob in connection.execute(self.joinStatement):
+            if name is None:
+                assert modificationFilter.isRejected(modID), \
+                    "Modification site {} not found in the Modification Sites table".format(modID)
+                modificationFilter.skipMapRow()
+                continue
+            if blob is None:
+                self.skipRejectedPeptide(pepID)
+                continue
+
+            abundances = array.array(typecode)
+            abundances.frombytes(blob)
+            joinedRows += 1
+            yield (str(pepID), accession, residue, position, abundances, names[name])
+        self.addJoinCost(time.perf_counter() - startTime, joinedRows)
+
+    def aggregateStaged(self, connection, aggregator):
+        """ Yields the records collapsed by a SiteAggregator in the GROUP BY of aggregateStatement
+
+        SQLite sorts the joined rows by site on disk, then the site_group
+        aggregate collapses the rows of one site at a time with the steps of
+        the aggregator, in map table order, and returns the pickled group.
+        """
+        import pickle
+
+        modificationFilter = self.modificationFilter
+        for pepID, modID, siteMissing in connection.execute(self.skippedStatement):
+            if siteMissing:
+                assert modificationFilter.isRejected(modID), \
+                    "Modification site {} not found in the Modification Sites table".format(modID)
+                modificationFilter.skipMapRow()
+            else:
+                self.skipRejectedPeptide(pepID)
+
+        typecode = self.abundanceTypecode
+
+        class SiteGroup(object):
+            def __init__(self):
+                self.rows = []
+
+            def step(self, *row):
+                self.rows.append(row)
+
+            def finalize(self):
+                group = None
+                for rowID, pepID, accession, residue, position, name, blob in sorted(self.rows):
+                    abundances = array.array(typecode)
+                    abundances.frombytes(blob)
+                    record = (str(pepID), accession, residue, position, abundances, name)
+                    if group is None:
+                        group = aggregator.newGroup(record)
+                    else:
+                        aggregator.addRecord(group, record)
+                return pickle.dumps(aggregator.getRecord(group), pickle.HIGHEST_PROTOCOL)
+
+        connection.create_aggregate('site_group', 7, SiteGroup)
+        recordsIn = aggregator.recordsIn
+        startTime = time.perf_counter()
+        for first, group in connection.execute(self.aggregateStatement):
+            yield pickle.loads(group)
+        self.addJoinCost(time.perf_counter() - startTime, aggregator.recordsIn - recordsIn)
+
+class JoinPlanner(object):
+    """ Chooses the join mode of a run from the sizes of its input tables and the resources of the machine
+
+    The row counts of the input tables are estimated from the sizes of their
+    files and the average length of their first rows (or taken from the
+    tableSource), and from them and the number of abundance columns the
+    memory HashJoinEngine would take. The planner then chooses
+
+        hash        when that fits into memoryFraction of the available memory
+                    (see scriptutils.getAvailableMemory)
+        sqlite      out of core (SqliteJoinEngine) when hash does not fit
+
+    An unknown amount of available memory counts as enough.
+
+    Attributes
+    ----------
+    estimates : dict
+        the figures the decision is based on, see summary()
+    joinMode : str
+        the chosen join mode, once plan() has run
+
+    Methods
+    -------
+    plan() -> join mode
+    summary() -> str
+        the decision and the estimates behind it, for the node log
+    """
+
+    # share of the available memory a join may take, the rest is left to Proteome Discoverer
+    memoryFraction = 0.5
+
+    # approximate memory (bytes) of the hash join: per peptide group besides its abundances,
+    # per modification site, per map row, and the interpreter, modules and write batches
+    peptideRowBytes = 130
+    siteRowBytes = 350
+    mapRowBytes = 16
+    baseBytes = 64 * 1024 * 1024
+
+    # bytes read from the start of a table file to estimate its average row length
+    sampleBytes = 65536
+
+    def __init__(self, nodeArgs, indexDict, options, tableSource=None):
+        self.nodeArgs = nodeArgs
+        self.indexDict = indexDict
+        self.options = options
+        self.tableSource = tableSource
+        self.estimates = {}
+        self.joinMode = None
+
+    @classmethod
+    def estimateFileRows(cls, fileName):
+        """ Returns the number of rows of a table file, without its header, estimated from its first rows """
+        with open(fileName, 'rb') as f:
+            sample = f.read(cls.sampleBytes)
+            size = os.fstat(f.fileno()).st_size
+        lines = sample.count(b'\n')
+        if len(sample) >= size:
+            # the whole file
+            return max(lines + (0 if sample.endswith(b'\n') or not sample else 1) - 1, 0)
+        headerEnd = sample.find(b'\n') + 1
+        sampleEnd = sample.rfind(b'\n') + 1
+        if lines < 2:
+            return 1
+        return int((size - headerEnd) * (lines - 1) / float(sampleEnd - headerEnd))
+
+    def estimateRows(self, tableIndex):
+        if self.tableSource is not None:
+            return self.tableSource.estimateRows(self.nodeArgs, tableIndex)
+        return self.estimateFileRows(self.nodeArgs.Tables[tableIndex].DataFile)
+
+    def plan(self):
+        indexDict = self.indexDict
+        estimates = self.estimates
+        estimates['peptideRows'] = self.estimateRows(indexDict['peptideTableIndex'])
+        estimates['siteRows'] = self.estimateRows(indexDict['modSiteTableIndex'])
+        estimates['mapRows'] = self.estimateRows(indexDict['mapTableIndex'])
+        if self.tableSource is None:
+            estimates['fileBytes'] = sum(os.path.getsize(self.nodeArgs.Tables[indexDict[name]].DataFile)
+                                         for name in ('peptideTableIndex', 'modSiteTableIndex', 'mapTableIndex'))
+
+        itemBytes = array.array(scriptutils.abundanceTypecodes[self.options.get('abundanceType', 'float64')]).itemsize
+        estimates['hashBytes'] = (
+            self.baseBytes
+            + estimates['peptideRows'] * (self.peptideRowBytes + len(indexDict['quantColIndicies']) * itemBytes)
+            + estimates['siteRows'] * self.siteRowBytes
+            + estimates['mapRows'] * self.mapRowBytes)
+        estimates['availableBytes'] = scriptutils.getAvailableMemory()
+
+        budget = None
+        if estimates['availableBytes'] is not None:
+            budget = estimates['availableBytes'] * self.memoryFraction
+        if budget is not None and estimates['hashBytes'] > budget:
+            self.joinMode = 'sqlite'
+        else:
+            self.joinMode = 'hash'
+        return self.joinMode
+
+    def summary(self):
+        estimates = self.estimates
+        megabytes = lambda value: 'unknown' if value is None else '{:.0f} MB'.format(value / 1048576.0)
+        text = "join planner chose {}: ~{} peptide groups, ~{} modification sites, ~{} map rows".format(
+            self.joinMode, estimates['peptideRows'], estimates['siteRows'], estimates['mapRows'])
+        if 'fileBytes' in estimates:
+            text += ' in {} of files'.format(megabytes(estimates['fileBytes']))
+        return text + "; hash join ~{}, {:.0%} of {} available memory".format(
+            megabytes(estimates['hashBytes']), self.memoryFraction, megabytes(estimates['availableBytes']))
+
+def sumReducer(current, abundances, state):
+    # NaN + x = x, so a site only stays NaN where none of its peptides has a value
+    for index, b in enumerate(abundances):
+        if b == b:
+            a = current[index]
+            current[index] = b if a != a else a + b
+    return current, state
+
+def maxReducer(current, abundances, state):
+    for index, b in enumerate(abundances):
+        a = current[index]
+        if a != a or b > a:
+            current[index] = b
+    return current, state
+
+def mostValidReducer(current, abundances, state):
+    # state is the number of valid values of current
+    validCount = len(abundances) - sum(1 for b in abundances if b != b)
+    if validCount > state:
+        return abundances, validCount
+    return current, state
+
+class SiteAggregator(object):
+    """ Collapses the records of the same modification site into one
+
+    Records are grouped by (accession, residue, position, modification name). The abundances of a
+    group are combined with one of the reducers, NaN meaning a missing value:
+
+        sum         per-channel sum of the valid values
+        max         per-channel maximum of the valid values
+        mostvalid   the abundances of the peptide group with the most valid
+                    values; on a tie the first one
+
+    A group is yielded in the position of its first record and carries the list
+    of its distinct peptide group IDs instead of a single ID, so the connection
+    table links each site to all of its peptide groups.
+
+    aggregate() holds all groups in memory until the records are exhausted.
+    aggregateSorted() sorts the records by site and the groups back by
+    position with ExternalSorters instead, for the join engines with a memory
+    ceiling (see JoinEngine.joinAggregated); both give the same groups.
+
+    Methods
+    -------
+    aggregate(records) -> generator of groups
+    aggregateSorted(records, newSorter, typecode) -> generator of groups
+    newGroup(record) -> group
+    addRecord(group, record)
+    getRecord(group) -> record
+        the steps of both, also used by SqliteJoinEngine
+    """
+
+    reducers = {
+        'sum': sumReducer,
+        'max': maxReducer,
+        'mostvalid': mostValidReducer,
+    }
+
+    # peptide group IDs of a group from which they are looked up in a set rather than the list
+    maxListedIDs = 8
+
+    def __init__(self, reducerName):
+        assert reducerName in self.reducers, "invalid reducer {}".format(reducerName)
+        self.reducerName = reducerName
+        self.reducer = self.reducers[reducerName]
+        self.recordsIn = 0
+
+    def newGroup(self, record):
+        """ Returns the group of a site's first record: [peptide group IDs, accession, residue, position,
+        abundances, modification name, reducer state, set of the IDs or None] """
+        self.recordsIn += 1
+        peptideGroupID, accession, residue, position, abundances, modificationName = record
+        if self.reducer is mostValidReducer:
+            state = len(abundances) - sum(1 for b in abundances if b != b)
+        else:
+            # sum and max update the abundances in place, so they get a copy of their own; those of
+            # a record may be shared with other records of the same peptide group
+            abundances = array.array(abundances.typecode, abundances)
+            state = None
+        return [[peptideGroupID], accession, residue, position, abundances, modificationName, state, None]
+
+    def addRecord(self, group, record):
+        """ Adds a further record of the same site to a group """
+        self.recordsIn += 1
+        peptideGroupID = record[0]
+        peptideGroupIDs = group[0]
+        idSet = group[7]
+        if idSet is None:
+            if peptideGroupID not in peptideGroupIDs:
+                peptideGroupIDs.append(peptideGroupID)
+                if len(peptideGroupIDs) > self.maxListedIDs:
+                    group[7] = set(peptideGroupIDs)
+        elif peptideGroupID not in idSet:
+            idSet.add(peptideGroupID)
+            peptideGroupIDs.append(peptideGroupID)
+        group[4], group[6] = self.reducer(group[4], record[4], group[6])
+
+    @classmethod
+    def getRecord(cls, group):
+        return tuple(group[:6])
+
+    def aggregate(self, records):
+        groups = {}
+        orderedGroups = []
+        for record in records:
+            key = record[1:4] + (record[5],)
+            group = groups.get(key)
+            if group is None:
+                group = self.newGroup(record)
+                groups[key] = group
+                orderedGroups.append(group)
+            else:
+                self.addRecord(group, record)
+
+        for group in orderedGroups:
+            yield self.getRecord(group)
+
+    def aggregateSorted(self, records, newSorter, typecode):
+        """ Aggregates the records with newSorter() returning the ExternalSorters to use
+
+        The records, whose abundances are arrays of typecode, are sorted by
+        site, which keeps those of a site in their order, and every group goes
+        into the second sorter as a row of strings and floats once it is complete.
+        """
+        # [accession, residue, position, modification name, position in the records, peptide group ID, abundances...]
+        recordRows = (
+            [record[1], record[2], record[3], record[5], '%012d' % position, record[0]] + list(record[4])
+            for position, record in enumerate(records)
+        )
+        sortedRows = newSorter().sort(recordRows, lambda row: (row[0], row[1], row[2], row[3]))
+
+        def groupRows():
+            group = None
+            groupKey = None
+            for key, row in sortedRows:
+                record = (row[5], row[0], row[1], row[2], array.array(typecode, row[6:]), row[3])
+                if key == groupKey:
+                    self.addRecord(group, record)
+                    continue
+                if group is not None:
+                    yield self.getGroupRow(groupPosition, group)
+                group = self.newGroup(record)
+                groupKey = key
+                groupPosition = row[4]
+            if group is not None:
+                yield self.getGroupRow(groupPosition, group)
+        sortedGroupRows = newSorter().sort(groupRows(), lambda row: row[0])
+
+        for position, row in sortedGroupRows:
+            yield (row[5].split(','), row[1], row[2], row[3], array.array(typecode, row[6:]), row[4])
+
+    @classmethod
+    def getGroupRow(cls, position, group):
+        # [position of the first record, accession, residue, position, modification name, peptide group IDs, abundances...]
+        return [position, group[1], group[2], group[3], group[5], ','.join(group[0])] + list(group[4])
+
+    def summary(self, recordsOut):
+        return "site aggregation ({}) collapsed {} records into {} sites".format(
+            self.reducerName, self.recordsIn, recordsOut)
+
+# join engines by the name used for the joinMode option
+joinEngines = {
+    'hash': HashJoinEngine,
+    'mapped': MappedJoinEngine,
+    'sortmerge': SortMergeJoinEngine,
+    'sqlite': SqliteJoinEngine,
+}
@@ -0,0 +1,412 @@
+import os
+import array
+import struct
+import sqlite3
+
+"""
+.pdResult table source
+----------------------
+
+Proteome Discoverer exports the input tables of a scripting node to text
+files (the DataFile of every table in node_args.json) before it starts the
+node. A .pdResult file is an SQLite database holding the same tables, so
+with the inputSource option 'pdresult' the node reads them from the result
+file instead, and the export files need not exist.
+
+PdResultSource
+    reads the tables of node_args.json from a .pdResult file
+    has PdResultTable
+
+PdResultTable
+    gives random access by ID to the rows of a table, like scriptutils.MappedTable
+
+A table of node_args.json is found through the DataTypes table of the file,
+whose DisplayName is the TableName of node_args.json, and its columns through
+the DataTypesColumns table, whose DisplayName is the ColumnName:
+
+    DataTypes (TableName, DisplayName)
+    DataTypesColumns (TableName, ColumnName, DisplayName)
+
+Tables and columns not listed there are looked up by their node_args.json
+names. Only the columns a reader is asked for are selected, the others are
+empty, and it returns the rows in the order of the table (its rowid) as lists
+like the csv readers of the text files: NULL becomes an empty string, the
+values of Float columns are floats, those of the other columns strings. The
+floats go to scriptutils.parseAbundanceList as they are; formatting them as
+text, only for that to parse them again, would take longer than reading them.
+The conversions are done by SQLite.
+
+A reader given a rowFilter (see joinengines.RowFilter) whose predicates all
+have an SQL condition, like the modification name and site probability tests,
+leaves the rows to SQLite: the query only returns the kept rows, and a second
+one the ID of every dropped row with the predicate it failed, for the counts
+and rejected IDs of the filter. Other filters are applied to the rows read.
+
+Proteome Discoverer stores the values of a column group, like the
+abundances of all files, together in one BLOB column of grouped values:
+groupedValueBytes per value, a little-endian double followed by a byte that
+is 0 when the value is missing. A column of node_args.json that is not a
+column of the table is read from the BLOB column of its DataGroupName (found
+by its DisplayName like the other columns), as the value at its position
+among the columns of that group in node_args.json; a missing value is empty
+like a NULL. Blobs not of that layout, and BLOB columns of other kinds, are
+not supported: a reader that needs one fails, as the exported DataFile is
+never read.
+
+The file is opened read-only, so Proteome Discoverer can keep it open.
+"""
+
+# bytes of a value in a BLOB column of grouped values, and the struct of one value
+groupedValueBytes = 9
+groupedValueStruct = struct.Struct('<dB')
+
+# structs of whole blobs by number of values
+groupedValuesStructs = {}
+
+def parseNumber(value):
+    """ The SQL function parse_number of joinengines.RowPredicate: a number, or NULL for what is not one """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def decodeGroupedValues(blob, columnName, count):
+    """ Returns the values of a blob of grouped values as cells: floats, or empty strings for missing values
+
+    The blob of the BLOB column columnName must hold at least count values;
+    a NULL stands for as many missing ones.
+    """
+    if blob is None:
+        return [''] * count
+    blobCount, rest = divmod(len(blob), groupedValueBytes)
+    assert not rest and blobCount >= count, \
+        "The blob of grouped values of column {} has {} bytes, not {} bytes for each of {} values".format(
+            columnName, len(blob), groupedValueBytes, count)
+    blobStruct = groupedValuesStructs.get(blobCount)
+    if blobStruct is None:
+        blobStruct = groupedValuesStructs[blobCount] = struct.Struct('<' + 'dB' * blobCount)
+    values = blobStruct.unpack(blob)
+    return [value if valid else '' for value, valid in zip(values[0::2], values[1::2])]
+
+def groupedValue(blob, position):
+    """ The SQL function grouped_value: the value at a position of a blob of grouped values, or NULL if missing """
+    if blob is None or len(blob) < (position + 1) * groupedValueBytes:
+        return None
+    value, valid = groupedValueStruct.unpack_from(blob, position * groupedValueBytes)
+    return value if valid else None
+
+class PdResultSource(object):
+    """ A class that reads the tables of node_args.json from a .pdResult file
+
+    It stands in for the table files in scriptutils.getTableReader,
+    readColumnarTable and TableCache, which take it as their tableSource.
+
+    Attributes
+    ----------
+    fileName : str
+        the .pdResult file
+    connection : sqlite3.Connection
+        read-only connection to it
+
+    Methods
+    -------
+    getTableReader(nodeArgs, tableIndex, columnIndices=None, rowFilter=None) -> (file, reader, column names)
+        like scriptutils.getTableReader; file is the cursor, to be closed
+    getMappedTable(nodeArgs, tableIndex, idColumnIndex, columnIndices=None, cache=None) -> PdResultTable
+    estimateRows(nodeArgs, tableIndex) -> int
+        number of rows of a table, for joinengines.JoinPlanner
+    getFingerprint(nodeArgs, tableIndex)
+        changes when the file changes, for TableCache keys
+    """
+
+    def __init__(self, fileName):
+        assert fileName, "No .pdResult file given, nor a ResultFilePath in node_args.json"
+        assert os.path.isfile(fileName), "The .pdResult file {} does not exist".format(fileName)
+        self.fileName = fileName
+        self.connection = sqlite3.connect(self.getUri(fileName), uri=True)
+        self.connection.create_function('parse_number', 1, parseNumber, deterministic=True)
+        self.connection.create_function('grouped_value', 2, groupedValue, deterministic=True)
+        self.tables = {}
+        self.groupedColumns = {}
+        self.blobColumns = {}
+        try:
+            self.tableNames, self.columnNames = self.readNames()
+        except:
+            self.close()
+            raise
+
+    @classmethod
+    def getUri(cls, fileName):
+        from urllib.request import pathname2url
+
+        return 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(fileName)))
+
+    @classmethod
+    def quote(cls, name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def hasTable(self, tableName):
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (tableName,)).fetchone() is not None
+
+    def readNames(self):
+        """ Returns the maps of display names to table names and of (table name, display name) to column names """
+        tableNames = {}
+        columnNames = {}
+        if self.hasTable('DataTypes'):
+            for tableName, displayName in self.connection.execute('SELECT TableName, DisplayName FROM DataTypes'):
+                tableNames.setdefault(displayName, tableName)
+        if self.hasTable('DataTypesColumns'):
+            for tableName, columnName, displayName in self.connection.execute(
+                    'SELECT TableName, ColumnName, DisplayName FROM DataTypesColumns'):
+                columnNames.setdefault((tableName, displayName), columnName)
+        return tableNames, columnNames
+
+    def getTable(self, nodeArgs, tableIndex):
+        """ Returns the name and the column names in the file of a table of node_args.json
+
+        The column name of a grouped value is that of its BLOB column, see
+        groupedColumns; BLOB columns of other kinds are listed in blobColumns.
+        """
+        table = nodeArgs.Tables[tableIndex]
+        if table.TableName in self.tables:
+            return self.tables[table.TableName]
+
+        tableName = self.tableNames.get(table.TableName, table.TableName)
+        assert self.hasTable(tableName), \
+            "Table {} not found in {}".format(table.TableName, self.fileName)
+        declaredTypes = dict(
+            (row[1], row[2].upper()) for row in self.connection.execute('PRAGMA table_info({})'.format(self.quote(tableName))))
+
+        columnNames = []
+        groupedColumns = {}
+        blobColumns = set()
+        groupSizes = {}
+        for index, column in enumerate(table.ColumnDescriptions):
+            columnName = self.columnNames.get((tableName, column.ColumnName), column.ColumnName)
+            group = getattr(column, 'DataGroupName', None)
+            if columnName not in declaredTypes and group is not None:
+                # a value of the BLOB column of its group
+                columnName = self.columnNames.get((tableName, group), group)
+                assert 'BLOB' in declaredTypes.get(columnName, ''), \
+                    "Column {} of table {} not found in {}, nor a BLOB column of its group {}".format(
+                        column.ColumnName, table.TableName, self.fileName, group)
+                groupedColumns[index] = (columnName, groupSizes.get(columnName, 0))
+                groupSizes[columnName] = groupSizes.get(columnName, 0) + 1
+            else:
+                assert columnName in declaredTypes, \
+                    "Column {} of table {} not found in {}".format(column.ColumnName, table.TableName, self.fileName)
+                if 'BLOB' in declaredTypes[columnName]:
+                    blobColumns.add(index)
+            columnNames.append(columnName)
+
+        self.tables[table.TableName] = (tableName, columnNames)
+        self.groupedColumns[table.TableName] = groupedColumns
+        self.blobColumns[table.TableName] = blobColumns
+        return self.tables[table.TableName]
+
+    def getColumnExpressions(self, nodeArgs, tableIndex):
+        """ Returns the SQL expressions of the values of the columns of a table as the readers return them """
+        tableName, columnNames = self.getTable(nodeArgs, tableIndex)
+        groupedColumns = self.groupedColumns[nodeArgs.Tables[tableIndex].TableName]
+        columns = nodeArgs.Tables[tableIndex].ColumnDescriptions
+        expressions = []
+        for index, (column, columnName) in enumerate(zip(columns, columnNames)):
+            if index in groupedColumns:
+                expressions.append("IFNULL(grouped_value({}, {}), '')".format(
+                    self.quote(columnName), groupedColumns[index][1]))
+            else:
+                expressions.append(("IFNULL({}, '')" if column.DataType == 'Float' else
+                                    "IFNULL(CAST({} AS TEXT), '')").format(self.quote(columnName)))
+        return expressions
+
+    def select(self, nodeArgs, tableIndex, columnIndices=None, where=''):
+        """ Returns the SELECT statement of the rows of a table and the function making a row of a result row
+
+        Every column of the table in node_args.json is selected, those not in
+        columnIndices (all by default) as empty strings. The grouped values are
+        decoded from their blobs by the function, see decodeGroupedValues.
+        """
+        table = nodeArgs.Tables[tableIndex]
+        tableName, columnNames = self.getTable(nodeArgs, tableIndex)
+        groupedColumns = self.groupedColumns[table.TableName]
+        columnExpressions = self.getColumnExpressions(nodeArgs, tableIndex)
+        selected = set(range(len(columnExpressions)) if columnIndices is None else columnIndices)
+        blobColumns = sorted(self.blobColumns[table.TableName].intersection(selected))
+        assert not blobColumns, \
+            "Columns {} of table {} are stored as blobs in {}, which are not supported; " \
+            "read the tables from the exported files instead".format(
+                ', '.join(table.ColumnDescriptions[index].ColumnName for index in blobColumns),
+                table.TableName, self.fileName)
+
+        expressions = []
+        # BLOB column name -> [(column index, position in the blob)]
+        groups = {}
+        for index, expression in enumerate(columnExpressions):
+            if index in selected and index in groupedColumns:
+                blobName, position = groupedColumns[index]
+                groups.setdefault(blobName, []).append((index, position))
+                expression = "''"
+            expressions.append(expression if index in selected else "''")
+        statement = 'SELECT {} FROM {}{}'.format(
+            ', '.join(expressions + [self.quote(blobName) for blobName in groups]), self.quote(tableName), where)
+        if not groups:
+            return statement, list
+
+        columnCount = len(expressions)
+        decoders = []
+        for blobName, members in groups.items():
+            count = max(position for index, position in members) + 1
+            # the columns of a group usually follow each other in the order of their values
+            indices = [index for index, position in members]
+            positions = [position for index, position in members]
+            if indices == list(range(indices[0], indices[0] + len(indices))):
+                decoders.append((blobName, count, slice(indices[0], indices[-1] + 1), positions, None))
+            else:
+                decoders.append((blobName, count, None, positions, indices))
+
+        def makeRow(row):
+            cells = list(row[:columnCount])
+            for slot, (blobName, count, target, positions, indices) in enumerate(decoders):
+                values = decodeGroupedValues(row[columnCount + slot], blobName, count)
+                if positions[0] != 0 or len(positions) != count:
+                    values = [values[position] for position in positions]
+                if target is not None:
+                    cells[target] = values[:len(positions)]
+                else:
+                    for index, value in zip(indices, values):
+                        cells[index] = value
+            return cells
+        return statement, makeRow
+
+    def getTableReader(self, nodeArgs, tableIndex, columnIndices=None, rowFilter=None):
+        """ Returns the cursor, a reader of the rows, and the column names of a table
+
+        Only the columns in columnIndices (all by default) are read, the others
+        are empty. With a rowFilter, only the rows it keeps are returned, see
+        the module description.
+        """
+        header = [column.ColumnName for column in nodeArgs.Tables[tableIndex].ColumnDescriptions]
+        conditions = None
+        if rowFilter is not None:
+            conditions = rowFilter.getSqlConditions(self.getColumnExpressions(nodeArgs, tableIndex))
+        if conditions is None:
+            statement, makeRow = self.select(nodeArgs, tableIndex, columnIndices, ' ORDER BY rowid')
+            cursor = self.connection.execute(statement)
+            rows = map(makeRow, cursor)
+            if rowFilter is not None:
+                rows = rowFilter.filterRows(rows)
+            return cursor, rows, header
+
+        self.countRejectedRows(nodeArgs, tableIndex, rowFilter, conditions)
+        # a condition that is NULL, e.g. on a missing number, drops the row like a false one
+        where = ' WHERE {} ORDER BY rowid'.format(' AND '.join('IFNULL({}, 0)'.format(sql) for sql, parameters in conditions))
+        statement, makeRow = self.select(nodeArgs, tableIndex, columnIndices, where)
+        cursor = self.connection.execute(
+            statement, [parameter for sql, parameters in conditions for parameter in parameters])
+        return cursor, map(makeRow, cursor), header
+
+    def countRejectedRows(self, nodeArgs, tableIndex, rowFilter, conditions):
+        """ Passes the number of rows of a table and the IDs of those failing the conditions to rowFilter """
+        tableName, columnNames = self.getTable(nodeArgs, tableIndex)
+        columnExpressions = self.getColumnExpressions(nodeArgs, tableIndex)
+        rowCount = self.connection.execute('SELECT COUNT(*) FROM {}'.format(self.quote(tableName))).fetchone()[0]
+
+        tests = ['IFNULL({}, 0)'.format(sql) for sql, parameters in conditions]
+        parameters = [parameter for sql, parameters in conditions for parameter in parameters]
+        statement = 'SELECT {}, CASE {} END FROM {} WHERE NOT ({}) ORDER BY rowid'.format(
+            columnExpressions[rowFilter.idIndex],
+            ' '.join('WHEN NOT {} THEN {}'.format(test, index) for index, test in enumerate(tests)),
+            self.quote(tableName), ' AND '.join(tests))
+        rowFilter.addRejectedRows(rowCount, self.connection.execute(statement, parameters + parameters))
+
+    def estimateRows(self, nodeArgs, tableIndex):
+        """ Returns the largest rowid of a table, the number of its rows unless rows were deleted """
+        tableName, columnNames = self.getTable(nodeArgs, tableIndex)
+        return self.connection.execute('SELECT MAX(rowid) FROM {}'.format(self.quote(tableName))).fetchone()[0] or 0
+
+    def getMappedTable(self, nodeArgs, tableIndex, idColumnIndex, columnIndices=None, cache=None):
+        return PdResultTable(self, nodeArgs, tableIndex, idColumnIndex, columnIndices, cache)
+
+    def getFingerprint(self, nodeArgs, tableIndex):
+        stat = os.stat(self.fileName)
+        tableName, columnNames = self.getTable(nodeArgs, tableIndex)
+        groupedColumns = self.groupedColumns[nodeArgs.Tables[tableIndex].TableName]
+        return (stat.st_size, getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9)),
+                tableName, columnNames, sorted(groupedColumns.items()))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+class PdResultTable(object):
+    """ A class that gives random access by ID to the rows of a table of a .pdResult file
+
+    The counterpart of scriptutils.MappedTable for PdResultSource: the rowid
+    of every row is indexed by its ID, and a row is only read, by its rowid,
+    when it is asked for. When an ID occurs more than once, the first row with
+    that ID is returned. With a TableCache, the index is reused from earlier
+    runs on the same file.
+
+    Attributes
+    ----------
+    header : list
+        column names
+    rowIndex : dict
+        maps an ID to the rowid of its row
+
+    Methods
+    -------
+    getRow(ID) -> list
+        row fields like those of PdResultSource.getTableReader
+    """
+
+    def __init__(self, source, nodeArgs, tableIndex, idColumnIndex, columnIndices=None, cache=None):
+        self.source = source
+        self.header = [column.ColumnName for column in nodeArgs.Tables[tableIndex].ColumnDescriptions]
+        self.statement, self.makeRow = source.select(nodeArgs, tableIndex, columnIndices, ' WHERE rowid = ?')
+
+        tableName, columnNames = source.getTable(nodeArgs, tableIndex)
+        idStatement = 'SELECT {}, rowid FROM {} ORDER BY rowid'.format(
+            source.quote(columnNames[idColumnIndex]), source.quote(tableName))
+
+        def build():
+            ids = array.array('q')
+            rowIDs = array.array('q')
+            for ID, rowID in source.connection.execute(idStatement):
+                ids.append(int(ID))
+                rowIDs.append(rowID)
+            return ids, rowIDs
+
+        if cache is None:
+            ids, rowIDs = build()
+        else:
+            ids, rowIDs = cache.getOrBuild(nodeArgs, tableIndex, ('PdResultTable', idColumnIndex), build)
+        self.rowCount = len(ids)
+        # filled from the last row to the first, so the first row with an ID wins
+        self.rowIndex = dict(zip(reversed(ids), reversed(rowIDs)))
+
+    def __len__(self):
+        return self.rowCount
+
+    def __contains__(self, ID):
+        return int(ID) in self.rowIndex
+
+    def getRow(self, ID):
+        rowID = self.rowIndex.get(int(ID))
+        if rowID is None: return None
+        return self.makeRow(self.source.connection.execute(self.statement, (rowID,)).fetchone())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
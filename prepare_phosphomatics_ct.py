@@ -1,21 +1,104 @@
 # -----------------------------------------------------------------------
 #  Use Case 2
 # -----------------------------------------------------------------------
+import time
+
+# the CPU time the process took before this script started (interpreter initialization,
+# unpacking of the frozen executable) and the start of the imports, see startupProfile
+startupCpuSeconds = time.process_time()
+importStartTime = time.perf_counter()
+
+import os
 import sys
-import csv
+
+# with --resident this process only forwards the run to the resident worker, see residentworker,
+# and exits before importing the modules the worker has already imported
+if __name__ == "__main__" and '--resident' in sys.argv[1:]:
+    import residentworker
+    exitCode = residentworker.forward(sys.argv[1:], residentworker.getIdentity(__file__))
+    if exitCode is not None:
+        sys.exit(exitCode)
+
 import scriptutils
-import traceback
+import joinengines
+
+# argparse, multiprocessing and traceback are only imported when needed: Proteome Discoverer
+# starts the node as a new process for every workflow run, so module imports are a large part
+# of the run time on small studies
+importSeconds = time.perf_counter() - importStartTime
 
 class UC2(object):
 
-    # node_response.json template
+    # run options; perform() fills missing ones from here, see parseArguments for their meaning
+    defaultOptions = {
+        'joinMode': 'auto',
+        'inputSource': 'files',
+        'resultFile': None,
+        'memoryBudget': 256 * 1024 * 1024,
+        'parseWorkers': None,
+        'abundanceType': 'float64',
+        'cache': False,
+        'cacheDir': None,
+        'cacheSize': 2048 * 1024 * 1024,
+        'clearCache': False,
+        'aggregate': None,
+        'modifications': ['Phospho'],
+        'minSiteProbability': None,
+        'minConfidence': None,
+        'minValidValues': None,
+        'columnarOutput': None,
+        'profile': False,
+        'startupProfile': False,
+        'resident': False,
+        'serve': False,
+        'idleTimeout': 600,
+        'residentMemory': 1024 * 1024 * 1024,
+    }
+
+    # modules the node can run without, reported by the startupProfile option when they are loaded
+    lazyModules = ['argparse', 'multiprocessing', 'tempfile', 'pickle', 'hashlib', 'locale', 'traceback', 'six',
+                   'residentworker', 'subprocess', 'pdresult', 'sqlite3']
+
+    # number of joined records written to the output tables at once, see getWriteBatchRows
+    writeBatchRows = 10000
+
+    # share of options['memoryBudget'] the records being written may take, and the approximate
+    # memory (bytes) of a record while it is written, and of every abundance value of it
+    writeBudgetShare = 0.25
+    writeRecordBytes = 600
+    writeValueBytes = 80
+
+    # DataType of the abundance columns in node_response.json; they are written unquoted,
+    # in the shortest format that reads back as the same value, and empty when missing
+    abundanceDataType = 'Float'
+
+    # largest share of the parsed abundance cells that may be non-numeric, read as missing values;
+    # a run above it fails, see scriptutils.AbundanceErrors
+    maxAbundanceErrorShare = 0.01
+
+    # values of the inputSource option: the table files Proteome Discoverer exported, or its .pdResult file
+    inputSources = ['files', 'pdresult']
+
+    # the columnarOutput option -> compression of the .npz file written next to Phosphomatics.txt
+    columnarOutputs = {'npz': False, 'npz-deflated': True}
+
+    # stage measurements written next to node_response.json by the profile option
+    profileFileName = 'node_response_profile.json'
+
+    # node_response.json template, $SITE_TABLES$ being one siteTablesTemplate per modification
     nodeResponseTemplate = '''
     {
          "CurrentWorkflowID": $CWFID$,
-         "Tables": [
+         "Tables": [$SITE_TABLES$
+         ]
+    }
+    '''
+
+    # the results table of the sites of a modification and its connection table to the peptide groups
+    siteTablesTemplate = '''
            {
-             "TableName": "Phosphomatics",
-             "DataFile": "$PATH$/Phosphomatics.txt",
+             "TableName": "$TABLE$",
+             "DataFile": "$PATH$/$TABLE$.txt",
              "DataFormat": "CSV",
              "Options": {},
              "ColumnDescriptions": [
@@ -46,11 +129,11 @@ class UC2(object):
              ]
            },
            {
-             "TableName":"Phosphomatics-TargetPeptideGroup",
-             "DataFile":"$PATH$/Phosphomatics-TargetPeptideGroup.txt",
+             "TableName":"$TABLE$-TargetPeptideGroup",
+             "DataFile":"$PATH$/$TABLE$-TargetPeptideGroup.txt",
              "DataFormat":"CSVConnectionTable",
              "Options":{
-                "FirstTable":"Phosphomatics",
+                "FirstTable":"$TABLE$",
                 "SecondTable":"Peptide Groups"
              },
              "ColumnDescriptions":[
@@ -67,114 +150,451 @@ class UC2(object):
                 "Options":{}
               }
             ]
-           }
-         ]
-    }
-    '''
+           },'''
+
+    # name of the results table; with several modifications, that of each is followed by the modification name
+    siteTableName = 'Phosphomatics'
 
     @classmethod
-    def doTables(cls, nodeArgs, nodeResponse, indexDict):
-        # get CSV reader for the only table specified in the nodeArgs
-        mapFile, mapReader, mapHeader = scriptutils.getTableReader(nodeArgs, indexDict['mapTableIndex'])
-
-        indexDict['pepGroupIDColInMapTable'] = mapHeader.index(
-            'Peptide Groups Peptide Group ID')
-
-        indexDict['modSiteIDColInMapTable'] = mapHeader.index(
-            'Modification Sites Modification Site ID')
-
-        # open CSV file for the Results table (1st) specified in the nodeResponse for writing
-        outResultsTableFileName = nodeResponse.Tables[0].DataFile
-        outResultsTableFile = open(outResultsTableFileName, 'w')
-        outResultsTableWriter = csv.writer(outResultsTableFile, delimiter='\t', quoting=csv.QUOTE_NONNUMERIC)
-
-
-        # open CSV file for connection table
-        outConnectionTableFileName = nodeResponse.Tables[1].DataFile
-        outConnectionTableFile = open(outConnectionTableFileName, 'w')
-        outConnectionTableWriter = csv.writer(outConnectionTableFile, delimiter='\t', quoting=csv.QUOTE_NONNUMERIC)
-
-        # write the 1st row (2-column header) to the connection table file
-        outConnectionTableHeader = [
-            nodeResponse.Tables[1].ColumnDescriptions[0].ColumnName,
-            nodeResponse.Tables[1].ColumnDescriptions[1].ColumnName
-        ]
-        outConnectionTableWriter.writerow(outConnectionTableHeader)
-
-        def getRow(ID, reader, index = 0):
-            for row in reader:
-                for column in row:
-                    column = column.strip().replace('"', '')
-                if row[index] == ID:
-                    return row
-            return
+    def doTables(cls, nodeArgs, nodeResponse, indexDict, options, profiler=None, tableSource=None):
+        if profiler is None:
+            profiler = scriptutils.NullProfiler()
+
+        # join the input tables with the engine selected by the joinMode option, see joinengines,
+        # or with the one joinengines.JoinPlanner chooses for 'auto'; one pass yields the records
+        # of all the modifications
+        joinMode = options['joinMode']
+        if joinMode == 'auto':
+            with profiler.stage('planJoin'):
+                planner = joinengines.JoinPlanner(nodeArgs, indexDict, options, tableSource)
+                joinMode = planner.plan()
+            print('uc2: ' + planner.summary())
+        cache = cls.getTableCache(nodeArgs, options, tableSource)
+        # a resident worker runs the node again and again in the same process
+        scriptutils.abundanceErrors.reset()
+        engine = joinengines.joinEngines[joinMode](
+            nodeArgs, indexDict, options, cache, profiler, tableSource)
+
+        # the results and connection tables of all modifications specified in the nodeResponse
+        # only replace their files once all are completely written; the write stage
+        # gets the time of the batches and of creating and committing the files
+        with profiler.stage('write') as writeStage:
+            siteTables = cls.openSiteTables(nodeResponse, indexDict, options)
+            writers = [writer for siteTable in siteTables.values() for writer in siteTable['writers']]
+            try:
+                # cycle through joined rows and build/write out tables' rows in batches;
+                # the join stage gets the time not taken by the parse and write stages nested in it
+                with profiler.stage('join') as joinStage:
+                    if options['aggregate']:
+                        aggregator = joinengines.SiteAggregator(options['aggregate'])
+                        records = engine.joinAggregated(aggregator)
+                    else:
+                        records = engine.join()
+                    records = profiler.markFirst(records, 'firstRecord')
+
+                    batchRows = cls.getWriteBatchRows(indexDict, options)
+                    for record in records:
+                        siteTable = siteTables[record[5]]
+                        siteTable['batch'].append(record)
+                        if len(siteTable['batch']) == batchRows:
+                            with profiler.stage('write'):
+                                cls.writeSiteTableBatch(siteTable, indexDict)
+                    with profiler.stage('write'):
+                        for siteTable in siteTables.values():
+                            cls.writeSiteTableBatch(siteTable, indexDict)
+                    rowsOut = sum(siteTable['nextID'] - 1 for siteTable in siteTables.values())
+                    joinStage.rowsOut = rowsOut
+                abundanceErrors = scriptutils.abundanceErrors
+                assert abundanceErrors.getShare() <= cls.maxAbundanceErrorShare, \
+                    "{}, more than {:.0%} of them; are the numbers written with decimal commas?".format(
+                        abundanceErrors.summary(), cls.maxAbundanceErrorShare)
+            except:
+                for writer in writers:
+                    writer.abort()
+                raise
+            for writer in writers:
+                writer.commit()
+
+            writeStage.rowsIn = rowsOut
+            writeStage.rowsOut = sum(
+                siteTable['writers'][0].rowCount + siteTable['writers'][1].rowCount for siteTable in siteTables.values())
+
+        print('uc2: ' + engine.modificationFilter.summary())
+        if engine.peptideFilter is not None:
+            print('uc2: ' + engine.peptideFilter.summary())
+        if abundanceErrors.errors:
+            print('uc2: ' + abundanceErrors.summary())
+        if len(siteTables) > 1:
+            for modificationName, siteTable in siteTables.items():
+                print('uc2: {} sites written to table "{}"'.format(siteTable['nextID'] - 1, siteTable['tableName']))
+        if options['aggregate']:
+            print('uc2: ' + aggregator.summary(rowsOut))
+        if cache is not None:
+            print('uc2: table cache {}: {} hits, {} misses'.format(cache.cacheDir, cache.hits, cache.misses))
 
-        # write the 1st row (2-column header) to the results table file
-        outResultsTableHeader = []
-        for columnDescription in nodeResponse.Tables[0].ColumnDescriptions:
-            outResultsTableHeader.append(columnDescription.ColumnName)
+        """
+        print "uc2.doTables: Resulting \"" + nodeResponse.Tables[0].TableName + "\" table:\n" + open(outResultTableFileName, 'rb').read()
+        """
 
-        #for column in _NodeResponse__Tables
-        outResultsTableWriter.writerow(outResultsTableHeader)
+        # number of rows written to the results tables
+        return rowsOut
 
-        # cycle throw input table rows and build/write out tables' rows
-        phosphomaticsID = 1 # initialize unique ID
-        for counter, mapRow in enumerate(mapReader):
-            # trim and de-quote all input table row values
-            for column in mapRow:
-                column = column.strip().replace('"', '')
+    @classmethod
+    def getWriteBatchRows(cls, indexDict, options):
+        """ Returns the number of records of a site table written at once
 
-            pepFile, pepReader, pepHeader = scriptutils.getTableReader(
-                nodeArgs, indexDict['peptideTableIndex'])
-            modFile, modReader, modHeader = scriptutils.getTableReader(
-                nodeArgs, indexDict['modSiteTableIndex'])
+        That is writeBatchRows, unless the batches of all site tables would take
+        more than writeBudgetShare of options['memoryBudget'], which bounds the
+        memory of the sortmerge and sqlite join modes.
+        """
+        recordBytes = cls.writeRecordBytes + len(indexDict['quantColIndicies']) * cls.writeValueBytes
+        budgetRows = options['memoryBudget'] * cls.writeBudgetShare / (recordBytes * len(options['modifications']))
+        return int(max(100, min(cls.writeBatchRows, budgetRows)))
 
-            if counter == 0:
-                indexDict['modNameIndex'] = modHeader.index('Modification Name')
-                indexDict['residueIndex'] = modHeader.index('Target Amino Acid')
-                indexDict['accessionIndex'] = modHeader.index('Protein Accession')
-                indexDict['positionIndex'] = modHeader.index('Position')
-                indexDict['modIDColumnIndex'] = modHeader.index('Modification Sites Modification Site ID')
+    @classmethod
+    def openSiteTables(cls, nodeResponse, indexDict, options):
+        """ Creates the writers of the tables of every modification, see siteTablesTemplate
 
-            peptide = getRow(
-                mapRow[indexDict['pepGroupIDColInMapTable']], pepReader, index = indexDict['peptideIDColumnIndex'])
-            modification = getRow(
-                mapRow[indexDict['modSiteIDColInMapTable']], modReader, index = indexDict['modIDColumnIndex'])
+        Returns a dict of modification name -> {'tableName', 'writers', 'batch', 'nextID'},
+        writers being the results table, connection table and columnar writers
+        in the order writeBatch takes them.
+        """
+        siteTables = {}
+        writers = []
+        try:
+            for index, modificationName in enumerate(options['modifications']):
+                resultsTable = nodeResponse.Tables[2 * index]
+                connectionTable = nodeResponse.Tables[2 * index + 1]
+                siteTableWriters = [
+                    scriptutils.TableWriter(
+                        resultsTable.DataFile, [column.ColumnName for column in resultsTable.ColumnDescriptions]),
+                    scriptutils.TableWriter(
+                        connectionTable.DataFile, [column.ColumnName for column in connectionTable.ColumnDescriptions]),
+                    cls.getColumnarWriter(resultsTable, indexDict, options),
+                ]
+                writers.extend(siteTableWriters)
+                siteTables[modificationName] = {
+                    'tableName': resultsTable.TableName,
+                    'writers': siteTableWriters,
+                    'batch': [],
+                    'nextID': 1, # unique ID within the table
+                }
+        except:
+            for writer in writers:
+                writer.abort()
+            raise
+        return siteTables
 
-            if modification[indexDict['modNameIndex']] != 'Phospho': continue
+    @classmethod
+    def writeSiteTableBatch(cls, siteTable, indexDict):
+        siteTable['nextID'] = cls.writeBatch(siteTable['batch'], siteTable['nextID'], indexDict, *siteTable['writers'])
+        siteTable['batch'] = []
 
-            outResultsTableRow = ["%s" %phosphomaticsID]
+    @classmethod
+    def getSiteTableName(cls, modificationName, modifications):
+        """ Returns the name of the results table of a modification """
+        if len(modifications) == 1:
+            return cls.siteTableName
+        # '-' separates the table names of a connection table name, and the name
+        # also goes into file names and the JSON of the template
+        name = ''.join(' ' if c in '-\\/:*?"<>|' else c for c in modificationName)
+        return '{} {}'.format(cls.siteTableName, ' '.join(name.split()))
 
-            outResultsTableRow.append(modification[indexDict['accessionIndex']])
-            outResultsTableRow.append(modification[indexDict['residueIndex']])
-            outResultsTableRow.append(modification[indexDict['positionIndex']])
+    @classmethod
+    def writeBatch(cls, batch, phosphomaticsID, indexDict, outResultsTableWriter, outConnectionTableWriter,
+                   columnarWriter=None):
+        """ Writes a batch of joined records numbered from phosphomaticsID on, returns the next free ID
 
-            outResultsTableRow += [
-                peptide[x] for x in indexDict['quantColIndicies']
-            ]
+        The peptide group ID of a record is a list of IDs when it comes from a SiteAggregator.
+        """
+        abundanceRows = scriptutils.formatAbundanceRows(
+            [record[4] for record in batch], len(indexDict['quantColIndicies']))
+
+        outResultsTableRows = []
+        connectionTableRows = []
+        for peptideGroupID, accession, residue, position, abundances, modificationName in batch:
+            outResultsTableRows.append(["%s" %phosphomaticsID, accession, residue, position])
+            if isinstance(peptideGroupID, list):
+                for ID in peptideGroupID:
+                    connectionTableRows.append([ "%s" %phosphomaticsID, ID ])
+            else:
+                connectionTableRows.append([ "%s" %phosphomaticsID, peptideGroupID ])
+            phosphomaticsID += 1
 
-            # write output results table row
-            outResultsTableWriter.writerow(outResultsTableRow)
+        # the abundances are written as numbers, see abundanceDataType
+        outResultsTableWriter.writeNumberRows(outResultsTableRows, abundanceRows)
+        if columnarWriter is not None:
+            columnarWriter.writeRows(outResultsTableRows, [record[4] for record in batch])
+        outConnectionTableWriter.writerows(connectionTableRows)
+        return phosphomaticsID
 
-            # write entry to connection table
-            connectionTableRow = [ "%s" %phosphomaticsID, peptide[indexDict['peptideIDColumnIndex']] ]
-            outConnectionTableWriter.writerow(connectionTableRow)
+    @classmethod
+    def getColumnarWriter(cls, resultsTable, indexDict, options):
+        """ Returns the writer of the .npz file of a results table selected by the columnarOutput option,
+        or a NullTableWriter
+
+        The file has the columns of the results table, see scriptutils.NpzTableWriter:
+        "Phosphomatics ID" and "Position" int64, "Accession" and "Residue" unicode,
+        and the abundances in the float array "Abundances" with their column names
+        in "Abundances columns".
+        """
+        if options['columnarOutput'] is None:
+            return scriptutils.NullTableWriter()
+
+        columnNames = [column.ColumnName for column in resultsTable.ColumnDescriptions]
+        abundanceCount = len(indexDict['quantColIndicies'])
+        resultsFileName = resultsTable.DataFile
+        return scriptutils.NpzTableWriter(
+            os.path.splitext(resultsFileName)[0] + '.npz',
+            list(zip(columnNames[:4], ['q', 'U', 'U', 'q'])),
+            'Abundances', columnNames[4:4 + abundanceCount],
+            scriptutils.abundanceTypecodes[options['abundanceType']],
+            cls.columnarOutputs[options['columnarOutput']])
 
-            phosphomaticsID += 1
+    @classmethod
+    def getTableSource(cls, nodeArgs, options):
+        """ Returns the source of the input tables selected by the inputSource option, None for the table files """
+        if options['inputSource'] == 'files':
+            return None
+        assert options['inputSource'] == 'pdresult', "invalid input source {}".format(options['inputSource'])
 
-        # close  both in- and out- files
-        outResultsTableFile.close()
+        import pdresult
 
-        """
-        print "uc2.doTables: Resulting \"" + nodeResponse.Tables[0].TableName + "\" table:\n" + open(outResultTableFileName, 'rb').read()
-        """
+        resultFile = options['resultFile'] or getattr(nodeArgs, 'ResultFilePath', None)
+        print('uc2: reading the input tables from ' + str(resultFile))
+        return pdresult.PdResultSource(resultFile)
 
-        return
+    @classmethod
+    def getTableCache(cls, nodeArgs, options, tableSource=None):
+        """ Returns the TableCache selected by the options, or None """
+        cacheDir = options['cacheDir']
+        if cacheDir is None:
+            workingDirectory = getattr(nodeArgs, 'WorkingDirectory', None)
+            if workingDirectory is None:
+                workingDirectory = os.path.dirname(os.path.abspath(nodeArgs.ExpectedResponsePath))
+            cacheDir = os.path.join(workingDirectory, 'PhosphomaticsCache')
+
+        if options['clearCache'] and os.path.isdir(cacheDir):
+            scriptutils.TableCache(cacheDir, options['cacheSize']).clear()
+
+        if not options['cache']:
+            return None
+        return scriptutils.TableCache(cacheDir, options['cacheSize'], tableSource)
 
     @classmethod
-    def perform(cls, nodeArgsFileName):
+    def storeProfile(cls, nodeArgs, profiler):
+        """ Writes the stage measurements next to node_response.json and a summary to the node log """
+        profileFileName = os.path.join(
+            os.path.dirname(os.path.abspath(nodeArgs.ExpectedResponsePath)), cls.profileFileName)
+        profiler.toFile(profileFileName)
+        for line in profiler.summary():
+            print('uc2: profile ' + line)
+        print('uc2: profile stored in ' + profileFileName)
 
-        nodeArgs = scriptutils.NodeArgs.fromFile(nodeArgsFileName)
+    @classmethod
+    def reportStartup(cls, profiler):
+        """ Prints the startup costs: interpreter, imports, initialization stages and the time to the first record """
+        print('uc2: startup interpreter {:.1f} ms cpu before the script'.format(startupCpuSeconds * 1000))
+        print('uc2: startup imports {:.1f} ms'.format(importSeconds * 1000))
+        for name in ['readNodeArgs', 'buildTemplate', 'storeNodeResponse']:
+            if name in profiler.stages:
+                print('uc2: startup {} {:.1f} ms'.format(name, profiler.stages[name]['wallSeconds'] * 1000))
+        if 'firstRecord' in profiler.marks:
+            firstRecordSeconds = profiler.startTimes[0] - importStartTime + profiler.marks['firstRecord']
+            print('uc2: startup first record {:.1f} ms after the imports started'.format(firstRecordSeconds * 1000))
+        loaded = [name for name in cls.lazyModules if name in sys.modules]
+        print('uc2: startup optional modules loaded: {}'.format(', '.join(loaded) if loaded else 'none'))
+
+    @classmethod
+    def parseArguments(cls, argv):
+        # Proteome Discoverer passes the node_args.json file name only (see node.json),
+        # which needs neither argparse nor the modules it imports
+        if len(argv) == 1 and not argv[0].startswith('-'):
+            return argv[0], dict(cls.defaultOptions)
+
+        import argparse
+
+        parser = argparse.ArgumentParser(
+            description='Generate tables compatible with Phosphomatics import from Proteome Discoverer results')
+        parser.add_argument('nodeArgsFileName', nargs='?',
+            help='full filename of the node_args.json file')
+        parser.add_argument('--join-mode', dest='joinMode',
+            choices=['auto'] + sorted(joinengines.joinEngines), default=cls.defaultOptions['joinMode'],
+            help='auto: choose hash, or sqlite when hash would not fit, from the sizes of the input tables and '
+                 'the available memory, see joinengines.JoinPlanner (default); '
+                 'hash: index the input tables in memory; '
+                 'mapped: like hash, but peptide groups are read from the memory-mapped file when needed; '
+                 'sortmerge: sort the input tables on disk, for inputs larger than memory; '
+                 'sqlite: stage the input tables in a temporary SQLite database on disk and join them there, '
+                 'for inputs larger than memory')
+        parser.add_argument('--input-source', dest='inputSource',
+            choices=cls.inputSources, default=cls.defaultOptions['inputSource'],
+            help='files: read the input tables from the files Proteome Discoverer exported (default); '
+                 'pdresult: read them from the .pdResult file, see pdresult, so they need not be exported; '
+                 'of the columns stored as blobs, only grouped values (like the abundances) of Proteome '
+                 'Discoverer\'s layout of 9 bytes per value can be read, a run needing other blobs fails')
+        parser.add_argument('--result-file', dest='resultFile', default=cls.defaultOptions['resultFile'],
+            help='.pdResult file of the pdresult input source, default: ResultFilePath of node_args.json')
+        parser.add_argument('--memory-budget', dest='memoryBudget', type=int,
+            default=cls.defaultOptions['memoryBudget'] // (1024 * 1024),
+            help='approximate memory (MB) the sortmerge join mode may use for rows, and the sqlite join mode '
+                 'for its page cache and sorts; a quarter of it bounds the records being written; default %(default)s')
+        parser.add_argument('--abundance-type', dest='abundanceType',
+            choices=sorted(scriptutils.abundanceTypecodes), default=cls.defaultOptions['abundanceType'],
+            help='type abundance values are held in, default %(default)s')
+        parser.add_argument('--cache', dest='cache', action='store_true',
+            help='keep data parsed from the input tables in a cache folder and reuse it in later runs '
+                 '(hash and mapped join modes)')
+        parser.add_argument('--cache-dir', dest='cacheDir', default=cls.defaultOptions['cacheDir'],
+            help='cache folder, default: PhosphomaticsCache in the working directory of node_args.json')
+        parser.add_argument('--cache-size', dest='cacheSize', type=int,
+            default=cls.defaultOptions['cacheSize'] // (1024 * 1024),
+            help='size (MB) above which the least recently used cache entries are removed, default %(default)s')
+        parser.add_argument('--clear-cache', dest='clearCache', action='store_true',
+            help='remove all cache entries before running')
+        parser.add_argument('--aggregate', dest='aggregate',
+            choices=sorted(joinengines.SiteAggregator.reducers), default=cls.defaultOptions['aggregate'],
+            help='write one row per site (accession, residue, position), combining the abundances of its '
+                 'peptide groups by sum, max, or taking those of the peptide group with the most valid values; '
+                 'default: one row per peptide group and site')
+        parser.add_argument('--modifications', dest='modifications',
+            type=lambda value: [name.strip() for name in value.split(',') if name.strip()],
+            default=cls.defaultOptions['modifications'],
+            help='comma-separated Modification Name values of the sites to write, e.g. Phospho,Acetyl,GlyGly; '
+                 'the input tables are read once for all of them. With more than one, every modification '
+                 'gets its own results and connection tables, "{0} <modification>" and '
+                 '"{0} <modification>-TargetPeptideGroup"; default: Phospho'.format(cls.siteTableName))
+        parser.add_argument('--min-site-probability', dest='minSiteProbability', type=float,
+            default=cls.defaultOptions['minSiteProbability'],
+            help='drop the modification sites whose Site Probability is lower or missing, e.g. 75; default: none')
+        parser.add_argument('--min-confidence', dest='minConfidence',
+            choices=joinengines.confidenceLevels, default=cls.defaultOptions['minConfidence'],
+            help='drop the peptide groups whose Confidence is lower; default: none')
+        parser.add_argument('--min-valid-values', dest='minValidValues', type=int,
+            default=cls.defaultOptions['minValidValues'],
+            help='drop the peptide groups with fewer non-missing abundance values; default: none')
+        parser.add_argument('--columnar-output', dest='columnarOutput',
+            choices=sorted(cls.columnarOutputs), default=cls.defaultOptions['columnarOutput'],
+            help='also write the results table as a NumPy .npz file with one typed array per column '
+                 '(see scriptutils.NpzTableWriter) next to Phosphomatics.txt, its members stored (npz) '
+                 'or deflated (npz-deflated); default: none')
+        parser.add_argument('--parse-workers', dest='parseWorkers', type=int,
+            default=cls.defaultOptions['parseWorkers'],
+            help='number of worker processes parsing byte ranges of the Peptide Groups file in the hash join mode, '
+                 'see scriptutils.ParallelTableParser; worth it for files of hundreds of MB; default: none, '
+                 'the file is parsed by the node process')
+        parser.add_argument('--profile', dest='profile', action='store_true',
+            help='measure the wall time, CPU time, rows and peak RSS of the stages of the run, '
+                 'write them to {} next to node_response.json and print a summary'.format(cls.profileFileName))
+        parser.add_argument('--startup-profile', dest='startupProfile', action='store_true',
+            help='print the time taken by interpreter startup, imports and initialization, '
+                 'and the time to the first record')
+        parser.add_argument('--resident', dest='resident', action='store_true',
+            help='run in the resident worker process, which keeps the modules and, with --cache, '
+                 'recently parsed tables loaded between runs; it is started when not running')
+        parser.add_argument('--serve', dest='serve', action='store_true',
+            help='be the resident worker: run the node for --resident launchers until idle')
+        parser.add_argument('--idle-timeout', dest='idleTimeout', type=float,
+            default=cls.defaultOptions['idleTimeout'],
+            help='seconds without a run after which the resident worker exits, default %(default)s')
+        parser.add_argument('--resident-memory', dest='residentMemory', type=int,
+            default=cls.defaultOptions['residentMemory'] // (1024 * 1024),
+            help='size (MB) of the cache entries the resident worker keeps in memory, default %(default)s')
+
+        args = parser.parse_args(argv)
+        if args.nodeArgsFileName is None and not args.serve:
+            parser.error('the nodeArgsFileName argument is required')
+
+        options = dict(cls.defaultOptions)
+        options['joinMode'] = args.joinMode
+        options['inputSource'] = args.inputSource
+        options['resultFile'] = args.resultFile
+        options['memoryBudget'] = args.memoryBudget * 1024 * 1024
+        options['parseWorkers'] = args.parseWorkers
+        options['abundanceType'] = args.abundanceType
+        options['cache'] = args.cache
+        options['cacheDir'] = args.cacheDir
+        options['cacheSize'] = args.cacheSize * 1024 * 1024
+        options['clearCache'] = args.clearCache
+        options['aggregate'] = args.aggregate
+        options['columnarOutput'] = args.columnarOutput
+        options['modifications'] = args.modifications
+        options['minSiteProbability'] = args.minSiteProbability
+        options['minConfidence'] = args.minConfidence
+        options['minValidValues'] = args.minValidValues
+        options['profile'] = args.profile
+        options['startupProfile'] = args.startupProfile
+        options['resident'] = args.resident
+        options['serve'] = args.serve
+        options['idleTimeout'] = args.idleTimeout
+        options['residentMemory'] = args.residentMemory * 1024 * 1024
+        return args.nodeArgsFileName, options
+
+    @classmethod
+    def main(cls, argv):
+        """ Runs the node, or the resident worker, for a command line """
+        if '--serve' not in argv and '--resident' not in argv:
+            return cls.run(argv)
+
+        import residentworker
+
+        nodeArgsFileName, options = cls.parseArguments(argv)
+        if options['serve']:
+            scriptutils.TableCache.memoryBytes = options['residentMemory']
+            worker = residentworker.ResidentWorker(cls.run, residentworker.getIdentity(__file__), options['idleTimeout'])
+            worker.serve()
+            return
+
+        # the launcher found no usable worker: start one for the next runs and run this one here
+        if getattr(sys, 'frozen', False):
+            command = [sys.executable, '--serve']
+        else:
+            command = [sys.executable, os.path.abspath(__file__), '--serve']
+        command += ['--idle-timeout', str(options['idleTimeout']),
+                    '--resident-memory', str(options['residentMemory'] // (1024 * 1024))]
+        if not residentworker.ResidentWorker.isRunning():
+            residentworker.ResidentWorker.start(command)
+        cls.run(argv)
+
+    @classmethod
+    def run(cls, argv):
+        """ Runs the node for a command line, printing the outcome to the node log """
+        try:
+            nodeArgsFileName, options = cls.parseArguments(argv)
+
+            cls.perform(nodeArgsFileName, options)
+
+        except AssertionError as assertionError:
+            print ('uc2: Script failure on assert: ')
+            print (assertionError)
+        except Exception as exception:
+            import traceback
+            print ('uc2: Script failure with exception: ')
+            print (traceback.format_exc())
+        else:
+            print ('uc2: Done with the script business.')
+
+    @classmethod
+    def perform(cls, nodeArgsFileName, options=None):
+
+        options = dict(cls.defaultOptions, **(options or {}))
+
+        modifications = options['modifications']
+        assert len(modifications) > 0, 'No modification names given'
+        assert len(set(modifications)) == len(modifications), \
+            'Modification names given more than once: {}'.format(modifications)
+        assert len(set(cls.getSiteTableName(name, modifications) for name in modifications)) == len(modifications), \
+            'Modification names {} do not give distinct table names'.format(modifications)
+
+        # measures the stages of the run; the NullProfiler measures nothing
+        if options['profile'] or options['startupProfile']:
+            profiler = scriptutils.StageProfiler()
+        else:
+            profiler = scriptutils.NullProfiler()
+
+        with profiler.stage('readNodeArgs') as stage:
+            nodeArgs = scriptutils.NodeArgs.fromFile(nodeArgsFileName)
+            stage.rowsOut = len(nodeArgs.Tables)
 
         # get peptide table
         # not sure that these will always be in the same order in node_args
@@ -206,69 +626,76 @@ class UC2(object):
 
         assert len(peptideTableColumns) > 0, 'No data columns found in peptide groups table'
 
-        # need to dynamicall add new columns to match number of
-        # input table abundance figures
-
-        # new column string to add to template
-        newColumns = ''
-
-        # teplate for new column definitions
-        colTemplate = '''
-           {
-             "ColumnName": "$COLNAME$",
-             "ID": "",
-             "DataType": "$COLDTYPE$",
-             "Options": {}
-           },'''
-
-
-        for counter, column in enumerate(peptideTableColumns):
-            if column._AnyColumnDescription__ColumnName == 'Sequence':
-                indexDict['sequenceIndex'] = counter
-            if column._AnyColumnDescription__ColumnName == 'Modifications':
-                indexDict['modificationIndex'] = counter
-            if column._AnyColumnDescription__ColumnName == 'Peptide Groups Peptide Group ID':
-                indexDict['peptideIDColumnIndex'] = counter
-
-            colOptions = column._ColumnDescription__Options
+        with profiler.stage('buildTemplate'):
+            # need to dynamicall add new columns to match number of
+            # input table abundance figures
 
-            if not hasattr(colOptions, 'DataGroupName'): continue
+            # new column string to add to template
+            newColumns = ''
 
-            if colOptions.DataGroupName == 'Abundances':
-                name = column._AnyColumnDescription__ColumnName
-                dataType = column._AnyColumnDescription__DataType
-                newColumn = colTemplate.replace(
-                    '$COLNAME$', name
+            # teplate for new column definitions
+            colTemplate = '''
+               {
+                 "ColumnName": "$COLNAME$",
+                 "ID": "",
+                 "DataType": "$COLDTYPE$",
+                 "Options": {}
+               },'''
+
+
+            for counter, column in enumerate(peptideTableColumns):
+                if column.ColumnName == 'Sequence':
+                    indexDict['sequenceIndex'] = counter
+                if column.ColumnName == 'Modifications':
+                    indexDict['modificationIndex'] = counter
+                if column.ColumnName == 'Peptide Groups Peptide Group ID':
+                    indexDict['peptideIDColumnIndex'] = counter
+
+                if column.DataGroupName == 'Abundances':
+                    name = column.ColumnName
+                    dataType = cls.abundanceDataType
+                    newColumn = colTemplate.replace(
+                        '$COLNAME$', name
+                    ).replace(
+                        '$COLDTYPE$',dataType
+                    )
+                    newColumns += newColumn
+                    indexDict['quantColIndicies'].append(counter)
+
+
+            # the tables of every modification; the templates stay unchanged for later
+            # runs in the same process (resident worker)
+            siteTables = ''
+            for modificationName in modifications:
+                siteTables += cls.siteTablesTemplate.replace(
+                    '$QUANTIFICATION_COLUMNS$', newColumns[0:-1]
                 ).replace(
-                    '$COLDTYPE$',dataType
+                    '$TABLE$', cls.getSiteTableName(modificationName, modifications)
                 )
-                newColumns += newColumn
-                indexDict['quantColIndicies'].append(counter)
-
+            nodeResponseTemplate = cls.nodeResponseTemplate.replace('$SITE_TABLES$', siteTables[0:-1])
 
-        cls.nodeResponseTemplate = cls.nodeResponseTemplate.replace(
-            '$QUANTIFICATION_COLUMNS$', newColumns[0:-1]
-        )
+        with profiler.stage('storeNodeResponse'):
+            nodeResponse = scriptutils.generateAndStoreNodeResponse(nodeArgs, nodeResponseTemplate)
 
-        nodeResponse = scriptutils.generateAndStoreNodeResponse(nodeArgs, cls.nodeResponseTemplate)
+        tableSource = cls.getTableSource(nodeArgs, options)
+        try:
+            rowsOut = cls.doTables(nodeArgs, nodeResponse, indexDict, options, profiler, tableSource)
+        finally:
+            if tableSource is not None:
+                tableSource.close()
 
-        cls.doTables(nodeArgs, nodeResponse, indexDict)
+        if options['profile']:
+            cls.storeProfile(nodeArgs, profiler)
+        if options['startupProfile']:
+            cls.reportStartup(profiler)
 
-        return
+        return rowsOut
 
 if __name__ == "__main__":
-    try:
-        assert (len(sys.argv) == 2), \
-            "Script requires one and only one parameter: full filename of the node_args.json file"
-
-        UC2.perform(sys.argv[1])
-
-    except AssertionError as assertionError:
-        print ('uc2: Script failure on assert: ')
-        print (assertionError)
-    except Exception as exception:
-        print ('uc2: Script failure with exception: ')
-        print (traceback.format_exc())
-    else:
-        print ('uc2: Done with the script business.')
+    # needed by the worker processes of --parse-workers in the frozen executable,
+    # where alone it has an effect
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
 
+    UC2.main(sys.argv[1:])
@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import gc
+import time
+import stat
+import socket
+import threading
+
+"""
+Resident worker
+---------------
+
+Proteome Discoverer starts the node as a new process for every workflow run,
+which pays for interpreter startup, imports and parsing the input tables
+every time. With the --resident option the node process is a thin launcher:
+it forwards its command line to a long-lived worker process of the same
+user, streams back what the run prints and exits. The worker keeps the
+modules imported and, with --cache, the tables parsed by recent runs in
+memory (see scriptutils.TableCache.memoryBytes).
+
+ResidentWorker
+    the worker: accepts runs on a localhost socket, runs them one at a time in
+    the order they come, and exits after idleTimeout seconds without a run
+
+forward(argv, identity) -> int or None
+    the launcher side: runs argv in the worker, returns the exit code of the run
+    or None if there is no usable worker
+
+The worker listens on 127.0.0.1 on a port chosen by the system and writes
+the port and a random key to a state file in a directory only the user can
+access (see getStateDir); a state file or directory owned by someone else or
+open to others is ignored, and a request without the key is rejected.
+Requests and replies are JSON objects, one per line:
+
+    launcher -> worker
+        {"key": ..., "command": "run", "identity": ..., "argv": [...], "cwd": ..., "deadline": t}
+        {"key": ..., "command": "ping"}
+    worker -> launcher
+        {"status": "queued"}    at once and every heartbeatInterval seconds while another run goes on
+        {"status": "expired"}   when the run could not start before the deadline (time.time())
+        {"output": text}        for everything the run prints, as it is printed
+        {"status": "running"}   every heartbeatInterval seconds during the run
+        {"status": "done", "exitCode": n}   when the run is finished
+        {"status": "mismatch"}  when the worker runs another version of the node
+        {"status": "pong"}
+
+The identity (see getIdentity) changes when the executable or the scripts
+change, so a worker never runs a node it was not started from; it exits
+instead and the launcher runs the node itself. A launcher that hears
+nothing from the worker for replyTimeout seconds, heartbeats included, takes
+the worker for dead. Every connection is served by a thread of its own, so
+pings are answered during a run and a second launcher is told that its run
+is queued; the worker drops a queued run at its deadline, when the launcher
+stops waiting and runs the node itself, so no run is done twice.
+"""
+
+# seconds between the heartbeats of a run, and without any message after which the launcher gives up
+heartbeatInterval = 5.0
+replyTimeout = 30.0
+
+# seconds a launcher waits for the worker to start its run while another one goes on
+queueTimeout = 120.0
+
+def isPrivate(fileStat):
+    """ Returns whether a file or directory belongs to this user and is closed to everybody else """
+    if sys.platform == 'win32':
+        # the state lives in the profile of the user, see getStateDir
+        return True
+    return fileStat.st_uid == os.getuid() and not fileStat.st_mode & 0o077
+
+def getStateDir():
+    """ Returns the directory of the worker state of this user, created if needed, or None if it is not private """
+    try:
+        if sys.platform == 'win32':
+            stateDir = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~'), 'phosphomatics-worker')
+            os.makedirs(stateDir, exist_ok=True)
+            return stateDir
+        baseDir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+        stateDir = os.path.join(baseDir, 'phosphomatics-worker-{}'.format(os.getuid()))
+        try:
+            os.mkdir(stateDir, 0o700)
+        except FileExistsError:
+            pass
+        # lstat, so that a link planted in a shared directory is not followed
+        stateDirStat = os.lstat(stateDir)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(stateDirStat.st_mode) or not isPrivate(stateDirStat):
+        return None
+    return stateDir
+
+def getStateFileName():
+    """ Returns the name of the file with the port and key of the worker of this user, None without a private directory """
+    stateDir = getStateDir()
+    if stateDir is None:
+        return None
+    return os.path.join(stateDir, 'worker.json')
+
+def getIdentity(scriptFileName):
+    """ Returns a string that changes whenever the code of the node changes """
+    if getattr(sys, 'frozen', False):
+        fileNames = [sys.executable]
+    else:
+        scriptDir = os.path.dirname(os.path.abspath(scriptFileName))
+        fileNames = [os.path.join(scriptDir, name) for name in sorted(os.listdir(scriptDir)) if name.endswith('.py')]
+    return repr([sys.executable, sys.version] + [(name, os.path.getmtime(name)) for name in fileNames])
+
+def readState():
+    stateFileName = getStateFileName()
+    if stateFileName is None:
+        return None
+    try:
+        fileDescriptor = os.open(stateFileName, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        with os.fdopen(fileDescriptor, 'r') as f:
+            if not isPrivate(os.fstat(f.fileno())):
+                return None
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def connect(state, timeout):
+    connection = socket.create_connection(('127.0.0.1', state['port']), timeout)
+    return connection, connection.makefile('rwb')
+
+def sendMessage(stream, message):
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+
+def receiveMessage(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError("connection closed")
+    return json.loads(line.decode('utf-8'))
+
+def forward(argv, identity, connectTimeout=2.0):
+    """ Runs the node with argv in the worker, prints its output and returns its exit code
+
+    Returns None, having printed nothing, when there is no worker, it runs
+    another version of the node, or it fails before the run has started, and
+    when the worker could not start the run within queueTimeout seconds.
+    """
+    state = readState()
+    if state is None:
+        return None
+    printed = False
+    try:
+        connection, stream = connect(state, connectTimeout)
+        try:
+            # a run takes as long as it takes, but the worker sends a heartbeat while it lasts
+            connection.settimeout(replyTimeout)
+            sendMessage(stream, {
+                'key': state['key'], 'command': 'run', 'identity': identity,
+                'argv': list(argv), 'cwd': os.getcwd(), 'deadline': time.time() + queueTimeout
+            })
+            while True:
+                message = receiveMessage(stream)
+                if 'output' in message:
+                    sys.stdout.write(message['output'])
+                    printed = True
+                    continue
+                if message.get('status') in ('queued', 'running'):
+                    continue
+                if message.get('status') == 'expired':
+                    print('uc2: resident worker busy, running the node in this process')
+                    return None
+                if message.get('status') != 'done':
+                    return None
+                return message.get('exitCode', 0)
+        finally:
+            stream.close()
+            connection.close()
+    except (OSError, EOFError, ValueError, KeyError):
+        if printed:
+            # the worker died during the run; the launcher runs the node itself, whose
+            # output files are replaced only when complete
+            print('uc2: resident worker failed, running the node in this process')
+        return None
+
+class ResidentWorker(object):
+    """ A class that runs the node for launchers, see the module description
+
+    Attributes
+    ----------
+    run : callable
+        run(argv) runs the node for a command line, printing its log
+    identity : str
+        see getIdentity
+    idleTimeout : float
+        seconds without a run after which serve() returns
+
+    Methods
+    -------
+    serve()
+        accepts runs until the idle timeout
+    start(command)
+        starts a worker process with command, detached from this process
+    """
+
+    defaultIdleTimeout = 600
+
+    # seconds between the checks of the idle timeout
+    pollInterval = 0.5
+
+    def __init__(self, run, identity, idleTimeout=None):
+        self.run = run
+        self.identity = identity
+        self.idleTimeout = idleTimeout if idleTimeout is not None else self.defaultIdleTimeout
+        self.key = None
+        self.runLock = threading.Lock()
+        self.exiting = False
+        self.lastRequestTime = time.monotonic()
+
+    @classmethod
+    def isRunning(cls):
+        state = readState()
+        if state is None:
+            return False
+        try:
+            connection, stream = connect(state, 2.0)
+            try:
+                sendMessage(stream, {'key': state['key'], 'command': 'ping'})
+                return receiveMessage(stream).get('status') == 'pong'
+            finally:
+                stream.close()
+                connection.close()
+        except (OSError, EOFError, ValueError, KeyError):
+            return False
+
+    @classmethod
+    def start(cls, command):
+        import subprocess
+
+        if sys.platform == 'win32':
+            options = {'creationflags': 0x00000008 | 0x00000200}  # DETACHED_PROCESS, CREATE_NEW_PROCESS_GROUP
+        else:
+            options = {'start_new_session': True}
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, close_fds=True, **options)
+
+    def writeState(self, stateFileName, port):
+        tempFileName = '{}.{}.tmp'.format(stateFileName, os.urandom(8).hex())
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0)
+        fileDescriptor = os.open(tempFileName, flags, 0o600)
+        try:
+            with os.fdopen(fileDescriptor, 'w') as f:
+                json.dump({'port': port, 'key': self.key, 'pid': os.getpid()}, f)
+            os.replace(tempFileName, stateFileName)
+        except BaseException:
+            try:
+                os.remove(tempFileName)
+            except OSError:
+                pass
+            raise
+
+    def removeState(self):
+        state = readState()
+        if state is not None and state.get('pid') == os.getpid():
+            try:
+                os.remove(getStateFileName())
+            except OSError:
+                pass
+
+    def serve(self):
+        if self.isRunning():
+            return
+        stateFileName = getStateFileName()
+        if stateFileName is None:
+            print('uc2: no private directory for the resident worker state, not serving')
+            return
+
+        self.key = os.urandom(32).hex()
+        self.lastRequestTime = time.monotonic()
+        handlers = []
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(8)
+            listener.settimeout(min(self.pollInterval, self.idleTimeout))
+            self.writeState(stateFileName, listener.getsockname()[1])
+
+            while not self.exiting:
+                try:
+                    connection, address = listener.accept()
+                except socket.timeout:
+                    handlers = [handler for handler in handlers if handler.is_alive()]
+                    if not handlers and time.monotonic() - self.lastRequestTime > self.idleTimeout:
+                        break
+                    continue
+                handler = threading.Thread(target=self.serveConnection, args=(connection,),
+                                           name='uc2-request', daemon=True)
+                handler.start()
+                handlers.append(handler)
+        finally:
+            self.removeState()
+            listener.close()
+            # the runs already queued are still done
+            for handler in handlers:
+                handler.join()
+
+    def serveConnection(self, connection):
+        # a launcher that stops reading or writing does not hold the worker up
+        connection.settimeout(replyTimeout)
+        try:
+            if not self.handle(connection):
+                self.exiting = True
+        except (OSError, EOFError, ValueError):
+            pass
+        finally:
+            connection.close()
+            self.lastRequestTime = time.monotonic()
+
+    def handle(self, connection):
+        """ Answers one request, returns False when the worker is to exit """
+        import hmac
+
+        stream = connection.makefile('rwb')
+        try:
+            request = receiveMessage(stream)
+            if not hmac.compare_digest(str(request.get('key', '')), self.key):
+                return True
+            if request.get('command') == 'ping':
+                sendMessage(stream, {'status': 'pong'})
+                return True
+            if request.get('identity') != self.identity:
+                sendMessage(stream, {'status': 'mismatch'})
+                return False
+
+            if not self.waitForTurn(request, stream):
+                return True
+            try:
+                exitCode = self.runRequest(request, stream)
+            finally:
+                self.runLock.release()
+            sendMessage(stream, {'status': 'done', 'exitCode': exitCode})
+            return True
+        finally:
+            stream.close()
+
+    def waitForTurn(self, request, stream):
+        """ Takes the run lock for a request, telling the launcher meanwhile that its run is queued
+
+        Returns False without the lock when the deadline of the request passes
+        first, the launcher then running the node itself.
+        """
+        deadline = request.get('deadline')
+        acquired = self.runLock.acquire(blocking=False)
+        while True:
+            if acquired:
+                if deadline is None or time.time() <= deadline:
+                    return True
+                self.runLock.release()
+            if deadline is not None and time.time() > deadline:
+                sendMessage(stream, {'status': 'expired'})
+                return False
+            sendMessage(stream, {'status': 'queued'})
+            timeout = heartbeatInterval if deadline is None else min(heartbeatInterval, max(deadline - time.time(), 0))
+            acquired = self.runLock.acquire(timeout=timeout)
+
+    def runRequest(self, request, stream):
+        """ Runs the node for a request, forwarding its output, and returns its exit code """
+        import contextlib
+
+        cwd = os.getcwd()
+        output = OutputForwarder(stream)
+        try:
+            os.chdir(request['cwd'])
+            with output, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                try:
+                    self.run(request['argv'])
+                except SystemExit as systemExit:
+                    # e.g. a command line error; it ends the run, not the worker
+                    code = systemExit.code
+                    if code is None:
+                        return 0
+                    if not isinstance(code, int):
+                        print(code, file=sys.stderr)
+                        return 1
+                    return code
+        finally:
+            os.chdir(cwd)
+            # what the run left loaded (modules, cached tables) is kept out of the garbage
+            # collections of later runs, which would otherwise scan it again and again
+            if hasattr(gc, 'freeze'):
+                gc.collect()
+                gc.freeze()
+        return 0
+
+class OutputForwarder(object):
+    """ A file-like object sending what is written to it to the launcher
+
+    While it is entered, a thread sends a heartbeat every heartbeatInterval
+    seconds, so the launcher can tell a long run from a dead worker. A
+    launcher that went away does not stop the run, which then finishes
+    without printing.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.broken = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self.beat, name='uc2-heartbeat', daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.heartbeat.join()
+        return False
+
+    def beat(self):
+        while not self.stopped.wait(heartbeatInterval):
+            self.send({'status': 'running'})
+
+    def send(self, message):
+        with self.lock:
+            if self.broken:
+                return
+            try:
+                sendMessage(self.stream, message)
+            except (OSError, ValueError):
+                self.broken = True
+
+    def write(self, text):
+        if text:
+            self.send({'output': text})
+        return len(text)
+
+    def flush(self):
+        pass
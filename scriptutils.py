@@ -1,9 +1,21 @@
 import os
+import io
 import sys
 import csv
 import json
-import six      # six is a Python 2 and 3 compatibility library for string instance checking
-                # see https://stackoverflow.com/questions/4843173/how-to-check-if-type-of-a-variable-is-string for a brief explanation
+import time
+import mmap
+import array
+import errno
+import collections
+import operator
+
+# The node is started as a new process for every workflow run, so modules that only some
+# runs need (pickle, hashlib, tempfile, locale, and numeric libraries, should they be used)
+# are imported in the functions that use them rather than here.
+
+# string types for instance checks (the six library was imported for this alone)
+stringTypes = (str,)
 
 """
 Classes
@@ -59,6 +71,32 @@ ColumnOptions
     children
         ResponseColumnOptions
 
+ColumnarTable
+    holds the ID column and a block of numeric columns of a table
+
+MappedTable
+    gives random access by ID to the rows of a memory-mapped table file
+
+ParallelTableParser
+    parses a table file in byte ranges in worker processes
+
+TableCache
+    keeps data parsed from table files on disk between runs
+
+TableWriter
+    writes a table file through a temporary file that replaces it when complete
+
+NpzTableWriter
+    writes a table as a NumPy .npz file with one typed array per column
+    (NullTableWriter writes nothing in its place)
+
+StageProfiler
+    measures wall time, CPU time, rows and peak RSS of the stages of a run
+    has ProfiledStage
+
+NullProfiler
+    stands in for StageProfiler when profiling is off, measures nothing
+
 """
 def generateAndStoreNodeResponse(nodeArgs, nodeResponseTemplate):    
     assert nodeArgs is not None, "nodeResponseTemplate must not be None"
@@ -66,7 +104,7 @@ def generateAndStoreNodeResponse(nodeArgs, nodeResponseTemplate):
         "NodeArgs (type {}) must be of 'NodeArgs' type".format(NodeArgs.__class__.__name__)
 
     assert nodeResponseTemplate is not None, "nodeResponseTemplate must not be None"
-    assert isinstance(nodeResponseTemplate, six.string_types), \
+    assert isinstance(nodeResponseTemplate, stringTypes), \
         "nodeResponseTemplate (type {}) must be of 'String' type".format(nodeResponseTemplate.__class__.__name__)
     if (len(nodeResponseTemplate) == 0): raise ValueError("nodeResponseTemplate cannot be an empty String")
     assert ('$CWFID$' in nodeResponseTemplate), "nodeResponseTemplate must have '$CWFID$' pattern" 
@@ -93,7 +131,18 @@ def generateAndStoreNodeResponse(nodeArgs, nodeResponseTemplate):
     
     return nodeResponse
 
-def getTableReader(nodeArgs, tableIndex):
+def getTableReader(nodeArgs, tableIndex, tableSource=None, columnIndices=None, rowFilter=None):
+    """ Returns the open table file, a csv reader of its rows and its column names
+
+    With a tableSource (see pdresult.PdResultSource), the table is read from it
+    rather than from its DataFile; columnIndices then lists the columns the
+    caller uses, the source may leave the others empty. With a rowFilter (see
+    joinengines.RowFilter), the reader only yields the rows it keeps; a
+    tableSource may test them itself, e.g. in a query.
+    """
+    if tableSource is not None:
+        return tableSource.getTableReader(nodeArgs, tableIndex, columnIndices, rowFilter)
+
     assert nodeArgs is not None, "nodeResponseTemplate must not be None"
     assert isinstance(nodeArgs, NodeArgs), \
         "NodeArgs (type {}) must be of 'NodeArgs' type".format(NodeArgs.__class__.__name__)
@@ -113,7 +162,15 @@ def getTableReader(nodeArgs, tableIndex):
         inTableHeader = inTableFile.__next__()
     else:
         inTableHeader = inTableFile.next()
-     
+
+    inTableColumnNames = validateTableHeader(nodeArgs, tableIndex, inTableHeader)
+    if rowFilter is not None:
+        inTableReader = rowFilter.filterRows(inTableReader)
+
+    return inTableFile, inTableReader, inTableColumnNames
+
+def validateTableHeader(nodeArgs, tableIndex, inTableHeader):
+    """ Checks the header line of a table file against the table's ColumnDescriptions and returns the column names """
     # verify that there are as many table column names as the header fields
     inTableColumnNames = [x.strip().replace('"', '') for x in inTableHeader.split('\t')]
     assert (len(inTableColumnNames) == len(nodeArgs.Tables[tableIndex].ColumnDescriptions)), \
@@ -128,8 +185,1361 @@ def getTableReader(nodeArgs, tableIndex):
             "Table column name {} does not match the one in the header {}". \
             format(ct, inTableColumnName)
         columnIndex = columnIndex+1
-    
-    return inTableFile, inTableReader, inTableColumnNames
+
+    return inTableColumnNames
+
+# array typecodes of the supported abundance value types
+abundanceTypecodes = {
+    'float64': 'd',
+    'float32': 'f',
+}
+
+NAN = float('nan')
+
+def parseAbundance(value):
+    """ Converts an abundance cell to float; empty and non-numeric cells become NaN """
+    try:
+        return float(value)
+    except ValueError:
+        return NAN
+
+def parseAbundanceList(values, count=True):
+    """ Converts a sequence of abundance cells to a list of floats; empty and non-numeric cells become NaN
+
+    Empty cells, the usual missing values, are told apart without float()
+    raising for them, which is several times faster than parseAbundance on
+    typical abundance columns; only a non-numeric cell makes the whole
+    sequence go through the slow path, which counts such cells in
+    abundanceErrors. Cells may also be floats already (see pdresult).
+    With count False nothing is counted, for cells that are parsed again
+    when their row is kept (see joinengines.ValidValuesPredicate).
+    """
+    if count:
+        abundanceErrors.cells += len(values)
+    try:
+        return [float(v) if v != '' else NAN for v in values]
+    except ValueError:
+        result = []
+        for v in values:
+            try:
+                result.append(float(v) if v != '' else NAN)
+            except ValueError:
+                if count:
+                    abundanceErrors.add(v)
+                result.append(NAN)
+        return result
+
+class AbundanceErrors(object):
+    """ A class that counts the non-numeric cells parseAbundanceList read as missing values
+
+    Such cells are rare in Proteome Discoverer exports; many of them mean the
+    values are not read as intended, e.g. written with decimal commas. The
+    module's abundanceErrors counts those of the running process; worker
+    processes send back what they counted with getStateSince.
+
+    Attributes
+    ----------
+    cells : int
+        cells parsed
+    errors : int
+        non-numeric cells among them
+    examples : list
+        the first maxExamples different values of those cells
+    """
+
+    maxExamples = 3
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cells = 0
+        self.errors = 0
+        self.examples = []
+
+    def add(self, value):
+        self.errors += 1
+        if len(self.examples) < self.maxExamples and value not in self.examples:
+            self.examples.append(value)
+
+    def getState(self):
+        return self.cells, self.errors, list(self.examples)
+
+    def getStateSince(self, state):
+        """ Returns the state of what was counted after getState returned state """
+        cells, errors, examples = state
+        return self.cells - cells, self.errors - errors, self.examples[len(examples):]
+
+    def addState(self, state):
+        cells, errors, examples = state
+        self.cells += cells
+        self.errors += errors
+        for value in examples:
+            if len(self.examples) < self.maxExamples and value not in self.examples:
+                self.examples.append(value)
+
+    def getShare(self):
+        return self.errors / self.cells if self.cells else 0.0
+
+    def summary(self):
+        return '{} of {} abundance cells ({:.2%}) are not numbers and were read as missing values, e.g. {}'.format(
+            self.errors, self.cells, self.getShare(), ', '.join(repr(value) for value in self.examples))
+
+abundanceErrors = AbundanceErrors()
+
+def parseAbundances(values, typecode='d'):
+    """ Converts a sequence of abundance cells to an array of the given typecode """
+    return array.array(typecode, parseAbundanceList(values))
+
+def formatAbundances(values):
+    """ Converts an array of abundances back to strings; NaN becomes an empty string
+
+    float32 values are written with the 9 significant digits that identify them,
+    float64 values with the shortest repr that does.
+    """
+    if values.typecode == 'f':
+        return ['' if v != v else '%.9g' % v for v in values]
+    return ['' if v != v else repr(v) for v in values]
+
+def formatAbundanceRows(abundanceRows, width):
+    """ Formats the abundance arrays of many rows in one step, returns a list of string lists """
+    if not abundanceRows: return []
+    values = array.array(abundanceRows[0].typecode)
+    for abundances in abundanceRows:
+        values.extend(abundances)
+    texts = formatAbundances(values)
+    return [texts[start:start + width] for start in range(0, len(texts), width)] if width else [[] for a in abundanceRows]
+
+def readColumnarTable(nodeArgs, tableIndex, idColumnIndex, valueColumnIndices, typecode='d', cache=None,
+                      rowFilter=None, tableSource=None, workers=None):
+    """ Reads the ID column and the given numeric columns of a table into a ColumnarTable
+
+    Only the projected columns are converted and kept, the other cells of a row
+    are dropped as soon as the row is read. When an ID occurs more than once,
+    the first row with that ID is kept. With a rowFilter (see
+    joinengines.RowFilter), the rows it drops are not kept. With a TableCache,
+    a table parsed by an earlier run with the same parameters is loaded from
+    the cache, together with the state of the rowFilter. With a tableSource,
+    the table is read from it, see getTableReader. Otherwise, with more than
+    one of workers, its file is parsed by a ParallelTableParser.
+    """
+    assert typecode in abundanceTypecodes.values(), "invalid typecode {}".format(typecode)
+
+    if cache is not None:
+        # the non-numeric cells are counted again for a table loaded from the cache
+        parameters = ('ColumnarTable', idColumnIndex, list(valueColumnIndices), typecode, 'abundanceErrors')
+        if rowFilter is not None:
+            parameters += (rowFilter.getKey(),)
+
+        built = []
+        def build():
+            built.append(True)
+            errorState = abundanceErrors.getState()
+            table = readColumnarTable(nodeArgs, tableIndex, idColumnIndex, valueColumnIndices, typecode,
+                                      rowFilter=rowFilter, tableSource=tableSource, workers=workers)
+            return table, (rowFilter.getState() if rowFilter is not None else None), \
+                abundanceErrors.getStateSince(errorState)
+        table, filterState, tableErrorState = cache.getOrBuild(nodeArgs, tableIndex, parameters, build)
+        if rowFilter is not None:
+            rowFilter.setState(filterState)
+        if not built:
+            abundanceErrors.addState(tableErrorState)
+        return table
+
+    if tableSource is None and workers is not None and workers > 1:
+        with ParallelTableParser(nodeArgs, tableIndex, workers) as parser:
+            return parser.readColumnarTable(idColumnIndex, valueColumnIndices, typecode, rowFilter)
+
+    columnIndices = [idColumnIndex] + list(valueColumnIndices)
+    if rowFilter is not None:
+        columnIndices += rowFilter.getColumnIndices()
+    inTableFile, inTableReader, inTableHeader = getTableReader(
+        nodeArgs, tableIndex, tableSource, columnIndices, rowFilter)
+    table = ColumnarTable(
+        [inTableHeader[x] for x in valueColumnIndices], typecode)
+    try:
+        table.appendRows(inTableReader, idColumnIndex, valueColumnIndices)
+    finally:
+        inTableFile.close()
+    return table
+
+class ColumnarTable(object):
+    """ A class that holds the ID column and a block of numeric columns of a table
+
+    The values are stored row after row in one flat array, which takes a
+    fraction of the memory of rows of Python strings.
+
+    Attributes
+    ----------
+    columnNames : list
+        names of the numeric columns
+    width : int
+        number of numeric columns
+    ids : array
+        IDs of the rows (typecode 'q')
+    values : array
+        numeric values, row-major, NaN for missing values (typecode 'd' or 'f')
+    rowIndex : dict
+        maps an ID to its row number
+    """
+    def __init__(self, columnNames, typecode='d'):
+        self.columnNames = list(columnNames)
+        self.width = len(self.columnNames)
+        self.ids = array.array('q')
+        self.values = array.array(typecode)
+        self.rowIndex = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # the row index is rebuilt on unpickling, which is faster than unpickling it
+        state = dict(self.__dict__)
+        del state['rowIndex']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rowIndex = dict(zip(self.ids, range(len(self.ids))))
+
+    def appendRows(self, rows, idColumnIndex, valueColumnIndices):
+        """ Appends the ID and the given numeric columns of table rows, skipping IDs already in the table """
+        if len(valueColumnIndices) == 0:
+            project = lambda row: ()
+        elif len(valueColumnIndices) == 1:
+            project = lambda row, index=valueColumnIndices[0]: (row[index],)
+        else:
+            project = operator.itemgetter(*valueColumnIndices)
+
+        rowIndex = self.rowIndex
+        ids = self.ids
+        values = self.values
+        for row in rows:
+            ID = int(row[idColumnIndex])
+            if ID in rowIndex: continue
+            rowIndex[ID] = len(ids)
+            ids.append(ID)
+            values.extend(parseAbundanceList(project(row)))
+
+    def extend(self, ids, values, skipIDs=()):
+        """ Appends the rows of another part of the table, given by their unique ids and row-major values
+
+        Rows whose ID is already in the table, or in skipIDs, are left out.
+        """
+        rowIndex = self.rowIndex
+        start = len(self.ids)
+        if rowIndex.keys().isdisjoint(ids) and (not skipIDs or skipIDs.isdisjoint(ids)):
+            self.ids.extend(ids)
+            self.values.extend(values)
+            rowIndex.update(zip(ids, range(start, start + len(ids))))
+            return
+        width = self.width
+        for rowNumber, ID in enumerate(ids):
+            if ID in rowIndex or ID in skipIDs: continue
+            rowIndex[ID] = len(self.ids)
+            self.ids.append(ID)
+            self.values.extend(values[rowNumber * width:(rowNumber + 1) * width])
+
+    def getRowNumber(self, ID):
+        """ Returns the row number of an ID (int or str), or None if it is not in the table """
+        return self.rowIndex.get(int(ID))
+
+    def getValues(self, rowNumber):
+        """ Returns the numeric values of a row as an array """
+        start = rowNumber * self.width
+        return self.values[start:start + self.width]
+
+class MappedTable(object):
+    """ A class that gives random access by ID to the rows of a table file
+
+    The file is memory-mapped and scanned once to record the byte offset of
+    every row, keyed by the integer value of its ID column; rows spanning
+    several lines because of quoted line breaks are handled. The bytes of a
+    row are only copied and decoded when the row is asked for, so even
+    multi-GB files cost little more than their index in memory. When an ID
+    occurs more than once, the first row with that ID is returned.
+
+    Attributes
+    ----------
+    header : list
+        column names, validated against the table's ColumnDescriptions
+    offsets : array
+        byte offsets of the rows in file order, followed by the file size (typecode 'q')
+    rowIndex : dict
+        maps an ID to the number of its row in offsets
+
+    Methods
+    -------
+    getRawRow(ID) -> memoryview
+        bytes of a row, without copying them
+    getRow(ID) -> list
+        decoded row fields
+    """
+    def __init__(self, nodeArgs, tableIndex, idColumnIndex, cache=None):
+        import locale
+
+        # same default encoding as the text files opened by getTableReader
+        self.encoding = locale.getpreferredencoding(False)
+        self.idColumnIndex = idColumnIndex
+        self.offsets = array.array('q')
+        self.rowIndex = {}
+
+        self.file = open(nodeArgs.Tables[tableIndex].DataFile, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+            if cache is None:
+                headerEnd = self.buildIndex()
+            else:
+                # the index is cached as arrays, the ID to row number dict is rebuilt from them
+                headerEnd, self.offsets, indexIDs, indexRows = cache.getOrBuild(
+                    nodeArgs, tableIndex, ('MappedTable', idColumnIndex), self.getIndexState)
+                self.rowIndex = dict(zip(indexIDs, indexRows))
+            self.header = validateTableHeader(
+                nodeArgs, tableIndex, self.map[0:headerEnd].decode(self.encoding).rstrip('\r\n'))
+        except:
+            self.close()
+            raise
+
+    def buildIndex(self):
+        """ Records the row offsets and returns the offset of the first row after the header """
+        buffer = self.map
+        size = len(buffer)
+        offsets = self.offsets
+        rowIndex = self.rowIndex
+        idColumnIndex = self.idColumnIndex
+
+        # the searches are bounded to the row, so only its ID field is copied out of the map
+        start = 0
+        headerEnd = None
+        while start < size:
+            end = buffer.find(b'\n', start)
+            end = size if end < 0 else end + 1
+            firstQuote = buffer.find(b'"', start, end)
+            if firstQuote >= 0:
+                # follow line breaks inside quoted fields, counting the quotes line by line
+                quoted = False
+                quote = firstQuote
+                while True:
+                    while quote >= 0:
+                        quoted = not quoted
+                        quote = buffer.find(b'"', quote + 1, end)
+                    if not quoted or end >= size: break
+                    lineEnd = buffer.find(b'\n', end)
+                    lineEnd = size if lineEnd < 0 else lineEnd + 1
+                    quote = buffer.find(b'"', end, lineEnd)
+                    end = lineEnd
+
+            if headerEnd is None:
+                headerEnd = end
+            else:
+                fieldStart = start
+                for column in range(idColumnIndex):
+                    fieldStart = buffer.find(b'\t', fieldStart, end) + 1
+                    assert fieldStart, "row at byte {} has no column {}".format(start, idColumnIndex)
+                fieldEnd = buffer.find(b'\t', fieldStart, end)
+                if fieldEnd < 0:
+                    fieldEnd = end
+                # int() ignores the line break after an ID in the last column
+                ID = int(buffer[fieldStart:fieldEnd] if firstQuote < 0 or firstQuote >= fieldEnd
+                         else self.decodeRow(start, end)[idColumnIndex])
+                if ID not in rowIndex:
+                    rowIndex[ID] = len(offsets)
+                offsets.append(start)
+            start = end
+
+        offsets.append(size)
+        return size if headerEnd is None else headerEnd
+
+    def getIndexState(self):
+        headerEnd = self.buildIndex()
+        return (headerEnd, self.offsets,
+                array.array('q', self.rowIndex.keys()), array.array('q', self.rowIndex.values()))
+
+    def decodeRow(self, start, end):
+        text = self.map[start:end].decode(self.encoding)
+        return next(csv.reader(io.StringIO(text, newline=None), delimiter='\t'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, ID):
+        return int(ID) in self.rowIndex
+
+    def getRawRow(self, ID):
+        rowNumber = self.rowIndex.get(int(ID))
+        if rowNumber is None: return None
+        return self.view[self.offsets[rowNumber]:self.offsets[rowNumber + 1]]
+
+    def getRow(self, ID):
+        rowNumber = self.rowIndex.get(int(ID))
+        if rowNumber is None: return None
+        return self.decodeRow(self.offsets[rowNumber], self.offsets[rowNumber + 1])
+
+    def close(self):
+        if getattr(self, 'view', None) is not None:
+            self.view.release()
+            self.view = None
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+def readTableRange(fileName, start, end, encoding):
+    """ Returns a csv reader of the rows in a byte range of a table file, which must start and end at row ends """
+    with open(fileName, 'rb') as inTableFile:
+        inTableFile.seek(start)
+        text = inTableFile.read(end - start).decode(encoding)
+    # newline=None translates line ends like the text files opened by getTableReader
+    return csv.reader(io.StringIO(text, newline=None), delimiter='\t')
+
+def countRangeQuotes(task):
+    """ Returns the number of quote characters in a byte range of a file; runs in a ParallelTableParser worker """
+    fileName, start, end = task
+    count = 0
+    with open(fileName, 'rb') as inTableFile:
+        inTableFile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = inTableFile.read(min(remaining, ParallelTableParser.blockBytes))
+            if not block: break
+            count += block.count(b'"')
+            remaining -= len(block)
+    return count
+
+def parseTableRange(task):
+    """ Returns the rows of a byte range of a table file, with the cells of columns
+    not in columnIndices (None for all) empty; runs in a ParallelTableParser worker """
+    fileName, start, end, encoding, columnIndices = task
+    rows = readTableRange(fileName, start, end, encoding)
+    if columnIndices is None:
+        return list(rows)
+    columnIndices = sorted(set(columnIndices))
+    result = []
+    for row in rows:
+        projected = [''] * len(row)
+        for index in columnIndices:
+            projected[index] = row[index]
+        result.append(projected)
+    return result
+
+def parseColumnarRange(task):
+    """ Returns the ids and values of a byte range of a table file, as readColumnarTable would read them,
+    the state of the rowFilter (or None) and that of the abundanceErrors of the range; runs in a
+    ParallelTableParser worker """
+    fileName, start, end, encoding, idColumnIndex, valueColumnIndices, typecode, rowFilter = task
+    errorState = abundanceErrors.getState()
+    rows = readTableRange(fileName, start, end, encoding)
+    if rowFilter is not None:
+        rows = rowFilter.filterRows(rows)
+    table = ColumnarTable([], typecode)
+    table.appendRows(rows, idColumnIndex, valueColumnIndices)
+    return table.ids, table.values, (rowFilter.getState() if rowFilter is not None else None), \
+        abundanceErrors.getStateSince(errorState)
+
+class ParallelTableParser(object):
+    """ A class that parses a table file in byte ranges in worker processes
+
+    The rows of the file, after its header, are split into byte ranges of
+    about the same size, rangesPerWorker of them per worker, but none smaller
+    than minRangeBytes. A range boundary is moved forward to the next line
+    break that ends a row: Proteome Discoverer quotes the cells holding tabs,
+    line breaks or quotes, and doubles the quotes inside them, so a line break
+    is inside a quoted cell exactly when an odd number of quote characters
+    precedes it. The workers first count the quotes of every range, so no
+    process has to scan the whole file, then parse the aligned ranges with csv
+    like getTableReader does. The results are put back together in file
+    order. A file of a single range is parsed without starting workers.
+
+    Attributes
+    ----------
+    fileName : str
+        the table file
+    encoding : str
+        its encoding, the default one of text files, like getTableReader
+    header : list
+        column names, validated against the table's ColumnDescriptions
+    ranges : list
+        (start, end) byte ranges of the rows, in file order
+
+    Methods
+    -------
+    iterRows(columnIndices=None) -> iterator of row lists
+        the rows in file order; cells of columns not in columnIndices (None for all) are empty
+    readColumnarTable(idColumnIndex, valueColumnIndices, typecode='d', rowFilter=None) -> ColumnarTable
+        like scriptutils.readColumnarTable
+    """
+
+    # ranges per worker, more ranges even out the load between workers
+    rangesPerWorker = 4
+
+    # smallest range worth sending to a worker (bytes)
+    minRangeBytes = 4 * 1024 * 1024
+
+    # bytes read at a time when counting quotes
+    blockBytes = 1024 * 1024
+
+    def __init__(self, nodeArgs, tableIndex, workers=None):
+        import locale
+        import multiprocessing
+
+        self.fileName = nodeArgs.Tables[tableIndex].DataFile
+        self.encoding = locale.getpreferredencoding(False)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = None
+
+        with open(self.fileName, 'rb') as inTableFile:
+            headerLine = self.readRow(inTableFile)
+            headerEnd = inTableFile.tell()
+            size = os.fstat(inTableFile.fileno()).st_size
+        self.header = validateTableHeader(nodeArgs, tableIndex, headerLine.decode(self.encoding).rstrip('\r\n'))
+
+        rangeCount = max(1, min(self.workers * self.rangesPerWorker, (size - headerEnd) // self.minRangeBytes))
+        if rangeCount == 1:
+            self.ranges = [(headerEnd, size)] if size > headerEnd else []
+        else:
+            self.pool = multiprocessing.Pool(self.workers)
+            try:
+                self.ranges = self.alignRanges(headerEnd, size, rangeCount)
+            except:
+                self.close()
+                raise
+
+    @classmethod
+    def readRow(cls, inTableFile):
+        """ Reads the lines of the next row of a binary file, following line breaks inside quoted cells """
+        row = inTableFile.readline()
+        while row.count(b'"') % 2:
+            line = inTableFile.readline()
+            if not line: break
+            row += line
+        return row
+
+    def alignRanges(self, start, end, rangeCount):
+        """ Returns the ranges between start and end, their boundaries moved to row ends """
+        boundaries = [start + (end - start) * k // rangeCount for k in range(rangeCount + 1)]
+        quoteCounts = self.pool.map(countRangeQuotes, [
+            (self.fileName, boundaries[k], boundaries[k + 1]) for k in range(rangeCount)])
+
+        aligned = [start]
+        quoteCount = 0
+        with open(self.fileName, 'rb') as inTableFile:
+            for k in range(1, rangeCount):
+                # the parity of the quotes between the header and the boundary tells
+                # whether the boundary is inside a quoted cell
+                quoteCount += quoteCounts[k - 1]
+                boundary = boundaries[k]
+                if boundary <= aligned[-1]: continue
+                inTableFile.seek(boundary)
+                quoted = quoteCount % 2
+                while True:
+                    line = inTableFile.readline()
+                    if not line: break
+                    if line.count(b'"') % 2:
+                        quoted = not quoted
+                    if not quoted: break
+                boundary = inTableFile.tell()
+                if aligned[-1] < boundary < end:
+                    aligned.append(boundary)
+        aligned.append(end)
+        return list(zip(aligned[:-1], aligned[1:]))
+
+    def runTasks(self, function, tasks):
+        """ Returns an iterator of the results of function for tasks, in their order """
+        if self.pool is None:
+            return (function(task) for task in tasks)
+        return self.pool.imap(function, tasks)
+
+    def iterRows(self, columnIndices=None):
+        for rows in self.runTasks(parseTableRange, [
+                (self.fileName, start, end, self.encoding, columnIndices) for start, end in self.ranges]):
+            for row in rows:
+                yield row
+
+    def readColumnarTable(self, idColumnIndex, valueColumnIndices, typecode='d', rowFilter=None):
+        """ Reads the ID column and the given numeric columns into a ColumnarTable, see scriptutils.readColumnarTable
+
+        The workers filter and project the rows of their ranges; an ID a worker
+        finds that an earlier range already kept or dropped is then left out,
+        as a serial read would. The rowFilter, which must not have read rows yet,
+        gets the states of the workers added up; its counts equal those of a
+        serial read unless IDs repeat.
+        """
+        assert typecode in abundanceTypecodes.values(), "invalid typecode {}".format(typecode)
+
+        table = ColumnarTable([self.header[x] for x in valueColumnIndices], typecode)
+        if self.pool is None:
+            for start, end in self.ranges:
+                rows = readTableRange(self.fileName, start, end, self.encoding)
+                if rowFilter is not None:
+                    rows = rowFilter.filterRows(rows)
+                table.appendRows(rows, idColumnIndex, valueColumnIndices)
+            return table
+
+        for ids, values, filterState, errorState in self.runTasks(parseColumnarRange, [
+                (self.fileName, start, end, self.encoding, idColumnIndex, list(valueColumnIndices), typecode, rowFilter)
+                for start, end in self.ranges]):
+            table.extend(ids, values, rowFilter.rejectedIDs if rowFilter is not None else ())
+            if rowFilter is not None:
+                rowFilter.addState(filterState)
+            abundanceErrors.addState(errorState)
+        return table
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+class TableCache(object):
+    """ A class that keeps data parsed from table files on disk between runs
+
+    Entries are pickled to files in cacheDir. The key of an entry combines the
+    fingerprint of the table file (size, modification time and a hash of its
+    header line) with the table's column names and the parameters the data
+    was parsed with, so a changed file or a different parsing simply misses
+    the cache. When the entries exceed maxBytes, the least recently used ones
+    are removed. With a tableSource (see getTableReader), its fingerprint of
+    the table replaces that of the table file.
+
+    Attributes
+    ----------
+    cacheDir : str
+        folder holding the cache entries
+    maxBytes : int
+        size limit of all the entries together
+    tableSource : object
+        source the tables are read from, or None for their files
+    hits, misses : int
+        number of lookups that found or did not find an entry
+    memoryBytes : int
+        class attribute; when above 0, the entries this process loads or stores
+        are also kept in memory, for later runs in the same process (the
+        resident worker, see residentworker), up to this size of their files
+    """
+
+    suffix = '.cache.pkl'
+
+    memoryBytes = 0
+    # key -> (value, size of its file), least recently used first, shared by all instances
+    memoryEntries = collections.OrderedDict()
+
+    def __init__(self, cacheDir, maxBytes, tableSource=None):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.tableSource = tableSource
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    @classmethod
+    def getFingerprint(cls, fileName):
+        import hashlib
+
+        stat = os.stat(fileName)
+        with open(fileName, 'rb') as f:
+            header = f.readline()
+        return (stat.st_size, getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9)),
+                hashlib.sha1(header).hexdigest())
+
+    def getKey(self, nodeArgs, tableIndex, parameters):
+        import hashlib
+
+        table = nodeArgs.Tables[tableIndex]
+        if self.tableSource is not None:
+            fingerprint = self.tableSource.getFingerprint(nodeArgs, tableIndex)
+        else:
+            fingerprint = self.getFingerprint(table.DataFile)
+        keyData = repr((fingerprint,
+                        [c.ColumnName for c in table.ColumnDescriptions], parameters))
+        return hashlib.sha1(keyData.encode('utf-8')).hexdigest()
+
+    def getFileName(self, key):
+        return os.path.join(self.cacheDir, key + self.suffix)
+
+    def load(self, key):
+        import pickle
+
+        fileName = self.getFileName(key)
+        entry = self.memoryEntries.get(key)
+        if entry is not None:
+            self.memoryEntries.move_to_end(key)
+            value = entry[0]
+        else:
+            try:
+                with open(fileName, 'rb') as f:
+                    value = pickle.load(f)
+            except (IOError, OSError):
+                return None
+            except Exception:
+                # truncated or otherwise unreadable entry
+                self.remove(fileName)
+                return None
+            self.keepInMemory(key, value, os.path.getsize(fileName))
+        # the modification time orders the entries for eviction
+        try:
+            os.utime(fileName, None)
+        except OSError:
+            pass
+        return value
+
+    def store(self, key, value):
+        import pickle
+        import tempfile
+
+        f = tempfile.NamedTemporaryFile(dir=self.cacheDir, prefix='tmp_', delete=False)
+        try:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.replace(f.name, self.getFileName(key))
+        except:
+            f.close()
+            self.remove(f.name)
+            raise
+        self.keepInMemory(key, value, os.path.getsize(self.getFileName(key)))
+        self.evict(keep=self.getFileName(key))
+
+    @classmethod
+    def keepInMemory(cls, key, value, size):
+        """ Keeps an entry in memory, removing the least recently used ones above memoryBytes """
+        if size > cls.memoryBytes:
+            return
+        cls.memoryEntries[key] = (value, size)
+        cls.memoryEntries.move_to_end(key)
+        totalBytes = sum(entrySize for entryValue, entrySize in cls.memoryEntries.values())
+        while totalBytes > cls.memoryBytes:
+            entryValue, entrySize = cls.memoryEntries.popitem(last=False)[1]
+            totalBytes -= entrySize
+
+    def getOrBuild(self, nodeArgs, tableIndex, parameters, build):
+        """ Returns the cached value for a table and parameters, or builds it with build() and caches it """
+        key = self.getKey(nodeArgs, tableIndex, parameters)
+        value = self.load(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = build()
+        self.store(key, value)
+        return value
+
+    def getEntries(self):
+        """ Returns (modification time, size, file name) of the entries, oldest first """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith(self.suffix): continue
+            fileName = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(fileName)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fileName))
+        entries.sort()
+        return entries
+
+    def evict(self, keep=None):
+        entries = self.getEntries()
+        totalBytes = sum(size for mtime, size, fileName in entries)
+        for mtime, size, fileName in entries:
+            if totalBytes <= self.maxBytes: break
+            if fileName == keep: continue
+            self.remove(fileName)
+            totalBytes -= size
+
+    def clear(self):
+        """ Invalidates the cache by removing all its entries """
+        self.memoryEntries.clear()
+        for mtime, size, fileName in self.getEntries():
+            self.remove(fileName)
+
+    @classmethod
+    def remove(cls, fileName):
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+class TableWriter(object):
+    """ A class that writes a table file for a node response
+
+    Rows go through a large write buffer into a temporary file next to the
+    target file. commit() flushes and closes it and renames it to the target
+    file, so the target is either absent, the previous version, or complete;
+    abort() removes it. Used as a context manager it commits on success and
+    aborts on an exception.
+
+    The file is tab-separated, with all text values quoted. writeNumberRows
+    writes rows that end with numbers formatted by formatAbundanceRows, which
+    are not quoted, so that Proteome Discoverer reads them as numbers and an
+    empty cell as a missing value.
+    """
+
+    bufferSize = 4 * 1024 * 1024
+
+    def __init__(self, fileName, header):
+        self.fileName = fileName
+        fileDescriptor, self.tempFileName = self.createTempFile(fileName)
+        self.file = os.fdopen(fileDescriptor, 'w', self.bufferSize)
+        self.writer = csv.writer(self.file, delimiter='\t', quoting=csv.QUOTE_NONNUMERIC)
+        self.rowCount = 0
+        self.writer.writerow(header)
+
+    @classmethod
+    def createTempFile(cls, fileName):
+        """ Creates a new file next to fileName like tempfile.mkstemp, returns its descriptor and name
+
+        Every run writes its tables through this, and the tempfile module alone
+        takes several ms to import. Unlike that of mkstemp, the file gets the
+        permissions open() would give it, 0o666 less the umask, as it replaces
+        an output file.
+        """
+        prefix = os.path.join(os.path.dirname(os.path.abspath(fileName)), os.path.basename(fileName))
+        flags = os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        for attempt in range(1000):
+            tempFileName = '{}.{}.{}.tmp'.format(prefix, os.getpid(), attempt)
+            try:
+                return os.open(tempFileName, flags, 0o666), tempFileName
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        raise IOError("No free temporary file name for {}".format(fileName))
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rowCount += 1
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+        self.rowCount += len(rows)
+
+    def writeNumberRows(self, rows, numberRows):
+        """ Writes rows of text values, each followed by the formatted numbers of a list of numberRows """
+        # quoted like the csv writer quotes text values: in double quotes, which are doubled
+        lines = []
+        for row, numbers in zip(rows, numberRows):
+            lines.append('\t'.join(
+                ['"' + value.replace('"', '""') + '"' for value in row] + numbers))
+        lines.append('')
+        self.file.write(self.writer.dialect.lineterminator.join(lines))
+        self.rowCount += len(rows)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tempFileName, self.fileName)
+
+    def abort(self):
+        self.file.close()
+        TableCache.remove(self.tempFileName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.commit()
+        else:
+            self.abort()
+
+class NpzTableWriter(object):
+    """ A class that writes a table as a NumPy .npz file, one typed array per column
+
+    numpy.load(fileName) returns the columns without parsing text; numpy is
+    not needed to write the file, and readNpz reads it without numpy. Layout,
+    for n rows:
+
+        <name>.npy for each of the columns
+            int64 (typecode 'q') or float (typecode 'd', 'f') columns: shape (n,)
+            text columns (typecode 'U'): fixed-width unicode '<U{width}', shape (n,),
+            width being that of the longest value
+        <blockName>.npy
+            the values of the block of numeric columns: float64 or float32, shape
+            (n, number of block columns), row-major, NaN for missing values
+        <blockName> columns.npy
+            the names of the block columns: unicode, shape (number of block columns,)
+
+    With compress the members are deflated like numpy.savez_compressed does,
+    otherwise stored like numpy.savez.
+
+    Rows are spooled to one temporary file per column as they come, so the
+    table is never held in memory; commit() builds the .npz file from them
+    next to the target file and renames it to the target file. Used as a
+    context manager it commits on success and aborts on an exception, like
+    TableWriter.
+
+    Attributes
+    ----------
+    columns : list
+        (name, typecode) of the single columns
+    blockName : str
+        name of the block of numeric columns
+    blockColumnNames : list
+        names of the block columns
+    blockTypecode : str
+        'd' or 'f'
+    rowCount : int
+        number of rows written
+
+    Methods
+    -------
+    writeRows(rows, blockRows)
+        writes rows of single column values, as text, and the arrays of their block values
+    """
+
+    chunkRows = 65536
+
+    def __init__(self, fileName, columns, blockName, blockColumnNames, blockTypecode='d', compress=False):
+        assert blockTypecode in abundanceTypecodes.values(), "invalid typecode {}".format(blockTypecode)
+        for name, typecode in columns:
+            assert typecode in ('q', 'd', 'f', 'U'), "invalid typecode {} of column {}".format(typecode, name)
+
+        self.fileName = fileName
+        self.columns = list(columns)
+        self.blockName = blockName
+        self.blockColumnNames = list(blockColumnNames)
+        self.blockTypecode = blockTypecode
+        self.compress = compress
+        self.rowCount = 0
+        # longest value of each text column, in characters
+        self.widths = [0] * len(self.columns)
+
+        self.spoolFiles = []
+        try:
+            for index in range(len(self.columns) + 1):
+                fileDescriptor, spoolFileName = TableWriter.createTempFile(fileName)
+                self.spoolFiles.append((os.fdopen(fileDescriptor, 'w+b', TableWriter.bufferSize), spoolFileName))
+        except:
+            self.abort()
+            raise
+
+    def writeRows(self, rows, blockRows):
+        for index, (name, typecode) in enumerate(self.columns):
+            spoolFile = self.spoolFiles[index][0]
+            cells = [row[index] for row in rows]
+            if typecode == 'U':
+                if cells:
+                    self.widths[index] = max(self.widths[index], max(len(value) for value in cells))
+                text = ''.join(value + '\n' for value in cells)
+                assert text.count('\n') == len(cells), "line break in a value of column {}".format(name)
+                spoolFile.write(text.encode('utf-8'))
+            elif typecode == 'q':
+                array.array(typecode, [int(value) for value in cells]).tofile(spoolFile)
+            else:
+                array.array(typecode, parseAbundanceList(cells)).tofile(spoolFile)
+
+        spoolFile = self.spoolFiles[-1][0]
+        width = len(self.blockColumnNames)
+        for values in blockRows:
+            assert len(values) == width, "{} values in a row of {} block columns".format(len(values), width)
+            if values.typecode != self.blockTypecode:
+                values = array.array(self.blockTypecode, values)
+            values.tofile(spoolFile)
+        self.rowCount += len(rows)
+
+    @classmethod
+    def getHeader(cls, descr, shape):
+        """ Returns the header of a .npy file (format version 1.0) with an array of dtype descr and shape """
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(descr, repr(tuple(shape)))
+        # the header is padded with spaces so that the data starts at a multiple of 64 bytes
+        padding = 64 - (10 + len(header) + 1) % 64
+        header = (header + ' ' * (padding % 64) + '\n').encode('latin1')
+        return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header
+
+    @classmethod
+    def getDescr(cls, typecode, width=None):
+        if typecode == 'U':
+            return '<U{}'.format(max(width, 1))
+        byteOrder = '<' if sys.byteorder == 'little' else '>'
+        return byteOrder + {'q': 'i8', 'd': 'f8', 'f': 'f4'}[typecode]
+
+    def writeNumbers(self, member, spoolFile, typecode, shape):
+        member.write(self.getHeader(self.getDescr(typecode), shape))
+        spoolFile.seek(0)
+        while True:
+            data = spoolFile.read(TableWriter.bufferSize)
+            if not data:
+                break
+            member.write(data)
+
+    def writeTexts(self, member, lines, width, count):
+        width = max(width, 1)
+        member.write(self.getHeader(self.getDescr('U', width), (count,)))
+        chunk = []
+        for line in lines:
+            chunk.append(line.rstrip('\n').ljust(width, '\0'))
+            if len(chunk) == self.chunkRows:
+                member.write(''.join(chunk).encode('utf-32-le'))
+                chunk = []
+        member.write(''.join(chunk).encode('utf-32-le'))
+
+    def commit(self):
+        import zipfile
+
+        fileDescriptor, tempFileName = TableWriter.createTempFile(self.fileName)
+        os.close(fileDescriptor)
+        try:
+            compression = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+            with zipfile.ZipFile(tempFileName, 'w', compression, allowZip64=True) as archive:
+                for index, (name, typecode) in enumerate(self.columns):
+                    spoolFile = self.spoolFiles[index][0]
+                    spoolFile.flush()
+                    with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+                        if typecode == 'U':
+                            spoolFile.seek(0)
+                            lines = io.TextIOWrapper(spoolFile, encoding='utf-8', newline='\n')
+                            self.writeTexts(member, lines, self.widths[index], self.rowCount)
+                            lines.detach()
+                        else:
+                            self.writeNumbers(member, spoolFile, typecode, (self.rowCount,))
+
+                spoolFile = self.spoolFiles[-1][0]
+                spoolFile.flush()
+                with archive.open(self.blockName + '.npy', 'w', force_zip64=True) as member:
+                    self.writeNumbers(member, spoolFile, self.blockTypecode,
+                                      (self.rowCount, len(self.blockColumnNames)))
+                with archive.open(self.blockName + ' columns.npy', 'w', force_zip64=True) as member:
+                    self.writeTexts(member, self.blockColumnNames,
+                                    max([len(name) for name in self.blockColumnNames] + [1]),
+                                    len(self.blockColumnNames))
+            os.replace(tempFileName, self.fileName)
+        except:
+            TableCache.remove(tempFileName)
+            raise
+        finally:
+            self.abort()
+
+    def abort(self):
+        """ Removes the spool files """
+        for spoolFile, spoolFileName in self.spoolFiles:
+            spoolFile.close()
+            TableCache.remove(spoolFileName)
+        self.spoolFiles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.commit()
+        else:
+            self.abort()
+
+class NullTableWriter(object):
+    """ A table writer that writes nothing, used in place of an optional one """
+
+    rowCount = 0
+
+    def writeRows(self, rows, blockRows):
+        pass
+
+    def commit(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        pass
+
+def readNpz(fileName):
+    """ Reads the arrays of a .npz file written by NpzTableWriter without numpy
+
+    Returns a dict of member name (without .npy) -> (shape, values), values being
+    an array for numeric members, with the values of all rows one after the
+    other, or a list of str for unicode members.
+    """
+    import ast
+    import zipfile
+
+    arrays = {}
+    with zipfile.ZipFile(fileName) as archive:
+        for memberName in archive.namelist():
+            with archive.open(memberName) as member:
+                prefix = member.read(10)
+                assert prefix[:8] == b'\x93NUMPY\x01\x00', "{} is not a .npy file (version 1.0)".format(memberName)
+                header = ast.literal_eval(member.read(int.from_bytes(prefix[8:10], 'little')).decode('latin1'))
+                data = member.read()
+            descr, shape = header['descr'], header['shape']
+            if descr[1] == 'U':
+                width = int(descr[2:])
+                text = data.decode('utf-32-le')
+                values = [text[start:start + width].rstrip('\0') for start in range(0, len(text), width)]
+            else:
+                values = array.array({'i8': 'q', 'f8': 'd', 'f4': 'f'}[descr[1:]])
+                values.frombytes(data)
+                if (descr[0] == '<') != (sys.byteorder == 'little'):
+                    values.byteswap()
+            arrays[memberName[:-len('.npy')]] = (shape, values)
+    return arrays
+
+def getPeakRSS(who=None):
+    """ Returns the peak resident set size in bytes of this process, or of its
+    waited-for child processes with who='children'; None where it is not available """
+    try:
+        import resource
+    except ImportError:
+        if who == 'children':
+            return None
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memoryInfo = psutil.Process().memory_info()
+        return getattr(memoryInfo, 'peak_wset', memoryInfo.rss)
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def setMemoryLimit(limitBytes):
+    """ Limits the address space of this process, and of the processes it starts, to limitBytes
+
+    Allocations beyond the limit raise MemoryError. Returns False where the
+    limit is not supported (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return False
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limitBytes = min(limitBytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limitBytes, hard))
+    return True
+
+def getAvailableMemory():
+    """ Returns the memory (bytes) this process can still allocate without making the system swap,
+    or None where it is not known
+
+    That is the memory the system reports as available, or the address space
+    limit of this process (see setMemoryLimit) when that is lower.
+    """
+    available = None
+    if sys.platform == 'win32':
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            available = status.ullAvailPhys
+    else:
+        try:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        available = int(line.split()[1]) * 1024
+                        break
+        except (IOError, OSError, ValueError):
+            pass
+        if available is None:
+            try:
+                available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+            except (AttributeError, ValueError, OSError):
+                pass
+
+    try:
+        import resource
+    except ImportError:
+        return available
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if soft != resource.RLIM_INFINITY:
+        available = soft if available is None else min(available, soft)
+    return available
+
+class StageProfiler(object):
+    """ A class that measures the stages of a node run
+
+    stage(name) returns a context manager timing the code it encloses:
+
+        with profiler.stage('parsePeptides') as stage:
+            peptides = ...
+            stage.rowsOut = len(peptides)
+
+    Stages may be nested and entered more than once. The times of a stage
+    exclude those of the stages nested in it, so the stage times add up to the
+    time measured, and the times of repeated entries are summed, as are the
+    rowsIn and rowsOut set on the stages. For every stage the wall time, the
+    CPU time of this process and of its finished child processes, the number
+    of calls and the peak RSS of the process at its last exit are recorded.
+
+    Measuring takes a few system calls per entry, so stages should enclose
+    whole tables or batches of rows, not single rows. NullProfiler has the same
+    methods and measures nothing.
+
+    Attributes
+    ----------
+    stages : dict
+        name -> dict of measurements, in the order the stages were first entered
+    marks : dict
+        name -> wall time (s) from the start of the profiler to the event of that name
+
+    Methods
+    -------
+    stage(name) -> context manager
+    markFirst(items, name) -> generator
+        yields items, marking the time the first one is ready
+    finish()
+        stops the clock of the whole run
+    toDict() -> dict
+    summary() -> list of str
+        one line per stage for the node log
+    toFile(fileName)
+        stores toDict() as JSON
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.marks = {}
+        self.stack = []
+        self.startTimes = self.getTimes()
+        self.totalTimes = None
+
+    @classmethod
+    def getTimes(cls):
+        # os.times() counts in clock ticks, process_time() is finer for this process
+        times = os.times()
+        return time.perf_counter(), time.process_time(), times.children_user + times.children_system
+
+    def stage(self, name):
+        return ProfiledStage(self, name)
+
+    def enter(self, stage):
+        if stage.name not in self.stages:
+            self.stages[stage.name] = {
+                'calls': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'childCpuSeconds': 0.0,
+                'rowsIn': None, 'rowsOut': None, 'peakRSS': None
+            }
+        # [stage, start times, times of nested stages]
+        self.stack.append([stage, self.getTimes(), [0.0, 0.0, 0.0]])
+
+    def exit(self, stage):
+        endTimes = self.getTimes()
+        entered, startTimes, nestedTimes = self.stack.pop()
+        assert entered is stage, "stage '{}' exited before stage '{}'".format(stage.name, entered.name)
+        elapsed = [end - start for end, start in zip(endTimes, startTimes)]
+        if self.stack:
+            parentNestedTimes = self.stack[-1][2]
+            for i in range(3):
+                parentNestedTimes[i] += elapsed[i]
+
+        measurements = self.stages[stage.name]
+        measurements['calls'] += 1
+        measurements['wallSeconds'] += elapsed[0] - nestedTimes[0]
+        measurements['cpuSeconds'] += elapsed[1] - nestedTimes[1]
+        measurements['childCpuSeconds'] += elapsed[2] - nestedTimes[2]
+        for key in ('rowsIn', 'rowsOut'):
+            rows = getattr(stage, key)
+            if rows is not None:
+                measurements[key] = (measurements[key] or 0) + rows
+        measurements['peakRSS'] = getPeakRSS()
+
+    def markFirst(self, items, name):
+        items = iter(items)
+        for item in items:
+            self.marks[name] = time.perf_counter() - self.startTimes[0]
+            yield item
+            break
+        for item in items:
+            yield item
+
+    def finish(self):
+        if self.totalTimes is None:
+            self.totalTimes = [end - start for end, start in zip(self.getTimes(), self.startTimes)]
+
+    def toDict(self):
+        self.finish()
+        return {
+            'wallSeconds': self.totalTimes[0],
+            'cpuSeconds': self.totalTimes[1],
+            'childCpuSeconds': self.totalTimes[2],
+            'peakRSS': getPeakRSS(),
+            'childPeakRSS': getPeakRSS('children'),
+            'stages': self.stages,
+            'marks': self.marks
+        }
+
+    def summary(self):
+        profile = self.toDict()
+        lines = []
+        for name, measurements in self.stages.items():
+            rows = ''
+            if measurements['rowsIn'] is not None:
+                rows += ', {} rows in'.format(measurements['rowsIn'])
+            if measurements['rowsOut'] is not None:
+                rows += ', {} rows out'.format(measurements['rowsOut'])
+            lines.append('{}: {:.3f} s wall, {:.3f} s cpu{}'.format(
+                name, measurements['wallSeconds'], measurements['cpuSeconds'] + measurements['childCpuSeconds'], rows))
+        peakRSS = '' if profile['peakRSS'] is None else ', peak RSS {:.1f} MB'.format(profile['peakRSS'] / 1048576.0)
+        lines.append('total: {:.3f} s wall, {:.3f} s cpu{}'.format(
+            profile['wallSeconds'], profile['cpuSeconds'] + profile['childCpuSeconds'], peakRSS))
+        return lines
+
+    def toFile(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.toDict(), f, indent=4)
+
+class ProfiledStage(object):
+    """ A stage measured by a StageProfiler, see StageProfiler.stage """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rowsIn = None
+        self.rowsOut = None
+
+    def __enter__(self):
+        self.profiler.enter(self)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.profiler.exit(self)
+
+class NullProfiler(object):
+    """ A StageProfiler that measures nothing, used when profiling is off """
+
+    class NullStage(object):
+        rowsIn = None
+        rowsOut = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, excType, excValue, tb):
+            pass
+
+    nullStage = NullStage()
+
+    def stage(self, name):
+        return self.nullStage
+
+    def markFirst(self, items, name):
+        return items
+
+    def finish(self):
+        pass
 
 class NodeArgs:
     """ A class that represents node_args.json 
@@ -164,7 +1574,7 @@ class NodeArgs:
     @WorkingDirectory.setter
     def WorkingDirectory(self, v):
         assert v is not None, "WorkingDirectory must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         self.__WorkingDirectory = v
     
     @property
@@ -174,7 +1584,7 @@ class NodeArgs:
     @ResultFilePath.setter
     def ResultFilePath(self, v):
         assert v is not None, "ResultFilePath must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         self.__ResultFilePath = v
     
     @property
@@ -195,7 +1605,7 @@ class NodeArgs:
     @ExpectedResponsePath.setter
     def ExpectedResponsePath(self, v):
         assert v is not None, "ExpectedResponsePath must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("ExpectedResponsePath cannot be an empty String")
         self.__ExpectedResponsePath = v
     
@@ -232,14 +1642,14 @@ class NodeArgs:
     def fromFile(cls, v):
         if (sys.version_info > (3, 0)):
             if v.__class__.__name__ == 'TextIOWrapper' :
-                nodeArgs = cls.fromDict(json.load(v, cls=NodeArgsDecoder))
+                nodeArgs = NodeDocumentDecoder.decodeNodeArgs(json.load(v))
                 return nodeArgs
         else:
             if v.__class__.__name__ == 'file' :
-                nodeArgs = cls.fromDict(json.load(v, cls=NodeArgsDecoder))
+                nodeArgs = NodeDocumentDecoder.decodeNodeArgs(json.load(v))
                 return nodeArgs
 
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("File name cannot be an empty String")
 
         with open(v, 'rt') as f:
@@ -250,9 +1660,9 @@ class NodeArgs:
     @classmethod
     def fromJsonString(cls, jsonStr):
         assert jsonStr is not None, "ExpectedResponsePath must not be None"
-        assert isinstance(jsonStr, six.string_types), "Parameter (type {}) must be of 'String' type".format(jsonStr.__class__.__name__)
+        assert isinstance(jsonStr, stringTypes), "Parameter (type {}) must be of 'String' type".format(jsonStr.__class__.__name__)
         if (len(jsonStr) == 0): raise ValueError("JSON string cannot be an empty String")
-        nodeArgs = cls.fromDict(json.loads(jsonStr, cls=NodeArgsDecoder))
+        nodeArgs = NodeDocumentDecoder.decodeNodeArgs(json.loads(jsonStr))
         return nodeArgs
         
     @classmethod
@@ -312,7 +1722,7 @@ class NodeArgs:
                 return
 
 		
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("File name cannot be an empty String")
     
         with open(v, 'wt') as f:
@@ -362,7 +1772,7 @@ class NodeResponse:
     @ExpectedResponsePath.setter
     def ExpectedResponsePath(self, v):
         assert v is not None, "ExpectedResponsePath must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         #if (len(v) == 0): raise ValueError("ExpectedResponsePath cannot be an empty String")
         self.__ExpectedResponsePath = v
     
@@ -388,24 +1798,24 @@ class NodeResponse:
 
     @classmethod
     def fromJsonString(cls, jsonStr):
-        assert isinstance(jsonStr, six.string_types), "Parameter (type {}) must be of 'String' type".format(jsonStr.__class__.__name__)
+        assert isinstance(jsonStr, stringTypes), "Parameter (type {}) must be of 'String' type".format(jsonStr.__class__.__name__)
         if (len(jsonStr) == 0): raise ValueError("JSON string cannot be an empty String")
         
-        nodeResponse = json.loads(jsonStr, cls=NodeResponseDecoder)
+        nodeResponse = NodeDocumentDecoder.decodeNodeResponse(json.loads(jsonStr))
         return nodeResponse
         
     @classmethod
     def fromFile(cls, v):
         if (sys.version_info > (3, 0)):
             if v.__class__.__name__ == 'TextIOWrapper' :
-                nodeResponse = cls.fromDict(json.load(v, cls=NodeResponseDecoder))
+                nodeResponse = NodeDocumentDecoder.decodeNodeResponse(json.load(v))
                 return nodeResponse
         else:
             if v.__class__.__name__ == 'file' :
-                nodeResponse = cls.fromDict(json.load(v, cls=NodeResponseDecoder))
+                nodeResponse = NodeDocumentDecoder.decodeNodeResponse(json.load(v))
                 return nodeResponse
 
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("File name cannot be an empty String")
         with open(v, 'rt') as f:
             nodeResponse = cls.fromFile(f)
@@ -455,7 +1865,7 @@ class NodeResponse:
                 json.dump( self, v, indent=4, default=NodeResponse.toDict )
                 return
 
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("File name cannot be an empty String")
     
         with open(v, 'wt') as f:
@@ -515,7 +1925,14 @@ class Table(object):
     #     self.__<attribute-name> = v
     #
     # is explained at https://www.python-course.eu/python3_properties.php
+    #
+    # The private attributes are held in __slots__ instead of a per-instance __dict__
+    # (names in __slots__ are mangled like the attributes), in this class and in the
+    # column description and options classes, of which there can be thousands. A slot
+    # whose setter skipped a None stays unset, so hasattr() answers as it did before.
     
+    __slots__ = ('__TableName', '__DataFile', '__DataFormat', '__ColumnDescriptions')
+
     def __init__(self, name, dataFile, dataFormat):
         self.ColumnDescriptions = []
         self.TableName = name
@@ -538,7 +1955,7 @@ class Table(object):
     @TableName.setter
     def TableName(self, v):
         assert v is not None, "TableName must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("TableName cannot be an empty String")
         self.__TableName = v
     
@@ -549,7 +1966,7 @@ class Table(object):
     @DataFile.setter
     def DataFile(self, v):
         assert v is not None, "DataFile must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("DataFile cannot be an empty String")
         self.__DataFile = v
     
@@ -560,7 +1977,7 @@ class Table(object):
     @DataFormat.setter
     def DataFormat(self, v):
         assert v is not None, "DataFormat must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("DataFormat cannot be an empty String")
         self.__DataFormat = v
     
@@ -616,6 +2033,8 @@ class ArgTable(Table):
       ]
     },
     """
+    __slots__ = ()
+
     def __init__(self, name, dataFile, dataFormat):
         super(ArgTable, self).__init__(name, dataFile, dataFormat)
 
@@ -663,6 +2082,8 @@ class ResponseTable(Table):
       ]
     },
     """
+    __slots__ = ()
+
     def __init__(self, name, dataFile, dataFormat):
         super(ResponseTable, self).__init__(name, dataFile, dataFormat)
 
@@ -712,6 +2133,8 @@ class ConnectionTable(Table):
 
    
     """
+    __slots__ = ('__TableName', '__Options', '__ColumnDescriptions')
+
     def __init__(self, name, dataFile, dataFormat):
         super(ConnectionTable, self).__init__(name, dataFile, dataFormat)
     
@@ -722,7 +2145,7 @@ class ConnectionTable(Table):
     @TableName.setter
     def TableName(self, v):
         assert v is not None, "TableName must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("TableName cannot be an empty String")
         assert '-' in v, "TableName of a connection table must have '-'"
         self.__TableName = v
@@ -821,6 +2244,8 @@ class AnyColumnDescription(object):
         it invokes namesake methods for child classes
     """
     
+    __slots__ = ('__ColumnName', '__ID', '__DataType')
+
     def __init__(self, columnName, iD, dataType):
         self.ColumnName = columnName
         self.ID = iD
@@ -839,7 +2264,7 @@ class AnyColumnDescription(object):
 
     @ColumnName.setter
     def ColumnName(self, v):
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("ColumnName cannot be an empty String")
         self.__ColumnName = v
     
@@ -849,7 +2274,7 @@ class AnyColumnDescription(object):
 
     @ID.setter
     def ID(self, v):
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if not (v in ['', 'ID', 'WorkflowID', 'Other']): raise ValueError("invalid ID {}".format(v))
         self.__ID = v
 
@@ -860,7 +2285,7 @@ class AnyColumnDescription(object):
     @DataType.setter
     def DataType(self, v):
         assert v is not None, "DataType must not be None"
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("DataType cannot be an empty String")
         if not (v in ['Boolean', 'Int', 'Long', 'Float', 'String']): raise ValueError("invalid DataType {}".format(v))
         self.__DataType = v
@@ -874,6 +2299,8 @@ class ConnectionTableColumnDescription(AnyColumnDescription):
         possible values are "ID' "WorkflowID", "Other"
 
     """
+    __slots__ = ('Options', '__ID')
+
     def __init__(self, columnName, iD, dataType):
         self.Options = None
         
@@ -908,7 +2335,7 @@ class ConnectionTableColumnDescription(AnyColumnDescription):
 
     @ID.setter      # overwritten to disallow an empty ID
     def ID(self, v):
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if not (v in ['ID', 'WorkflowID', 'Other']): raise ValueError("invalid ID {}".format(v))
         self.__ID = v
 
@@ -936,6 +2363,8 @@ class ColumnDescription(AnyColumnDescription):
     ----------
     Options : ColumnOptions
         column options (the DataGroupName only) - optional
+    DataGroupName : str
+        the DataGroupName of the Options, None if there is none - read only
         
     Methods
     -------        
@@ -946,6 +2375,8 @@ class ColumnDescription(AnyColumnDescription):
         creates a dict representation of a passes-in instance
         it invokes namesake methods for child classes
     """
+    __slots__ = ('__Options',)
+
     def __init__(self, columnName, iD, dataType):
         self.Options = None
         super(ColumnDescription, self).__init__(columnName, iD, dataType)
@@ -960,6 +2391,11 @@ class ColumnDescription(AnyColumnDescription):
         assert isinstance(v, ColumnOptions), "Parameter (type {}) must be of type 'ColumnOptions'".format(v.__class__.__name__)
         self.__Options = v
 
+    @property
+    def DataGroupName(self):
+        options = getattr(self, 'Options', None)
+        return getattr(options, 'DataGroupName', None)
+
     
     @classmethod
     def fromDict(cls, dct):
@@ -1011,6 +2447,8 @@ class ResponseTableColumnDescription(AnyColumnDescription):
         creates a dict representation of a passes-in instance
         it invokes namesake methods for child classes
     """
+    __slots__ = ('__Options',)
+
     def __init__(self, columnName, iD, dataType):
         self.Options = None
         super(ResponseTableColumnDescription, self).__init__(columnName, iD, dataType)
@@ -1067,6 +2505,8 @@ class ColumnOptions(object):
         it does not invoke namesake methods for child classes since this class has no children
     -------
     """
+    __slots__ = ('__DataGroupName',)
+
     def __init__(self):
         self.DataGroupName = None
     
@@ -1083,7 +2523,7 @@ class ColumnOptions(object):
     @DataGroupName.setter
     def DataGroupName(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("DataGroupName cannot be an empty String")
         self.__DataGroupName = v
 
@@ -1102,7 +2542,7 @@ class ColumnOptions(object):
         # print 'ColumnOptions.toDict: parameter type is {}, as dict {}'.format(obj.__class__.__name__, vars(obj))
         assert obj.__class__.__name__ == 'ColumnOptions', "Parameter is of invalid type {}".format(obj.__class__.__name__)
         d = {}
-        if hasattr(obj, 'DataGroupName') and (len(vars(obj)) == 1) and (obj.DataGroupName is not None):
+        if hasattr(obj, 'DataGroupName') and (obj.DataGroupName is not None):
             # print 'ColumnOptions.toDict: setting DataGroupName to {}'.format(obj.DataGroupName)
             d['DataGroupName'] = obj.DataGroupName    
         return d
@@ -1161,6 +2601,8 @@ class ResponseColumnOptions(ColumnOptions):
         it does not invoke namesake methods for child classes since this class has no children
     -------
     """
+    __slots__ = ('__PositionBefore', '__PositionAfter', '__RelativePosition', '__PlotType', '__FormatString', '__SpecialCellRenderer')
+
     def __init__(self):
         self.PositionBefore = None
         self.PositionAfter = None
@@ -1199,7 +2641,7 @@ class ResponseColumnOptions(ColumnOptions):
     @PlotType.setter
     def PlotType(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("PlotType cannot be an empty String")
         self.__PlotType = v
     
@@ -1210,7 +2652,7 @@ class ResponseColumnOptions(ColumnOptions):
     @FormatString.setter
     def FormatString(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("FormatString cannot be an empty String")
         self.__FormatString = v
     
@@ -1221,7 +2663,7 @@ class ResponseColumnOptions(ColumnOptions):
     @SpecialCellRenderer.setter
     def SpecialCellRenderer(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("SpecialCellRenderer cannot be an empty String")
         self.__SpecialCellRenderer = v
     
@@ -1232,7 +2674,7 @@ class ResponseColumnOptions(ColumnOptions):
     @PositionBefore.setter
     def PositionBefore(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("PositionBefore cannot be an empty String")
         self.__PositionBefore = v
 
@@ -1243,7 +2685,7 @@ class ResponseColumnOptions(ColumnOptions):
     @PositionAfter.setter
     def PositionAfter(self, v):
         if v is None: return
-        assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+        assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
         if (len(v) == 0): raise ValueError("PositionAfter cannot be an empty String")
         self.__PositionAfter = v
 
@@ -1272,7 +2714,7 @@ class ResponseColumnOptions(ColumnOptions):
         if hasattr(obj, 'SpecialCellRenderer') and (obj.SpecialCellRenderer is not None): d['SpecialCellRenderer'] = obj.SpecialCellRenderer    
         return d
     
-class ConnectionTableOptions:
+class ConnectionTableOptions(object):
     """ A class that represents connection table options 
     
     Attributes
@@ -1292,6 +2734,8 @@ class ConnectionTableOptions:
         it does not invoke namesake methods for child classes since this class has no children
     -------
     """
+    __slots__ = ('__FirstTable', '__SecondTable')
+
     def __init__(self):
         self.FirstTable = None
         self.SecondTable = None
@@ -1309,7 +2753,7 @@ class ConnectionTableOptions:
     @FirstTable.setter
     def FirstTable(self, v):
         if not (v is None) :
-            assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+            assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
             if (len(v) == 0): raise ValueError("FirstTable cannot be an empty String")
         self.__FirstTable = v
 
@@ -1320,7 +2764,7 @@ class ConnectionTableOptions:
     @SecondTable.setter
     def SecondTable(self, v):
         if not (v is None) :
-            assert isinstance(v, six.string_types), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
+            assert isinstance(v, stringTypes), "Parameter (type {}) must be of 'String' type".format(v.__class__.__name__)
             if (len(v) == 0): raise ValueError("SecondTable cannot be an empty String")
         self.__SecondTable = v
 
@@ -1360,6 +2804,10 @@ class NodeArgsDecoder(json.JSONDecoder):
         For each layer, the corresponding class fromDict factory method is invoked.
         These factory methods are creating class instances based on pqssed-in dict. 
         """
+        return self.decodeObject(dct)
+
+    @classmethod
+    def decodeObject(cls, dct):
         # print 'NodeDecoder.object_hook: dict is {}'.format(dct)
         if ConnectionTableOptions.isIt(dct): return ConnectionTableOptions.fromDict(dct)
         if ColumnOptions.isIt(dct): return ColumnOptions.fromDict(dct)
@@ -1389,6 +2837,10 @@ class NodeResponseDecoder(json.JSONDecoder):
         For each layer, the corresponding class fromDict factory method is invoked.
         These factory methods are creating class instances based on pqssed-in dict. 
         """
+        return self.decodeObject(dct)
+
+    @classmethod
+    def decodeObject(cls, dct):
         # print 'NodeDecoder.object_hook: dict is {}'.format(dct)
         if ConnectionTableOptions.isIt(dct): return ConnectionTableOptions.fromDict(dct)
         if ResponseColumnOptions.isIt(dct): return ResponseColumnOptions.fromDict(dct)
@@ -1401,3 +2853,105 @@ class NodeResponseDecoder(json.JSONDecoder):
         if NodeResponse.isIt(dct): return NodeResponse.fromDict(dct)
         return dct
  
+
+class NodeDocumentDecoder(object):
+    """ A class that decodes node_args.json and node_response.json by structural position
+
+    NodeArgsDecoder and NodeResponseDecoder find out what a JSON object is by
+    probing it with the isIt methods of up to nine classes, in an object_hook
+    called for every object of the document. Here the document is parsed into
+    plain dicts and lists first, without a hook, and then every dict is
+    converted according to its place in the document: the top object is the
+    node args or node response, the elements of its Tables list are tables (a
+    connection table when the TableName has a '-'), the elements of their
+    ColumnDescriptions lists are column descriptions and their Options are
+    column options, or connection table options at table level. The Options
+    dicts, which are few, still go through the decoders' dispatch, so they
+    end up as the same objects as before.
+
+    The objects are the same the decoders build for the documents Proteome
+    Discoverer and this script write, so NodeArgs and NodeResponse use this
+    class; the decoders are kept for json.load(..., cls=...) callers.
+
+    Methods
+    -------
+    decodeNodeArgs(dct) -> NodeArgs
+    decodeNodeResponse(dct) -> NodeResponse
+    """
+
+    @classmethod
+    def decodeNodeArgs(cls, dct):
+        assert isinstance(dct, dict), "Parameter is of invalid (not dict) type {}".format(dct.__class__.__name__)
+        nodeArgs = NodeArgs()
+        if 'WorkingDirectory' in dct:
+            nodeArgs.WorkingDirectory = dct['WorkingDirectory']
+        if 'ResultFilePath' in dct:
+            nodeArgs.ResultFilePath = dct['ResultFilePath']
+        if 'CurrentWorkflowID' in dct:
+            nodeArgs.CurrentWorkflowID = dct['CurrentWorkflowID']
+        if 'ExpectedResponsePath' in dct:
+            nodeArgs.ExpectedResponsePath = dct['ExpectedResponsePath']
+        if 'Version' in dct:
+            nodeArgs.Version = dct['Version']
+        for tableDict in dct.get('Tables', ()):
+            nodeArgs.Tables.append(cls.decodeTable(tableDict, ArgTable, ColumnDescription, cls.decodeColumnOptions))
+        return nodeArgs
+
+    @classmethod
+    def decodeNodeResponse(cls, dct):
+        assert isinstance(dct, dict), "Parameter is of invalid (not dict) type {}".format(dct.__class__.__name__)
+        nodeResponse = NodeResponse()
+        if 'CurrentWorkflowID' in dct:
+            nodeResponse.CurrentWorkflowID = dct['CurrentWorkflowID']
+        if 'ExpectedResponsePath' in dct:
+            nodeResponse.ExpectedResponsePath = dct['ExpectedResponsePath']
+        for tableDict in dct.get('Tables', ()):
+            nodeResponse.Tables.append(cls.decodeTable(
+                tableDict, ResponseTable, ResponseTableColumnDescription, cls.decodeResponseColumnOptions))
+        return nodeResponse
+
+    @classmethod
+    def decodeTable(cls, dct, tableClass, columnDescriptionClass, decodeOptions):
+        """ Returns a tableClass instance, or a ConnectionTable if the TableName has a '-' """
+        columnDescriptions = cls.decodeColumnDescriptions(
+            dct['ColumnDescriptions'], columnDescriptionClass, decodeOptions)
+
+        if '-' not in dct['TableName']:
+            table = tableClass(dct['TableName'], dct['DataFile'], dct['DataFormat'])
+            table.ColumnDescriptions.extend(columnDescriptions)
+            return table
+
+        table = ConnectionTable(dct['TableName'], dct['DataFile'], dct['DataFormat'])
+        if 'Options' in dct:
+            options = dct['Options']
+            # other options are left as they are for the setter to reject, like the decoders do
+            if isinstance(options, dict) and ConnectionTableOptions.isIt(options):
+                options = ConnectionTableOptions.fromDict(options)
+            table.Options = options
+        # converts them to ConnectionTableColumnDescription
+        for columnDescription in columnDescriptions:
+            table.addColumnDescription(columnDescription)
+        return table
+
+    @classmethod
+    def decodeColumnDescriptions(cls, columnDicts, columnDescriptionClass, decodeOptions):
+        columnDescriptions = []
+        for dct in columnDicts:
+            columnDescription = columnDescriptionClass(dct['ColumnName'], dct['ID'], dct['DataType'])
+            options = dct.get('Options')
+            if options is not None:
+                columnDescription.Options = decodeOptions(options) if isinstance(options, dict) else options
+            columnDescriptions.append(columnDescription)
+        return columnDescriptions
+
+    @classmethod
+    def decodeColumnOptions(cls, dct):
+        # the Options dicts go through the decoder's dispatch, like every object did, so that a dict
+        # it takes for another object is rejected by the Options setter; the rest is left to fromDict
+        options = NodeArgsDecoder.decodeObject(dct)
+        return ColumnOptions.fromDict(options) if isinstance(options, dict) else options
+
+    @classmethod
+    def decodeResponseColumnOptions(cls, dct):
+        options = NodeResponseDecoder.decodeObject(dct)
+        return ResponseColumnOptions.fromDict(options) if isinstance(options, dict) else options
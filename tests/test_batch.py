@@ -0,0 +1,117 @@
+import os
+import io
+import re
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+import subprocess
+import batch
+from tests.test_joinengines import makeDataset
+
+# the tests replace batch.runJob by crashingRunJob
+runJob = batch.runJob
+
+def crashingRunJob(nodeArgsFileName, argv, memoryLimit, logName, connection):
+    """ batch.runJob, except that the jobs in a 'crashed' folder end their process without a result """
+    if os.path.basename(os.path.dirname(nodeArgsFileName)) == 'crashed':
+        os._exit(3)
+    runJob(nodeArgsFileName, argv, memoryLimit, logName, connection)
+
+class BatchTest(unittest.TestCase):
+    """ Jobs that succeed, fail, crash or run out of memory, their exit code and --summary """
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        self.nodeArgsFileName = makeDataset(os.path.join(self.dataDir, 'ok'))
+        self.summaryFileName = os.path.join(self.dataDir, 'summary.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def writeJob(self, name, change=None):
+        """ Writes a copy of the node_args.json to the folder name, with change(dict) applied """
+        with open(self.nodeArgsFileName, 'r') as f:
+            dct = json.load(f)
+        if change is not None:
+            change(dct)
+        os.mkdir(os.path.join(self.dataDir, name))
+        fileName = os.path.join(self.dataDir, name, batch.nodeArgsName)
+        with open(fileName, 'w') as f:
+            json.dump(dct, f)
+        return fileName
+
+    def runBatch(self, argv):
+        """ Runs batch.main in this process, the jobs with crashingRunJob; returns the exit code, log and summary """
+        log = io.StringIO()
+        batch.runJob = crashingRunJob
+        try:
+            with contextlib.redirect_stdout(log):
+                exitCode = batch.main(['--jobs', '2', '--summary', self.summaryFileName] + argv)
+        finally:
+            batch.runJob = runJob
+        with open(self.summaryFileName, 'r') as f:
+            return exitCode, log.getvalue(), json.load(f)
+
+    def test_ok(self):
+        cacheDir = os.path.join(self.dataDir, 'cache dir')
+        exitCode, log, results = self.runBatch(
+            ['--uc2-args', '--cache --cache-dir "{}"'.format(cacheDir), self.nodeArgsFileName])
+        self.assertEqual(exitCode, 0)
+        self.assertEqual([result['status'] for result in results], ['ok'])
+        self.assertGreater(results[0]['rowsOut'], 0)
+        self.assertTrue(os.listdir(cacheDir))
+        self.assertIn('batch: 1 jobs done, 0 failed', log)
+
+    def test_failed_and_crashed(self):
+        def dropPeptideGroups(dct):
+            dct['Tables'][0]['DataFile'] = os.path.join(self.dataDir, 'missing.txt')
+        failed = self.writeJob('failed', dropPeptideGroups)
+        crashed = self.writeJob('crashed')
+        exitCode, log, results = self.runBatch([self.dataDir])
+        self.assertEqual(exitCode, 1)
+
+        results = dict((os.path.basename(os.path.dirname(result['nodeArgs'])), result) for result in results)
+        self.assertEqual(sorted(results), ['crashed', 'failed', 'ok'])
+        self.assertEqual(results['ok']['status'], 'ok')
+        self.assertEqual(results['failed']['status'], 'failed')
+        self.assertIsNone(results['failed']['rowsOut'])
+        self.assertRegex(results['failed']['error'], 'missing.txt')
+        with open(results['failed']['log'], 'r') as f:
+            self.assertIn('Traceback', f.read())
+        self.assertEqual(results['crashed']['status'], 'failed')
+        self.assertEqual(results['crashed']['error'], 'job process exited with code 3')
+        self.assertEqual(results['crashed']['nodeArgs'], crashed)
+
+        self.assertIn('batch: 3 jobs done, 2 failed, {} rows written'.format(results['ok']['rowsOut']), log)
+        for name, nodeArgsFileName in (('failed', failed), ('crashed', crashed)):
+            self.assertRegex(log, r'\n failed .* {}\n +{}\n'.format(
+                re.escape(nodeArgsFileName), re.escape(results[name]['error'])))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'), "reads the address space size from /proc")
+    def test_memory_limit(self):
+        bigFileName = makeDataset(os.path.join(self.dataDir, 'big'), mappings=100000)
+        # the address space of a job process before it reads the tables, plus a margin
+        # the small job stays within and the big job does not
+        output = subprocess.check_output([sys.executable, '-c',
+            "import batch, prepare_phosphomatics_ct\n"
+            "print([line.split()[1] for line in open('/proc/self/status') if line.startswith('VmSize:')][0])"],
+            cwd=os.path.dirname(os.path.abspath(batch.__file__)))
+        memoryLimit = int(output) // 1024 + 16
+
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(batch.__file__), '--jobs', '1', '--memory-limit', str(memoryLimit),
+             '--summary', self.summaryFileName, self.nodeArgsFileName, bigFileName],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.returncode, 1, process.stdout)
+        with open(self.summaryFileName, 'r') as f:
+            results = json.load(f)
+        self.assertEqual([result['status'] for result in results], ['ok', 'failed'], process.stdout)
+        self.assertRegex(results[1]['error'], '^MemoryError')
+        self.assertIn('batch: 2 jobs done, 1 failed', process.stdout)
+        self.assertLess(results[1]['peakRSS'], (memoryLimit + 1) * 1048576)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,497 @@
+import os
+import array
+import io
+import re
+import csv
+import glob
+import random
+import shutil
+import tempfile
+import tracemalloc
+import zipfile
+import unittest
+import contextlib
+import benchmark
+import joinengines
+import scriptutils
+import prepare_phosphomatics_ct
+
+"""
+Every join engine has to write the same results as the hash engine. The
+runs go through UC2.perform on a small synthetic dataset whose Modifications
+cells hold quoted tabs, line breaks and quotes.
+"""
+
+UC2 = prepare_phosphomatics_ct.UC2
+
+# further arguments of every join engine, chosen so the engines take their out-of-core paths
+engineArguments = {
+    'hash': [],
+    'mapped': [],
+    'sortmerge': ['--memory-budget', '1'],
+    'sqlite': ['--memory-budget', '1'],
+}
+
+scenarios = {
+    'default': [],
+    'filtered': ['--modifications', 'Phospho,Acetyl', '--min-site-probability', '30',
+                 '--min-confidence', 'Medium', '--min-valid-values', '3'],
+    'aggregated': ['--modifications', 'Phospho,GlyGly', '--aggregate', 'sum'],
+    'float32': ['--abundance-type', 'float32', '--aggregate', 'mostvalid'],
+    'maximum': ['--min-valid-values', '2', '--aggregate', 'max'],
+}
+
+def makeDataset(dataDir, mappings=3000, channels=6):
+    return benchmark.generateDataset(dataDir, mappings, channels, extraColumns=2, seed=7, specialCells=True)
+
+def getPeakMemory(function):
+    """ Returns the peak of the memory allocated by Python while function runs """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def runNode(nodeArgsFileName, argv):
+    """ Runs the node and returns the rows of the tables it wrote by file name """
+    dataDir = os.path.dirname(nodeArgsFileName)
+    for fileName in glob.glob(os.path.join(dataDir, 'Phosphomatics*.txt')):
+        os.remove(fileName)
+    fileName, options = UC2.parseArguments([nodeArgsFileName] + list(argv))
+    with contextlib.redirect_stdout(io.StringIO()):
+        UC2.perform(fileName, options)
+
+    tables = {}
+    for fileName in glob.glob(os.path.join(dataDir, 'Phosphomatics*.txt')):
+        with open(fileName, 'r', newline='') as f:
+            tables[os.path.basename(fileName)] = list(csv.reader(f, delimiter='\t'))
+    return tables
+
+def rewriteAbundances(nodeArgsFileName, function):
+    """ Replaces the Abundances cells of the Peptide Groups file by function(row number, cell) """
+    nodeArgs = scriptutils.NodeArgs.fromFile(nodeArgsFileName)
+    fileName = [table.DataFile for table in nodeArgs.Tables if table.TableName == 'Peptide Groups'][0]
+    with open(fileName, 'r', newline='') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    columns = [index for index, name in enumerate(rows[0]) if name.startswith('Abundances')]
+    for rowNumber, row in enumerate(rows[1:]):
+        for index in columns:
+            row[index] = function(rowNumber, row[index])
+    with open(fileName, 'w', newline='') as f:
+        csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+
+class JoinEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        cls.nodeArgsFileName = makeDataset(cls.dataDir)
+        cls.expected = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    def getExpected(self, scenario):
+        if scenario not in self.expected:
+            self.expected[scenario] = runNode(self.nodeArgsFileName, ['--join-mode', 'hash'] + scenarios[scenario])
+            self.assertTrue(self.expected[scenario])
+            for rows in self.expected[scenario].values():
+                self.assertGreater(len(rows), 1)
+        return self.expected[scenario]
+
+    def assertSameTables(self, argv, scenario='default'):
+        tables = runNode(self.nodeArgsFileName, argv + scenarios[scenario])
+        expected = self.getExpected(scenario)
+        self.assertEqual(sorted(tables), sorted(expected))
+        for fileName in expected:
+            self.assertEqual(tables[fileName], expected[fileName], fileName)
+
+    def test_engines(self):
+        for joinMode in sorted(joinengines.joinEngines):
+            for scenario in sorted(scenarios):
+                with self.subTest(joinMode=joinMode, scenario=scenario):
+                    self.assertSameTables(['--join-mode', joinMode] + engineArguments[joinMode], scenario)
+
+    def test_auto(self):
+        self.assertSameTables(['--join-mode', 'auto'])
+
+    def test_planner(self):
+        fileName, options = UC2.parseArguments([self.nodeArgsFileName])
+        nodeArgs = scriptutils.NodeArgs.fromFile(fileName)
+        tableNames = [table.TableName for table in nodeArgs.Tables]
+        peptideTableIndex = tableNames.index('Peptide Groups')
+        indexDict = {
+            'peptideTableIndex': peptideTableIndex,
+            'modSiteTableIndex': tableNames.index('Modification Sites'),
+            'mapTableIndex': tableNames.index('TargetPeptideGroup-ModificationSite'),
+            'quantColIndicies': [index for index, column in enumerate(nodeArgs.Tables[peptideTableIndex].ColumnDescriptions)
+                                 if column.ColumnName.startswith('Abundances')],
+        }
+        getAvailableMemory = scriptutils.getAvailableMemory
+        estimateFileRows = joinengines.JoinPlanner.__dict__['estimateFileRows']
+        try:
+            for availableBytes, rows, joinMode in ((None, None, 'hash'), (1 << 40, 10 ** 7, 'hash'),
+                                                   (1 << 20, None, 'sqlite'), (1 << 30, 10 ** 7, 'sqlite')):
+                with self.subTest(availableBytes=availableBytes, rows=rows):
+                    scriptutils.getAvailableMemory = lambda: availableBytes
+                    joinengines.JoinPlanner.estimateFileRows = estimateFileRows
+                    if rows is not None:
+                        joinengines.JoinPlanner.estimateFileRows = classmethod(lambda cls, fileName, rows=rows: rows)
+                    planner = joinengines.JoinPlanner(nodeArgs, indexDict, options)
+                    self.assertEqual(planner.plan(), joinMode)
+                    self.assertIn('chose ' + joinMode, planner.summary())
+        finally:
+            scriptutils.getAvailableMemory = getAvailableMemory
+            joinengines.JoinPlanner.estimateFileRows = estimateFileRows
+
+    def test_pdresult(self):
+        resultFile = benchmark.writePdResult(self.nodeArgsFileName)
+        for joinMode in sorted(joinengines.joinEngines):
+            with self.subTest(joinMode=joinMode):
+                self.assertSameTables(['--join-mode', joinMode, '--input-source', 'pdresult',
+                                       '--result-file', resultFile] + engineArguments[joinMode], 'filtered')
+
+    def test_cache(self):
+        cacheDir = os.path.join(self.dataDir, 'cache')
+        for joinMode in sorted(joinengines.joinEngines):
+            for run in range(2):
+                with self.subTest(joinMode=joinMode, run=run):
+                    self.assertSameTables(['--join-mode', joinMode, '--cache', '--cache-dir', cacheDir]
+                                          + engineArguments[joinMode], 'filtered')
+
+    def test_parse_workers(self):
+        minRangeBytes = scriptutils.ParallelTableParser.minRangeBytes
+        scriptutils.ParallelTableParser.minRangeBytes = 4096
+        try:
+            self.assertSameTables(['--join-mode', 'hash', '--parse-workers', '2'], 'filtered')
+        finally:
+            scriptutils.ParallelTableParser.minRangeBytes = minRangeBytes
+
+class AbundanceErrorTest(unittest.TestCase):
+    """ Non-numeric abundance cells are counted and reported; too many of them fail the run """
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        self.nodeArgsFileName = makeDataset(self.dataDir, mappings=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def rewriteAbundances(self, function):
+        rewriteAbundances(self.nodeArgsFileName, function)
+
+    def runLogged(self, argv):
+        dataDir = os.path.dirname(self.nodeArgsFileName)
+        for fileName in glob.glob(os.path.join(dataDir, 'Phosphomatics*.txt')):
+            os.remove(fileName)
+        fileName, options = UC2.parseArguments([self.nodeArgsFileName] + list(argv))
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            UC2.perform(fileName, options)
+        return log.getvalue()
+
+    def test_decimal_commas(self):
+        self.rewriteAbundances(lambda rowNumber, cell: cell.replace('.', ','))
+        for joinMode in sorted(joinengines.joinEngines):
+            with self.subTest(joinMode=joinMode):
+                with self.assertRaisesRegex(AssertionError, 'decimal commas'):
+                    self.runLogged(['--join-mode', joinMode] + engineArguments[joinMode])
+                self.assertEqual(glob.glob(os.path.join(self.dataDir, 'Phosphomatics*.txt')), [])
+
+    def test_few_errors(self):
+        self.rewriteAbundances(lambda rowNumber, cell: 'n/a' if rowNumber % 300 == 1 and cell else cell)
+        expected = runNode(self.nodeArgsFileName, ['--join-mode', 'hash'])
+        cacheArguments = ['--cache', '--cache-dir', os.path.join(self.dataDir, 'cache')]
+        minRangeBytes = scriptutils.ParallelTableParser.minRangeBytes
+        scriptutils.ParallelTableParser.minRangeBytes = 4096
+        try:
+            for argv in [['--join-mode', joinMode] + engineArguments[joinMode] for joinMode in sorted(joinengines.joinEngines)] + \
+                    [['--join-mode', 'hash', '--parse-workers', '2'], ['--join-mode', 'hash'] + cacheArguments,
+                     ['--join-mode', 'hash'] + cacheArguments]:
+                with self.subTest(argv=argv):
+                    log = self.runLogged(argv)
+                    self.assertRegex(log, r"uc2: \d+ of \d+ abundance cells \(\d+\.\d+%\) are not numbers and were "
+                                          r"read as missing values, e\.g\. 'n/a'")
+                    self.assertEqual(runNode(self.nodeArgsFileName, argv), expected)
+        finally:
+            scriptutils.ParallelTableParser.minRangeBytes = minRangeBytes
+
+    def test_valid_values_counts(self):
+        # --min-valid-values 0 keeps every row, so the cells and errors are those of a run without it
+        self.rewriteAbundances(lambda rowNumber, cell: 'n/a' if rowNumber % 300 == 1 and cell else cell)
+        for joinMode in sorted(joinengines.joinEngines):
+            with self.subTest(joinMode=joinMode):
+                argv = ['--join-mode', joinMode] + engineArguments[joinMode]
+                summaries = []
+                for extra in ([], ['--min-valid-values', '0']):
+                    log = self.runLogged(argv + extra)
+                    summaries.append(re.findall(r"uc2: \d+ of \d+ abundance cells .*", log))
+                self.assertEqual(len(summaries[0]), 1)
+                self.assertEqual(summaries[1], summaries[0])
+
+class PaddedIDTest(unittest.TestCase):
+    """ IDs are compared as numbers: zero-padded IDs of the map table join the rows with the unpadded IDs """
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        self.nodeArgsFileName = makeDataset(self.dataDir, mappings=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def test_engines(self):
+        expected = runNode(self.nodeArgsFileName, ['--join-mode', 'hash'])
+        nodeArgs = scriptutils.NodeArgs.fromFile(self.nodeArgsFileName)
+        fileName = [table.DataFile for table in nodeArgs.Tables if table.TableName.count('-') == 1][0]
+        with open(fileName, 'r', newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        for row in rows[1:]:
+            row[0] = row[0].zfill(8)
+            row[1] = row[1].zfill(8)
+        with open(fileName, 'w', newline='') as f:
+            csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+
+        for joinMode in sorted(joinengines.joinEngines):
+            with self.subTest(joinMode=joinMode):
+                self.assertEqual(runNode(self.nodeArgsFileName, ['--join-mode', joinMode] + engineArguments[joinMode]),
+                                 expected)
+
+class ColumnarOutputTest(unittest.TestCase):
+    """ The .npz files of --columnar-output against Phosphomatics.txt """
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        self.nodeArgsFileName = makeDataset(self.dataDir, mappings=1000)
+        self.npzFileName = os.path.join(self.dataDir, 'Phosphomatics.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def checkColumns(self, rows, header, abundanceType):
+        arrays = scriptutils.readNpz(self.npzFileName)
+        abundanceNames = header[4:]
+        self.assertEqual(sorted(arrays), sorted(header[:4] + ['Abundances', 'Abundances columns']))
+        self.assertEqual(arrays['Abundances columns'], ((len(abundanceNames),), abundanceNames))
+        for index, (name, typecode) in enumerate(zip(header[:4], ['q', 'U', 'U', 'q'])):
+            shape, values = arrays[name]
+            self.assertEqual(shape, (len(rows),))
+            if typecode == 'U':
+                self.assertEqual(values, [row[index] for row in rows])
+            else:
+                self.assertEqual(values.typecode, 'q')
+                self.assertEqual(list(values), [int(row[index]) for row in rows])
+
+        shape, values = arrays['Abundances']
+        typecode = scriptutils.abundanceTypecodes[abundanceType]
+        self.assertEqual(shape, (len(rows), len(abundanceNames)))
+        self.assertEqual(values.typecode, typecode)
+        # empty cells are NaN, the others the values written as text
+        cells = [cell for row in rows for cell in row[4:]]
+        self.assertIn('', cells)
+        expected = array.array(typecode, [float(cell) if cell else float('nan') for cell in cells])
+        self.assertEqual(values.tobytes(), expected.tobytes())
+        return arrays
+
+    def test_columns(self):
+        for columnarOutput, compression in (('npz', zipfile.ZIP_STORED), ('npz-deflated', zipfile.ZIP_DEFLATED)):
+            for abundanceType in ('float64', 'float32'):
+                with self.subTest(columnarOutput=columnarOutput, abundanceType=abundanceType):
+                    tables = runNode(self.nodeArgsFileName,
+                                     ['--columnar-output', columnarOutput, '--abundance-type', abundanceType])
+                    header, rows = tables['Phosphomatics.txt'][0], tables['Phosphomatics.txt'][1:]
+                    self.assertGreater(len(rows), 0)
+                    arrays = self.checkColumns(rows, header, abundanceType)
+                    with zipfile.ZipFile(self.npzFileName) as archive:
+                        self.assertEqual(set(info.compress_type for info in archive.infolist()), {compression})
+                    self.checkNumpy(arrays)
+
+    def checkNumpy(self, arrays):
+        try:
+            import numpy
+        except ImportError:
+            return
+        with numpy.load(self.npzFileName) as npz:
+            self.assertEqual(sorted(npz.files), sorted(arrays))
+            for name, (shape, values) in arrays.items():
+                self.assertEqual(npz[name].shape, shape)
+                self.assertEqual(npz[name].ravel().tolist(), list(values))
+
+    def test_failed_run(self):
+        # a failed run leaves neither a partial .npz file nor its temporary files, nor replaces an earlier one
+        argv = ['--columnar-output', 'npz']
+        rewriteAbundances(self.nodeArgsFileName, lambda rowNumber, cell: cell.replace('.', ','))
+        with self.assertRaisesRegex(AssertionError, 'decimal commas'):
+            runNode(self.nodeArgsFileName, argv)
+        self.assertEqual(glob.glob(os.path.join(self.dataDir, 'Phosphomatics*')), [])
+
+        rewriteAbundances(self.nodeArgsFileName, lambda rowNumber, cell: cell.replace(',', '.'))
+        runNode(self.nodeArgsFileName, argv)
+        with open(self.npzFileName, 'rb') as f:
+            expected = f.read()
+        rewriteAbundances(self.nodeArgsFileName, lambda rowNumber, cell: cell.replace('.', ','))
+        with self.assertRaisesRegex(AssertionError, 'decimal commas'):
+            runNode(self.nodeArgsFileName, argv)
+        with open(self.npzFileName, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(glob.glob(os.path.join(self.dataDir, '*.tmp')), [])
+
+class ModificationTablesTest(unittest.TestCase):
+    """ The tables of several modifications against those of runs for each of them """
+
+    # GlyGly renamed, '-' and ':' cannot go into table names
+    modificationName = 'Label:13C-GlyGly'
+    siteTableName = 'Phosphomatics Label 13C GlyGly'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        cls.nodeArgsFileName = makeDataset(cls.dataDir, mappings=1000)
+        nodeArgs = scriptutils.NodeArgs.fromFile(cls.nodeArgsFileName)
+        fileName = [table.DataFile for table in nodeArgs.Tables if table.TableName == 'Modification Sites'][0]
+        with open(fileName, 'r', newline='') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        index = rows[0].index('Modification Name')
+        for row in rows[1:]:
+            if row[index] == 'GlyGly':
+                row[index] = cls.modificationName
+        with open(fileName, 'w', newline='') as f:
+            csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    def test_tables(self):
+        modifications = ['Phospho', self.modificationName]
+        tableNames = ['Phosphomatics Phospho', self.siteTableName]
+        for joinMode in sorted(joinengines.joinEngines):
+            for argv in (['--join-mode', joinMode] + engineArguments[joinMode],
+                         ['--join-mode', joinMode, '--aggregate', 'sum'] + engineArguments[joinMode]):
+                with self.subTest(argv=argv):
+                    tables = runNode(self.nodeArgsFileName, argv + ['--modifications', ','.join(modifications)])
+                    nodeResponse = scriptutils.NodeResponse.fromFile(
+                        os.path.join(self.dataDir, 'node_response.json'))
+                    self.checkNodeResponse(nodeResponse, tableNames)
+                    self.assertEqual(sorted(tables), sorted(
+                        name + suffix for name in tableNames for suffix in ('.txt', '-TargetPeptideGroup.txt')))
+
+                    for modificationName, tableName in zip(modifications, tableNames):
+                        expected = runNode(self.nodeArgsFileName, argv + ['--modifications', modificationName])
+                        self.assertGreater(len(expected['Phosphomatics.txt']), 1)
+                        self.assertEqual(tables[tableName + '.txt'], expected['Phosphomatics.txt'])
+                        self.assertEqual(tables[tableName + '-TargetPeptideGroup.txt'],
+                                         expected['Phosphomatics-TargetPeptideGroup.txt'])
+
+    def checkNodeResponse(self, nodeResponse, tableNames):
+        self.assertEqual([table.TableName for table in nodeResponse.Tables],
+                         [name + suffix for name in tableNames for suffix in ('', '-TargetPeptideGroup')])
+        for index, tableName in enumerate(tableNames):
+            resultsTable, connectionTable = nodeResponse.Tables[2 * index:2 * index + 2]
+            self.assertEqual(os.path.normpath(resultsTable.DataFile), os.path.join(self.dataDir, tableName + '.txt'))
+            self.assertEqual(os.path.normpath(connectionTable.DataFile),
+                             os.path.join(self.dataDir, tableName + '-TargetPeptideGroup.txt'))
+            self.assertIsInstance(connectionTable, scriptutils.ConnectionTable)
+            self.assertEqual((connectionTable.Options.FirstTable, connectionTable.Options.SecondTable),
+                             (tableName, 'Peptide Groups'))
+
+class SiteAggregatorTest(unittest.TestCase):
+
+    def makeRecords(self, count):
+        # the same abundances joined to two sites, as the join engines share them
+        shared = [array.array('d', [float(index), float('nan'), 1.0]) for index in range(count)]
+        records = []
+        for index, abundances in enumerate(shared):
+            for position in ('1', '2'):
+                records.append((str(index), 'P1', 'S', position, abundances, 'Phospho'))
+        return shared, records
+
+    def test_reducers(self):
+        for reducer in sorted(joinengines.SiteAggregator.reducers):
+            with self.subTest(reducer=reducer):
+                shared, records = self.makeRecords(20)
+                before = [abundances.tobytes() for abundances in shared]
+                aggregated = list(joinengines.SiteAggregator(reducer).aggregate(records))
+                self.assertEqual([abundances.tobytes() for abundances in shared], before)
+                self.assertEqual([record[3] for record in aggregated], ['1', '2'])
+                for record in aggregated:
+                    self.assertEqual(record[0], [str(index) for index in range(20)])
+                    self.assertEqual(record[4][2], 20.0 if reducer == 'sum' else 1.0)
+                    self.assertEqual(record[4][0], {'sum': 190.0, 'max': 19.0}.get(reducer, 0.0))
+
+    def test_sorted(self):
+        shared, records = self.makeRecords(20)
+        with tempfile.TemporaryDirectory(prefix='uc2test_') as tempDir:
+            for reducer in sorted(joinengines.SiteAggregator.reducers):
+                with self.subTest(reducer=reducer):
+                    expected = list(joinengines.SiteAggregator(reducer).aggregate(records))
+                    aggregated = list(joinengines.SiteAggregator(reducer).aggregateSorted(
+                        records, lambda: joinengines.ExternalSorter(tempDir, 4096), 'd'))
+                    self.assertEqual([record[:4] + record[5:] for record in aggregated],
+                                     [record[:4] + record[5:] for record in expected])
+                    self.assertEqual([record[4].tobytes() for record in aggregated],
+                                     [record[4].tobytes() for record in expected])
+
+class ExternalSorterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix='uc2test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    @classmethod
+    def makeRows(cls, count):
+        rng = random.Random(count)
+        for position in range(count):
+            yield ['%012d' % position, str(rng.randint(1, 1000)), str(rng.randint(1, 10 ** 6))]
+
+    def sort(self, count, memoryBudget):
+        sorter = joinengines.ExternalSorter(self.tempDir, memoryBudget)
+        return [row for key, row in sorter.sort(self.makeRows(count), lambda row: row[1])]
+
+    def test_sort(self):
+        rows = list(self.makeRows(10000))
+        # sorted() is stable as well
+        expected = sorted(rows, key=lambda row: row[1])
+        for memoryBudget in (16 * 1024, 64 * 1024 * 1024):
+            with self.subTest(memoryBudget=memoryBudget):
+                self.assertEqual(self.sort(10000, memoryBudget), expected)
+        self.assertEqual(os.listdir(self.tempDir), [])
+
+    def test_memory_bounded(self):
+        for memoryBudget in (64 * 1024, 512 * 1024):
+            peaks = []
+            for count in (10000, 40000):
+                sorter = joinengines.ExternalSorter(self.tempDir, memoryBudget)
+                def sort():
+                    for item in sorter.sort(self.makeRows(count), lambda row: row[1]):
+                        pass
+                peaks.append(getPeakMemory(sort))
+            with self.subTest(memoryBudget=memoryBudget, peaks=peaks):
+                # 40000 rows take about 12 MB in memory
+                self.assertLess(max(peaks), 1.5 * memoryBudget + 256 * 1024)
+                self.assertLess(peaks[1], peaks[0] + 256 * 1024)
+
+    def test_sortmerge_memory_bounded(self):
+        batchRows = UC2.writeBatchRows
+        peaks = {}
+        try:
+            UC2.writeBatchRows = 1000
+            for mappings in (4000, 16000):
+                dataDir = os.path.join(self.tempDir, str(mappings))
+                nodeArgsFileName = makeDataset(dataDir, mappings, 16)
+                for argv in (['--join-mode', 'hash'], ['--join-mode', 'sortmerge', '--memory-budget', '1'],
+                             ['--join-mode', 'sortmerge', '--memory-budget', '1', '--aggregate', 'sum']):
+                    fileName, options = UC2.parseArguments([nodeArgsFileName] + argv)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        peaks[' '.join(argv[1::2]), mappings] = getPeakMemory(lambda: UC2.perform(fileName, options))
+        finally:
+            UC2.writeBatchRows = batchRows
+        for joinMode in ('sortmerge 1', 'sortmerge 1 sum'):
+            self.assertLess(peaks[joinMode, 16000], peaks[joinMode, 4000] + 512 * 1024, peaks)
+            self.assertLess(peaks[joinMode, 16000], peaks['hash', 16000], peaks)
+
+if __name__ == '__main__':
+    unittest.main()
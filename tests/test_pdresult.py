@@ -0,0 +1,172 @@
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import benchmark
+import joinengines
+import pdresult
+import scriptutils
+from tests.test_joinengines import makeDataset, runNode
+
+"""
+PdResultSource against the exported table files: the rows and filter counts
+of filters tested in SQL, the values grouped in blobs, and runs without the
+exported files.
+"""
+
+class PdResultSourceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        cls.nodeArgsFileName = makeDataset(cls.dataDir)
+        cls.nodeArgs = scriptutils.NodeArgs.fromFile(cls.nodeArgsFileName)
+        cls.resultFile = benchmark.writePdResult(cls.nodeArgsFileName)
+        cls.modTableIndex = cls.getTableIndex('Modification Sites')
+        cls.pepTableIndex = cls.getTableIndex('Peptide Groups')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    @classmethod
+    def getTableIndex(cls, tableName):
+        return [table.TableName for table in cls.nodeArgs.Tables].index(tableName)
+
+    def createModificationFilter(self, minimum):
+        header = [column.ColumnName for column in self.nodeArgs.Tables[self.modTableIndex].ColumnDescriptions]
+        predicates = [joinengines.MinimumPredicate('Site Probability >= {:g}'.format(minimum),
+                                                   header.index('Site Probability'), minimum)]
+        return joinengines.ModificationFilter(
+            ['Phospho', 'Acetyl'], header.index('Modification Name'),
+            header.index('Modification Sites Modification Site ID'), predicates)
+
+    def readRows(self, tableIndex, rowFilter, tableSource=None):
+        inTableFile, inTableReader, inTableHeader = scriptutils.getTableReader(
+            self.nodeArgs, tableIndex, tableSource, None, rowFilter)
+        try:
+            return [[str(value) for value in row] for row in inTableReader]
+        finally:
+            inTableFile.close()
+
+    def test_sql_filter(self):
+        for minimum in (-1, 30, 90):
+            with self.subTest(minimum=minimum):
+                expectedFilter = self.createModificationFilter(minimum)
+                expected = self.readRows(self.modTableIndex, expectedFilter)
+                rowFilter = self.createModificationFilter(minimum)
+                with pdresult.PdResultSource(self.resultFile) as source:
+                    self.assertIsNotNone(rowFilter.getSqlConditions(
+                        source.getColumnExpressions(self.nodeArgs, self.modTableIndex)))
+                    rows = self.readRows(self.modTableIndex, rowFilter, source)
+
+                # the Float columns of the file hold floats; the IDs and names compare as text
+                self.assertEqual([row[:3] for row in rows], [row[:3] for row in expected])
+                self.assertGreater(len(rows), 0)
+                self.assertEqual(rowFilter.getState(), expectedFilter.getState())
+                self.assertGreater(rowFilter.rowsRejected, 0)
+
+    def test_python_filter(self):
+        header = [column.ColumnName for column in self.nodeArgs.Tables[self.pepTableIndex].ColumnDescriptions]
+        quantColumns = [index for index, name in enumerate(header) if name.startswith('Abundance')]
+
+        def createFilter():
+            return joinengines.RowFilter(
+                'Peptide Groups', [joinengines.ValidValuesPredicate('abundances >= 3', quantColumns, 3)],
+                header.index('Peptide Groups Peptide Group ID'))
+        expectedFilter = createFilter()
+        expected = self.readRows(self.pepTableIndex, expectedFilter)
+        rowFilter = createFilter()
+        with pdresult.PdResultSource(self.resultFile) as source:
+            self.assertIsNone(rowFilter.getSqlConditions(source.getColumnExpressions(self.nodeArgs, self.pepTableIndex)))
+            rows = self.readRows(self.pepTableIndex, rowFilter, source)
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(rowFilter.getState(), expectedFilter.getState())
+
+    def copyResultFile(self, name, change):
+        """ Returns a copy of the result file changed by change(connection, name of the peptide groups table) """
+        resultFile = os.path.join(self.dataDir, name)
+        shutil.copy(self.resultFile, resultFile)
+        connection = sqlite3.connect(resultFile)
+        try:
+            tableName = connection.execute(
+                "SELECT TableName FROM DataTypes WHERE DisplayName = 'Peptide Groups'").fetchone()[0]
+            change(connection, tableName)
+            connection.commit()
+        finally:
+            connection.close()
+        return resultFile
+
+    def test_grouped_values(self):
+        # the abundances of the fixture are stored in blobs of grouped values, as Proteome Discoverer does
+        connection = sqlite3.connect(self.resultFile)
+        try:
+            tableName = connection.execute(
+                "SELECT TableName FROM DataTypes WHERE DisplayName = 'Peptide Groups'").fetchone()[0]
+            columnTypes = dict((row[1], row[2]) for row in connection.execute('PRAGMA table_info({})'.format(tableName)))
+        finally:
+            connection.close()
+        self.assertEqual(columnTypes['Abundances'], 'BLOB')
+        self.assertNotIn('AbundancesF1', columnTypes)
+
+        columnFile = benchmark.writePdResult(
+            self.nodeArgsFileName, os.path.join(self.dataDir, 'columns.pdResult'), groupedValues=False)
+        for columnIndices in (None, [0, 5, 6], [0, 7, 5]):
+            with self.subTest(columnIndices=columnIndices):
+                rows = []
+                for resultFile in (self.resultFile, columnFile):
+                    with pdresult.PdResultSource(resultFile) as source:
+                        cursor, reader, header = source.getTableReader(self.nodeArgs, self.pepTableIndex, columnIndices)
+                        rows.append(list(reader))
+                self.assertEqual(rows[0], rows[1])
+                self.assertTrue(any(row[5] == '' for row in rows[0]))
+
+    def test_no_export(self):
+        # a node_args.json whose input tables were not exported
+        runDir = os.path.join(self.dataDir, 'noexport')
+        os.mkdir(runDir)
+        with open(self.nodeArgsFileName) as f:
+            nodeArgs = json.load(f)
+        for table in nodeArgs['Tables']:
+            table['DataFile'] = os.path.join(runDir, 'missing', os.path.basename(table['DataFile']))
+        nodeArgs['ExpectedResponsePath'] = os.path.join(runDir, 'node_response.json')
+        nodeArgs['WorkingDirectory'] = runDir
+        nodeArgsFileName = os.path.join(runDir, 'node_args.json')
+        with open(nodeArgsFileName, 'w') as f:
+            json.dump(nodeArgs, f)
+
+        argv = ['--modifications', 'Phospho,Acetyl', '--min-site-probability', '30', '--min-valid-values', '3']
+        expected = runNode(self.nodeArgsFileName, argv + ['--join-mode', 'hash'])
+        for joinMode in sorted(joinengines.joinEngines):
+            with self.subTest(joinMode=joinMode):
+                tables = runNode(nodeArgsFileName, argv + [
+                    '--join-mode', joinMode, '--memory-budget', '1',
+                    '--input-source', 'pdresult', '--result-file', self.resultFile])
+                self.assertEqual(tables, expected)
+
+    def test_blob_errors(self):
+        # a blob of another layout
+        resultFile = self.copyResultFile('short.pdResult', lambda connection, tableName: connection.execute(
+            "UPDATE {} SET Abundances = X'00' WHERE rowid = 2".format(tableName)))
+        with pdresult.PdResultSource(resultFile) as source:
+            cursor, reader, header = source.getTableReader(self.nodeArgs, self.pepTableIndex)
+            with self.assertRaisesRegex(AssertionError, 'blob of grouped values of column Abundances has 1 bytes'):
+                list(reader)
+
+        # a column stored as a blob of its own
+        def declareBlob(connection, tableName):
+            statement = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (tableName,)).fetchone()[0]
+            connection.execute('DROP TABLE {}'.format(tableName))
+            connection.execute(statement.replace('Sequence TEXT', 'Sequence BLOB'))
+        resultFile = self.copyResultFile('blob.pdResult', declareBlob)
+        with pdresult.PdResultSource(resultFile) as source:
+            cursor, reader, header = source.getTableReader(self.nodeArgs, self.pepTableIndex, [0])
+            self.assertEqual(list(reader), [])
+            with self.assertRaisesRegex(AssertionError, 'Columns Sequence of table Peptide Groups are stored as blobs'):
+                source.getTableReader(self.nodeArgs, self.pepTableIndex)
+
+if __name__ == '__main__':
+    unittest.main()
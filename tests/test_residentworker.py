@@ -0,0 +1,153 @@
+import os
+import io
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import unittest
+import contextlib
+import residentworker
+
+"""
+The state file of the resident worker is only trusted when it is private to
+the user, and the launcher neither gives up on a long run nor waits forever
+for a worker that stopped answering.
+"""
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a worker whose runs take several heartbeats, noted in the file UC2TEST_RUNS, and that exits soon after
+workerScript = """
+import os
+import time
+import residentworker
+
+def run(argv):
+    print('started', argv)
+    time.sleep(1.0)
+    with open(os.environ['UC2TEST_RUNS'], 'a') as f:
+        f.write('run\\n')
+    print('finished')
+
+residentworker.heartbeatInterval, residentworker.replyTimeout = 0.1, 0.5
+residentworker.ResidentWorker(run, 'identity', idleTimeout=0.5).serve()
+"""
+
+# a launcher waiting the queue timeout argv[1] for its run
+launcherScript = """
+import sys
+import residentworker
+
+residentworker.queueTimeout = float(sys.argv[1])
+print('exit', residentworker.forward(['a'], 'identity'))
+"""
+
+@unittest.skipIf(sys.platform == 'win32', "POSIX permissions")
+class ResidentWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.baseDir = tempfile.mkdtemp(prefix='uc2test_')
+        self.environ = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = self.baseDir
+        self.timeouts = residentworker.heartbeatInterval, residentworker.replyTimeout
+        residentworker.heartbeatInterval, residentworker.replyTimeout = 0.1, 0.5
+
+    def tearDown(self):
+        residentworker.heartbeatInterval, residentworker.replyTimeout = self.timeouts
+        if self.environ is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = self.environ
+        shutil.rmtree(self.baseDir, ignore_errors=True)
+
+    def writeState(self, port):
+        worker = residentworker.ResidentWorker(None, 'identity')
+        worker.key = 'key'
+        stateFileName = residentworker.getStateFileName()
+        worker.writeState(stateFileName, port)
+        return stateFileName
+
+    def test_state_file(self):
+        stateFileName = self.writeState(1234)
+        stateDir = os.path.dirname(stateFileName)
+        self.assertEqual(os.stat(stateDir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(stateFileName).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(stateDir), ['worker.json'])
+        self.assertEqual(residentworker.readState()['port'], 1234)
+
+        os.chmod(stateFileName, 0o644)
+        self.assertIsNone(residentworker.readState())
+        os.chmod(stateFileName, 0o600)
+        os.chmod(stateDir, 0o755)
+        self.assertIsNone(residentworker.getStateFileName())
+        self.assertIsNone(residentworker.readState())
+
+    def test_state_link(self):
+        stateDir = os.path.join(self.baseDir, 'phosphomatics-worker-{}'.format(os.getuid()))
+        otherDir = os.path.join(self.baseDir, 'other')
+        os.mkdir(otherDir, 0o700)
+        os.symlink(otherDir, stateDir)
+        self.assertIsNone(residentworker.getStateFileName())
+
+    def startWorker(self):
+        # the worker redirects sys.stdout during a run, so it runs in a process of its own
+        self.runsFileName = os.path.join(self.baseDir, 'runs.txt')
+        worker = subprocess.Popen([sys.executable, '-c', workerScript], cwd=repoDir,
+                                  env=dict(os.environ, UC2TEST_RUNS=self.runsFileName))
+        for attempt in range(200):
+            if residentworker.readState() is not None:
+                break
+            time.sleep(0.05)
+        return worker
+
+    def getRuns(self):
+        with open(self.runsFileName) as f:
+            return len(f.readlines())
+
+    def test_long_run(self):
+        worker = self.startWorker()
+        try:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                exitCode = residentworker.forward(['a'], 'identity')
+        finally:
+            worker.wait(10)
+        self.assertEqual(exitCode, 0)
+        self.assertEqual(output.getvalue(), "started ['a']\nfinished\n")
+        self.assertIsNone(residentworker.readState())
+        self.assertEqual(self.getRuns(), 1)
+
+    def test_overlapping_launchers(self):
+        worker = self.startWorker()
+        try:
+            launchers = []
+            # the first launcher's run is going on when the others connect; the third one gives up
+            for queueTimeout in ('10', '10', '0.3'):
+                launchers.append(subprocess.Popen(
+                    [sys.executable, '-c', launcherScript, queueTimeout], cwd=repoDir,
+                    stdout=subprocess.PIPE, universal_newlines=True))
+                time.sleep(0.2)
+            outputs = [launcher.communicate(timeout=20)[0] for launcher in launchers]
+        finally:
+            worker.wait(10)
+        self.assertEqual(outputs[:2], ["started ['a']\nfinished\nexit 0\n"] * 2)
+        self.assertEqual(outputs[2], 'uc2: resident worker busy, running the node in this process\nexit None\n')
+        # the dropped run is not done once the first two are
+        self.assertEqual(self.getRuns(), 2)
+
+    def test_silent_worker(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self.writeState(listener.getsockname()[1])
+            started = time.time()
+            self.assertIsNone(residentworker.forward(['a'], 'identity'))
+            self.assertLess(time.time() - started, 5)
+        finally:
+            listener.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,378 @@
+import os
+import csv
+import sys
+import copy
+import re
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+import scriptutils
+import prepare_phosphomatics_ct
+from tests.test_joinengines import makeDataset, runNode
+
+class QuotedTableTest(unittest.TestCase):
+    """ MappedTable and ParallelTableParser against getTableReader on cells with quoted tabs, line breaks and quotes """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        cls.nodeArgs = scriptutils.NodeArgs.fromFile(makeDataset(cls.dataDir))
+        inTableFile, inTableReader, inTableHeader = scriptutils.getTableReader(cls.nodeArgs, 0)
+        try:
+            cls.rows = list(inTableReader)
+        finally:
+            inTableFile.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    def setUp(self):
+        self.minRangeBytes = scriptutils.ParallelTableParser.minRangeBytes
+        scriptutils.ParallelTableParser.minRangeBytes = 1024
+
+    def tearDown(self):
+        scriptutils.ParallelTableParser.minRangeBytes = self.minRangeBytes
+
+    def test_special_cells(self):
+        modifications = [row[2] for row in self.rows]
+        for special in ('\t', '\n', '"'):
+            self.assertTrue(any(special in cell for cell in modifications), repr(special))
+
+    def test_mapped_table(self):
+        with scriptutils.MappedTable(self.nodeArgs, 0, 0) as table:
+            self.assertEqual(len(table), len(self.rows))
+            for row in self.rows:
+                self.assertEqual(table.getRow(row[0]), row)
+
+    def test_mapped_table_id_column(self):
+        # the ID last, after the quoted cells and before the line break
+        nodeArgs = copy.deepcopy(self.nodeArgs)
+        table = nodeArgs.Tables[0]
+        table.DataFile = os.path.join(self.dataDir, 'id_last.txt')
+        table.ColumnDescriptions = table.ColumnDescriptions[1:] + table.ColumnDescriptions[:1]
+        rows = [row[1:] + row[:1] for row in self.rows]
+        with open(table.DataFile, 'w', newline='') as f:
+            f.write('\t'.join('"%s"' % column.ColumnName for column in table.ColumnDescriptions) + '\n')
+            csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+
+        # a quoted ID is decoded with its row
+        with open(table.DataFile, 'rb') as f:
+            text = f.read()
+        quotedID = ('\t"%s"\n' % rows[3][-1]).encode()
+        text = text.replace(('\t%s\n' % rows[3][-1]).encode(), quotedID)
+        self.assertEqual(text.count(quotedID), 1)
+        with open(table.DataFile, 'wb') as f:
+            f.write(text)
+        with scriptutils.MappedTable(nodeArgs, 0, len(rows[0]) - 1) as mappedTable:
+            self.assertEqual(len(mappedTable), len(rows))
+            for row in rows:
+                self.assertEqual(mappedTable.getRow(row[-1]), row)
+
+    def test_parallel_rows(self):
+        for workers in (1, 2, 3):
+            with scriptutils.ParallelTableParser(self.nodeArgs, 0, workers) as parser:
+                if workers > 1:
+                    self.assertGreater(len(parser.ranges), 1)
+                self.assertEqual(list(parser.iterRows()), self.rows)
+                projected = list(parser.iterRows([0, 2]))
+                self.assertEqual([(row[0], row[2]) for row in projected], [(row[0], row[2]) for row in self.rows])
+                self.assertTrue(all(row[1] == '' for row in projected))
+
+    def test_parallel_columnar(self):
+        valueColumnIndices = list(range(4, len(self.rows[0])))
+        expected = scriptutils.readColumnarTable(self.nodeArgs, 0, 0, valueColumnIndices)
+        table = scriptutils.readColumnarTable(self.nodeArgs, 0, 0, valueColumnIndices, workers=3)
+        self.assertEqual(table.ids, expected.ids)
+        self.assertEqual(table.values.tobytes(), expected.values.tobytes())
+        self.assertEqual(table.rowIndex, expected.rowIndex)
+
+def getState(obj):
+    """ Returns the attributes of the decoded objects as plain values, for comparing the decoders """
+    if isinstance(obj, list):
+        return [getState(v) for v in obj]
+    if isinstance(obj, dict):
+        return dict((k, getState(v)) for k, v in obj.items())
+    if type(obj).__module__ != 'scriptutils':
+        return obj
+    state = {'class': type(obj).__name__}
+    for name in dir(type(obj)):
+        if isinstance(getattr(type(obj), name), property):
+            state[name] = getState(getattr(obj, name, '<unset>'))
+    return state
+
+class NodeDocumentDecoderTest(unittest.TestCase):
+    """ NodeDocumentDecoder against NodeArgsDecoder and NodeResponseDecoder """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        cls.nodeArgsFileName = makeDataset(cls.dataDir)
+        runNode(cls.nodeArgsFileName, [])
+        with open(cls.nodeArgsFileName, 'r') as f:
+            cls.nodeArgsDict = json.load(f)
+        with open(cls.nodeArgsDict['ExpectedResponsePath'], 'r') as f:
+            cls.nodeResponseDict = json.load(f)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    def decode(self, dct, decoderClass, documentClass, decode):
+        """ Returns the objects of both decoders, or the exception types they raise """
+        jsonStr = json.dumps(dct)
+        results = []
+        for decodeDocument in (lambda: documentClass.fromDict(json.loads(jsonStr, cls=decoderClass)),
+                               lambda: decode(json.loads(jsonStr))):
+            try:
+                results.append(getState(decodeDocument()))
+            except (AssertionError, ValueError) as e:
+                results.append(type(e))
+        return results
+
+    def getDocuments(self, dct, tableIndex, options):
+        """ Yields dct, and copies of it with options as the first column Options of the table """
+        yield dct
+        for columnOptions in options:
+            changed = copy.deepcopy(dct)
+            changed['Tables'][tableIndex]['ColumnDescriptions'][1]['Options'] = columnOptions
+            yield changed
+
+    def test_node_args(self):
+        self.assertTrue(any(table.get('Options') for table in self.nodeArgsDict['Tables']))
+        options = [{'DataGroupName': 'Abundances', 'PositionAfter': 'Sequence'}, {'PositionAfter': 'Sequence'},
+                   {'FirstTable': 'Peptide Groups'}, {'ColumnName': 'Sequence', 'ID': '', 'DataType': 'String'}]
+        for i, dct in enumerate(self.getDocuments(self.nodeArgsDict, 0, options)):
+            with self.subTest(document=i):
+                old, new = self.decode(dct, scriptutils.NodeArgsDecoder, scriptutils.NodeArgs,
+                                       scriptutils.NodeDocumentDecoder.decodeNodeArgs)
+                self.assertEqual(new, old)
+                if i < 3:
+                    self.assertEqual(new['class'], 'NodeArgs')
+                else:
+                    self.assertIs(new, AssertionError)
+
+    def test_node_response(self):
+        options = [{'DataGroupName': 'Abundances', 'PositionAfter': 'Accession', 'FormatString': 'F2'},
+                   {'RelativePosition': 2}, {'FirstTable': 'Phosphomatics'}]
+        for i, dct in enumerate(self.getDocuments(self.nodeResponseDict, 0, options)):
+            with self.subTest(document=i):
+                old, new = self.decode(dct, scriptutils.NodeResponseDecoder, scriptutils.NodeResponse,
+                                       scriptutils.NodeDocumentDecoder.decodeNodeResponse)
+                self.assertEqual(new, old)
+                if i < 3:
+                    self.assertEqual(new['class'], 'NodeResponse')
+                else:
+                    self.assertIs(new, AssertionError)
+
+        # the response options keep their own keys
+        dct = list(self.getDocuments(self.nodeResponseDict, 0, options[:1]))[1]
+        nodeResponse = scriptutils.NodeDocumentDecoder.decodeNodeResponse(copy.deepcopy(dct))
+        columnOptions = nodeResponse.Tables[0].ColumnDescriptions[1].Options
+        self.assertIsInstance(columnOptions, scriptutils.ResponseColumnOptions)
+        self.assertEqual((columnOptions.PositionAfter, columnOptions.FormatString), ('Accession', 'F2'))
+
+class SlotsTest(unittest.TestCase):
+    """ The classes holding their attributes in __slots__ """
+
+    def test_unset_attributes(self):
+        responseOptionNames = ['DataGroupName', 'PositionBefore', 'PositionAfter', 'RelativePosition',
+                               'PlotType', 'FormatString', 'SpecialCellRenderer']
+        cases = [
+            (scriptutils.ColumnOptions(), ['DataGroupName'], 'DataGroupName', 'Abundances'),
+            (scriptutils.ResponseColumnOptions(), responseOptionNames, 'PositionAfter', 'Accession'),
+            # its setters keep None
+            (scriptutils.ConnectionTableOptions(), [], 'FirstTable', 'Phosphomatics'),
+            (scriptutils.ColumnDescription('Sequence', '', 'String'), ['Options'],
+             'Options', scriptutils.ColumnOptions()),
+            (scriptutils.ResponseTableColumnDescription('Accession', '', 'String'), ['Options'],
+             'Options', scriptutils.ResponseColumnOptions()),
+        ]
+        for obj, unsetNames, name, value in cases:
+            with self.subTest(cls=type(obj).__name__):
+                for unsetName in unsetNames:
+                    self.assertFalse(hasattr(obj, unsetName), unsetName)
+                self.assertFalse(hasattr(obj, '__dict__'))
+                with self.assertRaises(AttributeError):
+                    obj.Unknown = 1
+                self.assertEqual(type(obj).toDict(obj).get(name), None)
+                setattr(obj, name, value)
+                self.assertTrue(hasattr(obj, name))
+                self.assertIs(getattr(obj, name), value)
+                self.assertIn(name, type(obj).toDict(obj))
+
+        self.assertIsNone(scriptutils.ColumnDescription('Sequence', '', 'String').DataGroupName)
+        options = scriptutils.ConnectionTableOptions()
+        self.assertEqual((options.FirstTable, options.SecondTable), (None, None))
+
+    def test_columns_without_options(self):
+        # Peptide Groups columns without Options are read like those with empty Options
+        dataDir = tempfile.mkdtemp(prefix='uc2test_')
+        try:
+            nodeArgsFileName = makeDataset(dataDir, mappings=1000)
+            expected = runNode(nodeArgsFileName, [])
+            with open(nodeArgsFileName, 'r') as f:
+                dct = json.load(f)
+            columns = [column for column in dct['Tables'][0]['ColumnDescriptions']
+                       if not column.get('Options', {}).get('DataGroupName')]
+            self.assertEqual(dct['Tables'][0]['TableName'], 'Peptide Groups')
+            self.assertGreater(len(columns), 1)
+            for column in columns:
+                del column['Options']
+            with open(nodeArgsFileName, 'w') as f:
+                json.dump(dct, f)
+
+            nodeArgs = scriptutils.NodeArgs.fromFile(nodeArgsFileName)
+            self.assertFalse(hasattr(nodeArgs.Tables[0].ColumnDescriptions[1], 'Options'))
+            self.assertEqual(runNode(nodeArgsFileName, []), expected)
+        finally:
+            shutil.rmtree(dataDir, ignore_errors=True)
+
+class ScriptedProfiler(scriptutils.StageProfiler):
+    """ A StageProfiler whose clocks (wall, cpu, child cpu) only move by advance() """
+
+    def __init__(self):
+        self.clock = [0.0, 0.0, 0.0]
+        scriptutils.StageProfiler.__init__(self)
+
+    def getTimes(self):
+        return tuple(self.clock)
+
+    def advance(self, *seconds):
+        for i, s in enumerate(seconds):
+            self.clock[i] += s
+
+class StageProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    def test_nested_stages(self):
+        profiler = ScriptedProfiler()
+        with profiler.stage('outer') as outer:
+            profiler.advance(1.0, 0.5, 0.0)
+            with profiler.stage('inner') as inner:
+                profiler.advance(2.0, 1.0, 0.25)
+                inner.rowsIn = 10
+                inner.rowsOut = 5
+            profiler.advance(0.5, 0.5, 0.0)
+            with profiler.stage('inner') as inner:
+                profiler.advance(1.0, 0.0, 0.0)
+                inner.rowsOut = 3
+            outer.rowsOut = 8
+        profiler.advance(0.25, 0.25, 0.0)
+
+        fileName = os.path.join(self.dataDir, 'profile.json')
+        profiler.toFile(fileName)
+        with open(fileName, 'r') as f:
+            profile = json.load(f)
+        # the times of a stage exclude those of the stages nested in it
+        self.assertEqual(list(profile['stages']), ['outer', 'inner'])
+        outer, inner = profile['stages']['outer'], profile['stages']['inner']
+        self.assertEqual((outer['calls'], outer['wallSeconds'], outer['cpuSeconds'], outer['childCpuSeconds']),
+                         (1, 1.5, 1.0, 0.0))
+        self.assertEqual((outer['rowsIn'], outer['rowsOut']), (None, 8))
+        self.assertEqual((inner['calls'], inner['wallSeconds'], inner['cpuSeconds'], inner['childCpuSeconds']),
+                         (2, 3.0, 1.0, 0.25))
+        self.assertEqual((inner['rowsIn'], inner['rowsOut']), (10, 8))
+        self.assertEqual((profile['wallSeconds'], profile['cpuSeconds'], profile['childCpuSeconds']), (4.75, 2.25, 0.25))
+        self.assertEqual(profiler.summary()[-2], 'inner: 3.000 s wall, 1.250 s cpu, 10 rows in, 8 rows out')
+
+        with self.assertRaisesRegex(AssertionError, "stage 'a' exited before stage 'b'"):
+            a = profiler.stage('a')
+            with a:
+                profiler.stage('b').__enter__()
+                a.__exit__(None, None, None)
+
+    def test_null_profiler(self):
+        profiler = scriptutils.NullProfiler()
+        with profiler.stage('outer') as outer:
+            with profiler.stage('inner') as inner:
+                inner.rowsOut = 1
+        self.assertEqual(list(profiler.markFirst(iter([1, 2]), 'first')), [1, 2])
+        profiler.finish()
+
+    def test_profile_option(self):
+        nodeArgsFileName = makeDataset(self.dataDir, mappings=1000)
+        profileFileName = os.path.join(self.dataDir, 'node_response_profile.json')
+        runNode(nodeArgsFileName, ['--join-mode', 'hash'])
+        self.assertFalse(os.path.exists(profileFileName))
+
+        tables = runNode(nodeArgsFileName, ['--join-mode', 'hash', '--profile'])
+        with open(profileFileName, 'r') as f:
+            profile = json.load(f)
+        stages = profile['stages']
+        self.assertEqual(sorted(stages), sorted(['readNodeArgs', 'buildTemplate', 'storeNodeResponse', 'write',
+                                                 'join', 'parsePeptides', 'parseModifications', 'parseMapRows']))
+        self.assertIn('firstRecord', profile['marks'])
+        for name, measurements in stages.items():
+            self.assertGreaterEqual(measurements['calls'], 1, name)
+            self.assertGreaterEqual(measurements['wallSeconds'], 0.0, name)
+        self.assertLessEqual(sum(measurements['wallSeconds'] for measurements in stages.values()),
+                             profile['wallSeconds'] + 1e-6)
+
+        sites = len(tables['Phosphomatics.txt']) - 1
+        connections = len(tables['Phosphomatics-TargetPeptideGroup.txt']) - 1
+        self.assertEqual(stages['join']['rowsOut'], sites)
+        self.assertEqual((stages['write']['rowsIn'], stages['write']['rowsOut']), (sites, sites + connections))
+        with open(nodeArgsFileName, 'r') as f:
+            peptideGroupsFileName = json.load(f)['Tables'][0]['DataFile']
+        with open(peptideGroupsFileName, 'r', newline='') as f:
+            peptideGroups = len(list(csv.reader(f, delimiter='\t'))) - 1
+        self.assertEqual(stages['parsePeptides']['rowsOut'], peptideGroups)
+
+    def test_startup_profile(self):
+        # a process of its own, the imports being what is measured
+        nodeArgsFileName = makeDataset(self.dataDir, mappings=1000)
+        scriptFileName = os.path.abspath(prepare_phosphomatics_ct.__file__)
+        for joinMode, expectedModules in (('hash', []), ('sqlite', ['sqlite3'])):
+            with self.subTest(joinMode=joinMode):
+                log = subprocess.check_output(
+                    [sys.executable, scriptFileName, nodeArgsFileName, '--join-mode', joinMode, '--startup-profile'],
+                    universal_newlines=True)
+                times = dict((name, float(ms)) for name, ms in re.findall(r'uc2: startup (.+?) ([\d.]+) ms', log))
+                self.assertEqual(sorted(times), sorted(['interpreter', 'imports', 'readNodeArgs', 'buildTemplate',
+                                                        'storeNodeResponse', 'first record']))
+                self.assertGreater(times['imports'], 0.0)
+                self.assertGreaterEqual(times['first record'], times['imports'])
+
+                modules = re.search(r'uc2: startup optional modules loaded: (.+)', log).group(1).split(', ')
+                self.assertIn('argparse', modules)
+                for name in expectedModules:
+                    self.assertIn(name, modules)
+                for name in ['six', 'pickle', 'hashlib', 'multiprocessing', 'residentworker', 'pdresult']:
+                    self.assertNotIn(name, modules)
+                if not expectedModules:
+                    self.assertNotIn('sqlite3', modules)
+
+class TableWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp(prefix='uc2test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    @unittest.skipIf(sys.platform == 'win32', "POSIX permissions")
+    def test_permissions(self):
+        for umask in (0o022, 0o002, 0o077):
+            oldUmask = os.umask(umask)
+            try:
+                fileName = os.path.join(self.dataDir, 'table_%o.txt' % umask)
+                with scriptutils.TableWriter(fileName, ['ID']) as writer:
+                    writer.writerow(['1'])
+                with open(fileName + '.open', 'w'):
+                    pass
+            finally:
+                os.umask(oldUmask)
+            with self.subTest(umask=oct(umask)):
+                self.assertEqual(os.stat(fileName).st_mode & 0o777, 0o666 & ~umask)
+                self.assertEqual(os.stat(fileName).st_mode, os.stat(fileName + '.open').st_mode)
+
+if __name__ == '__main__':
+    unittest.main()